@@ -6,6 +6,7 @@ setup(
     name="LookPyrenees",
     package_dir={"": "src"},
     packages=["LookPyrenees"],
+    package_data={"LookPyrenees": ["ressources/*"]},
     version="0.0.1",
     author="Romain Buguet de Chargère",
     author_email="rbuguet@gmail.com",
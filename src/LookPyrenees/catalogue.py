@@ -0,0 +1,153 @@
+"""This module caches search results on disk to only query new acquisitions"""
+import datetime
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+
+from LookPyrenees.utils import sqlite_connect
+
+DEFAULT_TTL = datetime.timedelta(hours=24)
+# New acquisitions can be published a few days after their sensing date
+OVERLAP = datetime.timedelta(days=2)
+
+
+def search_key(provider, criteria):
+    """Build the cache key of a search from its provider, product type and geometry"""
+    geometry = hashlib.sha1(criteria["geom"].wkb).hexdigest()
+
+    return f'{provider}/{criteria["productType"]}/{geometry}'
+
+
+class Catalogue:
+    """
+    SQLite cache of EO products metadata per search key. A search is fully refreshed
+    when the cache is older than its TTL, otherwise only the window after the newest
+    cached product is queried and merged with cached products.
+    """
+
+    def __init__(self, path, ttl=DEFAULT_TTL, refresh=False):
+        self.path = str(path)
+        self.ttl = ttl
+        self.refresh = refresh
+        with sqlite_connect(self.path) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS searches (key TEXT PRIMARY KEY, refreshed_at TEXT NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS products (key TEXT NOT NULL, id TEXT NOT NULL, "
+                "start_date TEXT NOT NULL, feature TEXT NOT NULL, PRIMARY KEY (key, id))"
+            )
+
+    def is_expired(self, key, now):
+        """Check if the cached results of a search have to be fully refreshed"""
+        if self.refresh:
+            return True
+
+        with sqlite_connect(self.path) as conn:
+            row = conn.execute("SELECT refreshed_at FROM searches WHERE key = ?", (key,)).fetchone()
+
+        return row is None or now - datetime.datetime.fromisoformat(row[0]) > self.ttl
+
+    def store(self, key, search_results, refreshed_at=None):
+        """Insert or update products of a search, replacing all of them on full refresh"""
+        rows = [
+            (
+                key,
+                product.properties["id"],
+                product.properties["startTimeFromAscendingNode"],
+                json.dumps(product.as_dict()),
+            )
+            for product in search_results
+        ]
+        with sqlite_connect(self.path) as conn:
+            if refreshed_at is not None:
+                conn.execute("DELETE FROM products WHERE key = ?", (key,))
+                conn.execute(
+                    "INSERT OR REPLACE INTO searches VALUES (?, ?)", (key, refreshed_at.isoformat())
+                )
+            conn.executemany("INSERT OR REPLACE INTO products VALUES (?, ?, ?, ?)", rows)
+
+    def newest_date(self, key):
+        """Return the sensing date of the newest cached product of a search, None if there is none"""
+        with sqlite_connect(self.path) as conn:
+            row = conn.execute("SELECT MAX(start_date) FROM products WHERE key = ?", (key,)).fetchone()
+
+        return None if row[0] is None else datetime.date.fromisoformat(row[0][:10])
+
+    def load(self, key, dag, start):
+        """
+        Load cached products sensed after start as search results ready for download,
+        older products are dropped from the cache
+        """
+        with sqlite_connect(self.path) as conn:
+            conn.execute("DELETE FROM products WHERE key = ? AND start_date < ?", (key, str(start)))
+            features = [
+                json.loads(feature)
+                for (feature,) in conn.execute(
+                    "SELECT feature FROM products WHERE key = ? ORDER BY start_date", (key,)
+                )
+            ]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            geojson_path = os.path.join(tmp_dir, "search_results.geojson")
+            with open(geojson_path, "w", encoding="utf-8") as geojson:
+                json.dump({"type": "FeatureCollection", "features": features}, geojson)
+
+            return dag.deserialize_and_register(geojson_path)
+
+    def search(self, dag, provider, criteria, search):
+        """
+        Return search results of criteria, only querying the provider for new acquisitions
+        when the cache is still valid
+
+        :param search: Function querying the provider with search criteria.
+        """
+        key = search_key(provider, criteria)
+        now = datetime.datetime.now()
+
+        if self.is_expired(key, now):
+            logging.info("Refresh catalogue cache of %s", key)
+            search_results = search(criteria)
+            self.store(key, search_results, refreshed_at=now)
+            return search_results
+
+        newest_date = self.newest_date(key)
+        start = criteria["start"] if newest_date is None else newest_date - OVERLAP
+        logging.info("Search products of %s from %s, older ones are cached", key, start)
+        self.store(key, search(dict(criteria, start=str(start))))
+
+        return self.load(key, dag, criteria["start"])
+
+
+class MemoryCache:
+    """
+    Keep search results in memory for a while in front of an optional catalogue, so that
+    a service triggered often does not query providers nor read the catalogue each run
+    """
+
+    def __init__(self, catalogue=None, ttl=datetime.timedelta(minutes=10)):
+        self.catalogue = catalogue
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.results = {}
+
+    def search(self, dag, provider, criteria, search):
+        """Return search results of criteria kept in memory if they are recent enough, see Catalogue.search"""
+        key = search_key(provider, criteria)
+        now = datetime.datetime.now()
+        with self.lock:
+            if key in self.results and now - self.results[key][0] <= self.ttl:
+                logging.info("Search results of %s kept in memory", key)
+                return self.results[key][1]
+
+        if self.catalogue is None:
+            search_results = search(criteria)
+        else:
+            search_results = self.catalogue.search(dag, provider, criteria, search)
+        with self.lock:
+            self.results[key] = (now, search_results)
+
+        return search_results
@@ -1,10 +1,24 @@
 """CLI to run LookPyrenees module"""
 import argparse
+import cProfile
+import datetime
 import logging
+import os
 import sys
 from pathlib import Path
 
-from LookPyrenees.download import check_old_files, process
+from LookPyrenees.catalogue import Catalogue
+from LookPyrenees.download import (
+    DOWNLOAD_MODES,
+    IMAGE_FORMATS,
+    check_old_files,
+    process_zones,
+)
+from LookPyrenees.federation import SEARCH_TIMEOUT
+from LookPyrenees.metrics import RunMetrics
+from LookPyrenees.outputs import RETENTION_DAYS
+from LookPyrenees.service import ZoneService, serve
+from LookPyrenees.tiles import TILE_FORMATS
 
 __author__ = "Romain Buguet de Chargère"
 __copyright__ = "Romain Buguet de Chargère"
@@ -14,19 +28,17 @@ ALL_ZONES = ["3seigneurs", "carlit", "orlu", "rulhe_nerassol", "montcalm"]
 
 
 # ---- CLI ----
-def parse_args(args):
-    """Parse command line parameters
+def build_parser(prog=None, description="Workflow that download last images of Pyrenees"):
+    """Build the parser of the options of a run, shared by runs and the service
 
     Args:
-      args (List[str]): command line parameters as list of strings
-          (for example  ``["--help"]``).
+      prog (str): program name shown in the usage, by default the script name
+      description (str): description shown in the help
 
     Returns:
-      :obj:`argparse.Namespace`: command line parameters namespace
+      :obj:`argparse.ArgumentParser`: parser of run options
     """
-    parser = argparse.ArgumentParser(
-        description="Workflow that download last images of Pyrenees"
-    )
+    parser = argparse.ArgumentParser(prog=prog, description=description)
 
     parser.add_argument("-z",
                         "--zone",
@@ -52,6 +64,21 @@ def parse_args(args):
         type=str,
         default="cop_dataspace",
     )
+    parser.add_argument(
+        "--providers",
+        dest="providers",
+        help="Comma separated providers searched concurrently instead of the preferred provider only, "
+        "their results are merged preferring L2A products and the fastest provider",
+        type=lambda providers: providers.split(","),
+        default=None,
+    )
+    parser.add_argument(
+        "--search-timeout",
+        dest="search_timeout",
+        help="Number of seconds to wait for providers searched concurrently",
+        type=float,
+        default=SEARCH_TIMEOUT,
+    )
     parser.add_argument(
         "-b",
         "--bucket-name",
@@ -60,14 +87,152 @@ def parse_args(args):
         type=str,
         default=None,
     )
+    parser.add_argument(
+        "--bucket-manifest",
+        dest="bucket_manifest",
+        help="Read and update a manifest of images on the bucket instead of listing it",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--catalogue-cache",
+        dest="catalogue_cache",
+        help="Path of the search results cache, by default catalogue.sqlite in the output dirpath",
+        type=Path,
+        default=None,
+    )
+    parser.add_argument(
+        "--catalogue-ttl",
+        dest="catalogue_ttl",
+        help="Number of hours before the search results cache is fully refreshed",
+        type=float,
+        default=24,
+    )
+    parser.add_argument(
+        "--refresh-catalogue",
+        dest="refresh_catalogue",
+        help="Fully refresh the search results cache",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-d",
+        "--download-mode",
+        dest="download_mode",
+        help="Download the full product, only its TCI asset or read the TCI asset in place",
+        type=str,
+        choices=DOWNLOAD_MODES,
+        default="full",
+    )
+    parser.add_argument(
+        "--download-workers",
+        dest="download_workers",
+        help="Number of concurrent downloads and uploads",
+        type=int,
+        default=2,
+    )
+    parser.add_argument(
+        "--cpu-workers",
+        dest="cpu_workers",
+        help="Number of processes cropping images, by default the number of cores",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--download-interval",
+        dest="download_interval",
+        help="Minimum number of seconds between two download starts to respect provider rate limits",
+        type=float,
+        default=0.0,
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        dest="img_format",
+        help="Format of zone images",
+        type=str,
+        choices=list(IMAGE_FORMATS),
+        default="png",
+    )
+    parser.add_argument(
+        "-q",
+        "--quality",
+        dest="quality",
+        help="Compression level from 0 to 9 for png, quality from 1 to 100 for webp and jpeg",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--no-local",
+        dest="keep_local",
+        help="Only stream zone images to the bucket without writing them in the output dirpath",
+        action="store_false",
+    )
+    parser.add_argument(
+        "--tile-cloudcover",
+        dest="cloud_scoring",
+        help="Select products by the cloud cover of the whole tile instead of the cloud mask over each zone, "
+        "as done anyway for providers exposing no SCL or MSK_CLDPRB asset such as cop_dataspace",
+        action="store_false",
+    )
+    parser.add_argument(
+        "--time-series",
+        dest="time_series",
+        help="Also append zone crops to per zone Zarr cubes in the cubes directory of the output dirpath, "
+        "kept beyond the retention of images",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--tiles",
+        dest="tile_format",
+        help="Also render the newest crop of each zone into a Web Mercator tile pyramid in the tiles directory "
+        "of the output dirpath, as XYZ files or one MBTiles archive per zone",
+        type=str,
+        choices=TILE_FORMATS,
+        default=None,
+    )
+    parser.add_argument(
+        "--snow",
+        dest="snow",
+        help="Also compute the NDSI snow fraction of zones from B03 and B11 bands, added to their JSON file, "
+        "requires the full download mode",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--dem",
+        dest="dem_path",
+        help="Path of a DEM raster to also estimate the snow line altitude of zones",
+        type=str,
+        default=None,
+    )
     parser.add_argument(
         "-s",
         "--show-results",
         dest="plot_results",
-        help="Boolean to view or not search results",
+        help="Boolean to write or not a contact sheet of search results quicklooks",
         type=bool,
         default=False,
     )
+    parser.add_argument(
+        "--report",
+        dest="report_path",
+        help="Path of the JSON run report with time of each stage, bytes and peak memory, "
+        "by default run_report.json in the output dirpath",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--openmetrics",
+        dest="openmetrics_path",
+        help="Path to also write the run report as Prometheus/OpenMetrics text",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--profile",
+        dest="profile_path",
+        help="Path to write cProfile statistics of the run, readable with pstats or snakeviz",
+        type=str,
+        default=None,
+    )
     parser.add_argument(
         "--version", action="version", version=f"Look Pyrenees version : {__version__}"
     )
@@ -89,7 +254,180 @@ def parse_args(args):
         const=logging.DEBUG,
     )
 
-    return parser.parse_args(args)
+    parser.set_defaults(loglevel=logging.INFO)
+
+    return parser
+
+
+def check_args(parser, parsed_args):
+    """Exit with an error on incompatible options"""
+    if not parsed_args.keep_local and parsed_args.bucket_name is None:
+        parser.error("--no-local requires a bucket name")
+    if parsed_args.dem_path is not None and not parsed_args.snow:
+        parser.error("--dem requires --snow")
+    if parsed_args.snow and parsed_args.download_mode != "full":
+        parser.error("--snow requires -d full, the green and SWIR bands are not in the TCI asset")
+
+    return parsed_args
+
+
+def parse_args(args):
+    """Parse command line parameters
+
+    Args:
+      args (List[str]): command line parameters as list of strings
+          (for example  ``["--help"]``).
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = build_parser()
+
+    return check_args(parser, parser.parse_args(args))
+
+
+def parse_serve_args(args):
+    """Parse command line parameters of the serve subcommand
+
+    Args:
+      args (List[str]): command line parameters following ``serve``
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = build_parser(
+        prog="LookPyrenees serve",
+        description="Service keeping the gateway and zones in memory, runs are triggered through a local HTTP API",
+    )
+    parser.add_argument(
+        "--host",
+        dest="host",
+        help="Address the HTTP API listens on, 0.0.0.0 in a container",
+        type=str,
+        default="127.0.0.1",
+    )
+    parser.add_argument(
+        "--port",
+        dest="port",
+        help="Port the HTTP API listens on, by default the PORT environment variable or 8080",
+        type=int,
+        default=int(os.environ.get("PORT", 8080)),
+    )
+    parser.add_argument(
+        "--search-cache-ttl",
+        dest="search_cache_ttl",
+        help="Number of minutes search results are kept in memory between runs",
+        type=float,
+        default=10,
+    )
+
+    return check_args(parser, parser.parse_args(args))
+
+
+def parse_prune_args(args):
+    """Parse command line parameters of the prune-bucket subcommand
+
+    Args:
+      args (List[str]): command line parameters following ``prune-bucket``
+
+    Returns:
+      :obj:`argparse.Namespace`: command line parameters namespace
+    """
+    parser = argparse.ArgumentParser(
+        prog="LookPyrenees prune-bucket",
+        description="Delete old zone images of a bucket with batch requests",
+    )
+    parser.add_argument(
+        "-b",
+        "--bucket-name",
+        dest="bucket_name",
+        help="Select the bucket name",
+        type=str,
+        required=True,
+    )
+    parser.add_argument(
+        "--max-age",
+        dest="max_age_days",
+        help=f"Delete images sensed more than this number of days ago, {RETENTION_DAYS} unless --keep-last is given",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--keep-last",
+        dest="keep_last",
+        help="Keep only this number of the newest images of each zone",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--bucket-manifest",
+        dest="bucket_manifest",
+        help="Read and update a manifest of images on the bucket instead of listing it",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--dry-run",
+        dest="dry_run",
+        help="Only log the images which would be deleted",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        dest="loglevel",
+        help="set loglevel to INFO",
+        action="store_const",
+        const=logging.INFO,
+    )
+    parser.add_argument(
+        "-vv",
+        "--very-verbose",
+        dest="loglevel",
+        help="set loglevel to DEBUG",
+        action="store_const",
+        const=logging.DEBUG,
+    )
+    parser.set_defaults(loglevel=logging.INFO)
+
+    parsed_args = parser.parse_args(args)
+    if parsed_args.max_age_days is None and parsed_args.keep_last is None:
+        parsed_args.max_age_days = RETENTION_DAYS
+
+    return parsed_args
+
+
+def run_options(args):
+    """Return the keyword arguments of process_zones given by the options of a run"""
+    return {
+        "outdir": args.out_path,
+        "pref_provider": args.pref_provider,
+        "providers": args.providers,
+        "search_timeout": args.search_timeout,
+        "plot_res": args.plot_results,
+        "bucket": args.bucket_name,
+        "download_mode": args.download_mode,
+        "bucket_manifest": args.bucket_manifest,
+        "cloud_scoring": args.cloud_scoring,
+        "download_workers": args.download_workers,
+        "cpu_workers": args.cpu_workers,
+        "download_interval": args.download_interval,
+        "img_format": args.img_format,
+        "quality": args.quality,
+        "keep_local": args.keep_local,
+        "time_series": args.time_series,
+        "tiles": args.tile_format,
+        "snow": args.snow,
+        "dem_path": args.dem_path,
+    }
+
+
+def open_catalogue(args):
+    """Open the search results cache of the options of a run"""
+    return Catalogue(
+        args.catalogue_cache or Path(args.out_path, "catalogue.sqlite"),
+        ttl=datetime.timedelta(hours=args.catalogue_ttl),
+        refresh=args.refresh_catalogue,
+    )
 
 
 def setup_logging(loglevel):
@@ -109,8 +447,17 @@ def main(args):
 
     Args:
       args (List[str]): command line parameters as list of strings
-          (for example  ``["--verbose", "42"]``).
+          (for example  ``["--verbose", "42"]``), or ``serve`` followed by
+          them to start the service, or ``prune-bucket`` followed by its
+          options to delete old images of a bucket.
     """
+    if args[:1] == ["serve"]:
+        serve_main(args[1:])
+        return
+    if args[:1] == ["prune-bucket"]:
+        prune_main(args[1:])
+        return
+
     args = parse_args(args)
     setup_logging(args.loglevel)
 
@@ -121,21 +468,68 @@ def main(args):
 
     Path(args.out_path).mkdir(parents=True, exist_ok=True)
 
-    for zone in zones_list:
+    catalogue = open_catalogue(args)
+
+    logging.info("Downloading %s zones", ", ".join(zones_list))
+
+    metrics = RunMetrics()
+    profiler = None
+    if args.profile_path is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
 
-        logging.info(f"Downloading {zone} zone")
+    # The profile and reports of a failed run are written too
+    try:
+        process_zones(zones=zones_list, catalogue=catalogue, metrics=metrics, **run_options(args))
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile_path)
+            logging.info("Profile of the run written to %s", args.profile_path)
 
-        process(
-            zone=zone,
-            outdir=args.out_path,
-            pref_provider=args.pref_provider,
-            plot_res=args.plot_results,
-            bucket=args.bucket_name
-        )
+        metrics.write_json(args.report_path or Path(args.out_path, "run_report.json"))
+        if args.openmetrics_path is not None:
+            metrics.write_openmetrics(args.openmetrics_path)
 
     check_old_files(args.out_path)
 
 
+def serve_main(args):
+    """Start the service and answer HTTP requests until interrupted
+
+    Args:
+      args (List[str]): command line parameters following ``serve``
+    """
+    args = parse_serve_args(args)
+    setup_logging(args.loglevel)
+    Path(args.out_path).mkdir(parents=True, exist_ok=True)
+
+    service = ZoneService(
+        run_options(args), catalogue=open_catalogue(args),
+        search_cache_ttl=datetime.timedelta(minutes=args.search_cache_ttl), all_zones=ALL_ZONES,
+    )
+    serve(service, args.host, args.port)
+
+
+def prune_main(args):
+    """Delete old zone images of a bucket
+
+    Args:
+      args (List[str]): command line parameters following ``prune-bucket``
+    """
+    # The storage client is only imported by commands using a bucket to keep the CLI startup fast
+    # pylint: disable=import-outside-toplevel
+    from LookPyrenees.manage_bucket import check_old_blobs
+
+    args = parse_prune_args(args)
+    setup_logging(args.loglevel)
+
+    check_old_blobs(
+        args.bucket_name, max_age_days=args.max_age_days, keep_last=args.keep_last,
+        use_manifest=args.bucket_manifest, dry_run=args.dry_run,
+    )
+
+
 def run():
     """Calls :func:`main` passing the CLI arguments extracted from :obj:`sys.argv`"""
     main(sys.argv[1:])
@@ -0,0 +1,122 @@
+"""
+This module scores clouds of zones from the scene classification or cloud probability
+masks of EO products, reading only zone windows of their small assets before any download
+"""
+# pylint: disable=import-error,import-outside-toplevel
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from LookPyrenees.staging import gdal_auth, product_auth
+from LookPyrenees.zones import zone_pixels
+
+# Asset keys of the scene classification layer and of the cloud probability mask, e.g. SCL_20m or MSK_CLDPRB_60m
+CLOUD_ASSET_PATTERNS = {"scl": re.compile(r"(?i)^scl"), "cldprb": re.compile(r"(?i)cldprb")}
+# SCL classes of cloud shadows, medium and high probability clouds and thin cirrus
+SCL_CLOUDY = (3, 8, 9, 10)
+# SCL classes of no data and saturated or defective pixels
+SCL_INVALID = (0, 1)
+# Cloud probability in percent from which a pixel of MSK_CLDPRB is cloudy
+CLDPRB_THRESHOLD = 50
+CLOUD_WORKERS = 8
+
+
+def find_cloud_asset(final_img):
+    """
+    Return the kind and href of the cloud mask asset of an EO product, preferring SCL and
+    the coarsest resolution, or (None, None) when the provider does not expose one
+    """
+    assets = getattr(final_img, "assets", None) or {}
+    for kind, pattern in CLOUD_ASSET_PATTERNS.items():
+        keys = [key for key in assets.keys() if pattern.search(key)]
+        # 60m masks are 9 times smaller than 20m ones
+        keys = sorted(keys, key=lambda key: ("60m" not in key, key))
+        if keys:
+            return kind, assets[keys[0]].get("href")
+
+    return None, None
+
+
+def cloud_mask(data, kind):
+    """
+    Return boolean masks of cloudy and valid pixels of a cloud mask band
+
+    :param kind: scl or cldprb, see CLOUD_ASSET_PATTERNS.
+    """
+    import numpy as np
+
+    if kind == "scl":
+        return np.isin(data, SCL_CLOUDY), ~np.isin(data, SCL_INVALID)
+
+    return data >= CLDPRB_THRESHOLD, np.ones(data.shape, dtype=bool)
+
+
+def zone_clouds(href, kind, zones, auth=None):
+    """
+    Compute the cloud percent of zones from a cloud mask opened once, only the window
+    of each zone is read so that remote masks are read with a few range requests
+
+    :param href: Path or URL of the cloud mask asset.
+    :param auth: Requests authentication of the provider, see product_auth.
+    :return: Dict of zone name and cloud percent, None when a zone has no valid pixel.
+    """
+    import rasterio as rio
+
+    href, options = gdal_auth(href, auth)
+    percents = {}
+    # Masks have no sidecar files, listing or probing them would cost requests on remote ones
+    with rio.Env(GDAL_DISABLE_READDIR_ON_OPEN="EMPTY_DIR", **options), rio.open(href) as src:
+        for zone in zones:
+            window, outside = zone_pixels(zone, src.crs.to_string(), src.transform, src.width, src.height)
+            cloudy, valid = cloud_mask(src.read(1, window=window), kind)
+            valid &= ~outside
+            valid_pixels = int(valid.sum())
+            percents[zone] = round(100 * int((cloudy & valid).sum()) / valid_pixels, 2) if valid_pixels else None
+
+    return percents
+
+
+def product_clouds(final_img, zones):
+    """
+    Score clouds of the zones covered by an EO product
+
+    :return: Dict of zone name and cloud percent, None when the product has no readable cloud mask.
+    """
+    kind, href = find_cloud_asset(final_img)
+    if href is None:
+        return None
+
+    try:
+        return zone_clouds(href, kind, zones, product_auth(final_img))
+    except Exception as error:  # pylint: disable=broad-except
+        # The tile cloud cover is used instead, whatever prevented reading the mask
+        logging.warning("Cloud mask of %s not readable: %s", final_img.properties["id"], error)
+        return None
+
+
+def score_clouds(zones_per_product, max_workers=CLOUD_WORKERS):
+    """
+    Score clouds of zones over several EO products in parallel, each mask being opened once
+
+    :param zones_per_product: Dict of product id and tuple (EO product, zone names it covers).
+    :return: Dict of zone name and dict of product id and cloud percent, products without
+        cloud mask are left out so that their tile cloud cover is used.
+    """
+    def score(item):
+        final_img, zones = item
+        return final_img.properties["id"], product_clouds(final_img, zones)
+
+    if zones_per_product and not any(
+        find_cloud_asset(final_img)[1] is not None for final_img, _ in zones_per_product.values()
+    ):
+        logging.warning("No product exposes a cloud mask asset, zones are selected by the cloud cover of tiles")
+        return {}
+
+    clouds_per_zone = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for name, percents in pool.map(score, zones_per_product.values()):
+            for zone, percent in (percents or {}).items():
+                clouds_per_zone.setdefault(zone, {})[name] = percent
+                logging.info("Cloud cover of %s zone in %s: %s", zone, name, percent)
+
+    return clouds_per_zone
@@ -0,0 +1,100 @@
+"""This module appends zone crops to per zone time series cubes stored as compressed Zarr arrays"""
+# pylint: disable=import-error,import-outside-toplevel
+import datetime
+import logging
+import os
+
+CUBES_DIR = "cubes"
+# Chunks hold one date and at most this number of pixels along each spatial axis
+SPATIAL_CHUNK = 512
+# Fixed time units so that any sensing time can be appended
+TIME_ENCODING = {"units": "seconds since 1970-01-01", "dtype": "int64"}
+
+
+def cube_path(outdir, zone, tile):
+    """Return the path of the cube of a zone on a tile, crops of different tiles are not on the same grid"""
+    return os.path.join(str(outdir), CUBES_DIR, f"{zone}_{tile}.zarr")
+
+
+def sensing_time(name):
+    """Return the sensing datetime of an EO product id"""
+    return datetime.datetime.strptime(name.split("_")[2], "%Y%m%dT%H%M%S")
+
+
+def crop_dataset(raster, transform, crs, time):
+    """
+    Build the dataset of one crop, a (time, band, y, x) variable with the coordinates
+    of pixel centres and the georeferencing of the grid as attributes
+    """
+    import numpy as np
+    import xarray as xr
+
+    bands, height, width = raster.shape
+    x_coords = transform.c + transform.a * (np.arange(width) + 0.5)
+    y_coords = transform.f + transform.e * (np.arange(height) + 0.5)
+
+    return xr.Dataset(
+        {"tci": (("time", "band", "y", "x"), raster[np.newaxis])},
+        coords={
+            "time": np.array([time], dtype="datetime64[ns]"),
+            "band": np.arange(1, bands + 1),
+            "y": y_coords,
+            "x": x_coords,
+        },
+        attrs={"crs": str(crs), "transform": list(transform)[:6]},
+    )
+
+
+def append_crop(outdir, name, zone, raster, transform, crs):
+    """
+    Append the crop of a zone from a product to its cube along time, a date already
+    in the cube is not appended again
+
+    :param name: EO product id giving the tile and the sensing time.
+    :param raster: (bands, height, width) array of the zone, see read_zones.
+    :return: Path of the cube.
+    :raise ValueError: When the crop is not on the grid of the cube.
+    """
+    import numpy as np
+    import xarray as xr
+
+    time = sensing_time(name)
+    path = cube_path(outdir, zone, name.split("_")[5])
+    dataset = crop_dataset(raster, transform, crs, time)
+
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        chunks = (1, raster.shape[0], min(SPATIAL_CHUNK, raster.shape[1]), min(SPATIAL_CHUNK, raster.shape[2]))
+        dataset.to_zarr(
+            path, mode="w-", consolidated=False, encoding={"tci": {"chunks": chunks}, "time": TIME_ENCODING}
+        )
+        logging.info("Create the cube of %s zone in %s", zone, path)
+        return path
+
+    with xr.open_zarr(path, chunks=None, consolidated=False) as cube:
+        if np.datetime64(time, "ns") in cube.time.values:
+            logging.info("Crop of %s zone at %s already in its cube", zone, time)
+            return path
+        if not (np.array_equal(cube.x.values, dataset.x.values) and np.array_equal(cube.y.values, dataset.y.values)):
+            raise ValueError(f"Crop of {zone} zone at {time} is not on the grid of its cube")
+
+    dataset.to_zarr(path, append_dim="time", consolidated=False)
+    logging.info("Append crop of %s zone at %s to its cube", zone, time)
+
+    return path
+
+
+def open_cube(outdir, zone, tile, start=None, end=None):
+    """
+    Open the cube of a zone lazily, pixels are only read from the chunks of the selected
+    dates when their values are accessed
+
+    :param start: First date to select, as a string or datetime, None for the whole cube.
+    :param end: Last date to select, as a string or datetime, None for the whole cube.
+    :return: xarray Dataset sorted by time.
+    """
+    import xarray as xr
+
+    cube = xr.open_zarr(cube_path(outdir, zone, tile), chunks=None, consolidated=False)
+
+    return cube.sortby("time").sel(time=slice(start, end))
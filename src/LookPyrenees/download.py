@@ -1,35 +1,79 @@
-"""This module allow to search, crop and download zone of Pyrenees"""
-# pylint: disable=import-error
+"""This module allow to search, crop and download zone of Pyrenees
+
+Heavy dependencies are imported in the functions using them to keep the CLI startup fast.
+"""
+# pylint: disable=import-error,import-outside-toplevel
 import datetime
 import glob
+import io
+import json
 import logging
+import math
+import multiprocessing
 import os
-import shutil
-from pathlib import Path
-
-import folium
-import geopandas as gpd
-import matplotlib.image as mpimg
-import matplotlib.pyplot as plt
-import numpy as np
-import rasterio as rio
-import rioxarray as rxr
-from eodag.api.search_result import SearchResult
-from eodag.crunch import FilterDate, FilterOverlap, FilterProperty
-from PIL import Image
-from shapely.geometry import mapping
-
-from eodag import EODataAccessGateway, setup_logging
-from LookPyrenees.manage_bucket import check_files_on_bucket, load_on_gcs
-
-setup_logging(2)  # 0: nothing, 1: only progress bars, 2: INFO, 3: DEBUG
-logging.basicConfig()
-logging.getLogger().setLevel(logging.INFO)
+import re
+import threading
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import nullcontext
+
+from LookPyrenees.clouds import score_clouds
+from LookPyrenees.cube import append_crop, sensing_time
+from LookPyrenees.federation import (
+    SEARCH_TIMEOUT,
+    federated_search,
+    merge_results,
+    search_timeouts,
+)
+from LookPyrenees.metrics import RunMetrics, path_size, timed_call
+from LookPyrenees.mosaic import (
+    MIN_COVERAGE,
+    Mosaic,
+    datatake_coverage,
+    mosaic_groups,
+    mosaic_members,
+    read_mosaic,
+)
+from LookPyrenees.outputs import RETENTION_DAYS, OutputIndex, product_key
+from LookPyrenees.snow import snow_stats
+from LookPyrenees.staging import (
+    asset_checksum,
+    clean_legacy,
+    clean_staging,
+    product_auth,
+    published_path,
+    remove_published,
+    staged_download,
+    staged_fetch,
+)
+from LookPyrenees.tiles import TileStore, changed_tiles
+from LookPyrenees.zones import prepared_zone, search_geometry, zone_crop, zone_pixels
+
+# full: whole SAFE archive, asset: only the TCI asset, remote: crop the TCI asset in place
+DOWNLOAD_MODES = ["full", "asset", "remote"]
+TCI_ASSET_PATTERN = re.compile(r"(?i)(^visual$|tci)")
+# PIL format, file extension and content type of output images
+IMAGE_FORMATS = {
+    "png": ("PNG", ".png", "image/png"),
+    "webp": ("WEBP", ".webp", "image/webp"),
+    "jpeg": ("JPEG", ".jpg", "image/jpeg"),
+}
+QUICKLOOK_WORKERS = 8
+# Number of days of the window of recent products, older ones are only used when they are all too cloudy
+RECENT_DAYS = 10
 
 
 def create_search_result_map(search_results, extent):
     """Small utility to create an interactive map with folium
     that displays an extent in red and EO Producs in blue"""
+    import folium
+
     fmap = folium.Map([46, 3], zoom_start=6)
     folium.GeoJson(extent, style_function=lambda x: {"color": "red"}).add_to(fmap)
     folium.GeoJson(search_results).add_to(fmap)
@@ -37,65 +81,163 @@ def create_search_result_map(search_results, extent):
     return fmap
 
 
+def geometries_coverage(search_results, geometries):
+    """
+    Compute in one vectorized pass the coverage of every geometry by every EO product
+
+    :param geometries: List of shapely geometries, prepared ones are faster.
+    :return: Tuple of arrays of shape (geometries, products): coverage percent of
+        each geometry and whether it is totally contained in the product.
+    """
+    import numpy as np
+    import shapely
+
+    products = np.array([product.geometry for product in search_results], dtype=object)
+    geometries = np.array(geometries, dtype=object)
+
+    contains = shapely.within(geometries[:, np.newaxis], products[np.newaxis, :])
+    intersects = shapely.intersects(geometries[:, np.newaxis], products[np.newaxis, :])
+
+    # Intersections are only computed for products partially covering a geometry
+    coverage = np.where(contains, 100.0, 0.0)
+    rows, cols = np.nonzero(intersects & ~contains)
+    if len(rows) > 0:
+        intersection_area = shapely.area(shapely.intersection(geometries[rows], products[cols]))
+        coverage[rows, cols] = 100 * intersection_area / shapely.area(geometries[rows])
+
+    return coverage, contains
+
+
+def coverage_matrix(search_results, zones):
+    """
+    Compute the coverage of all zones by all EO products once per run
+
+    :param zones: List of zone names.
+    :return: Dict of zone name and tuple (coverage percent, contained) arrays over products.
+    """
+    coverage, contains = geometries_coverage(search_results, [prepared_zone(zone) for zone in zones])
+
+    return {zone: (coverage[i], contains[i]) for i, zone in enumerate(zones)}
+
+
+def covering_products(search_results, coverage, geometry):
+    """
+    Return the boolean mask of EO products kept for a zone, those containing it or
+    else those whose datatake covers more than 95 percent of it, to be mosaicked
+
+    :param coverage: Tuple (coverage percent, contained) arrays of the zone, see coverage_matrix.
+    :param geometry: Shapely geometry of the zone.
+    """
+    coverage_zone, contains = coverage
+
+    return contains if contains.any() else datatake_coverage(search_results, coverage_zone, geometry) > MIN_COVERAGE
+
+
+def zones_per_product(search_results, coverage):
+    """
+    Group the zones kept by each EO product
+
+    :param coverage: Dict of zone name and its coverage, see coverage_matrix.
+    :return: Dict of product id and tuple (EO product, zone names).
+    """
+    products = {}
+    for zone, zone_coverage in coverage.items():
+        for product, keep in zip(search_results, covering_products(search_results, zone_coverage, prepared_zone(zone))):
+            if keep:
+                products.setdefault(product.properties["id"], (product, []))[1].append(zone)
+
+    return products
+
+
 def check_coverage(search_results, polygon_geometry):
     """ "Check if results searched contains the zone geometry"""
-    contains = []
-    for img in search_results:
-        if img.geometry.contains(polygon_geometry):
-            contains.append(True)
-        else:
-            contains.append(False)
+    _, contains = geometries_coverage(search_results, [polygon_geometry])
 
-    return contains
+    return contains[0].tolist()
 
 
 def write_raster(path, raster, crs, transform, nodata):
     """
-    Write a raster to a tif file
+    Write a raster to a tif file, raster is a (height, width) or (bands, height, width) array
     """
+    import numpy as np
+    import rasterio as rio
+
+    if raster.ndim == 2:
+        raster = raster[np.newaxis]
+
     with rio.open(
             path,
             "w",
             driver="GTiff",
-            height=raster.shape[0],
-            width=raster.shape[1],
-            count=1,
+            height=raster.shape[1],
+            width=raster.shape[2],
+            count=raster.shape[0],
             dtype=raster.dtype,
             crs=crs,
             transform=transform,
             nodata=nodata,
     ) as dst:
-        dst.write(raster, 1)
+        dst.write(raster)
 
 
-def search_data(workspace, dag, pref_provider, plot_res):
-    """
-    Process the search of EOproducts for Ariege zone
-    """
+def search_criteria(provider):
+    """Build the search criteria of products of the last month over the Pyrenees on a provider"""
     end = datetime.date.today()
     last_month = end - datetime.timedelta(days=30)
-    geom_path = glob.glob(f"{os.getcwd()}/ressources/pyrenees.shp")[0]
-    geom = gpd.read_file(geom_path).geometry
+    geom = search_geometry()
 
-    if pref_provider == "peps":
-        default_search_criteria = {
+    if provider == "peps":
+        return {
             "productType": "S2_MSI_L1C",
             "start": last_month,
             "end": end,
             "cloudCover": 100,
-            "geom": geom[0],
-        }
-    else:
-        default_search_criteria = {
-            "productType": "S2_MSI_L2A",
-            "start": str(last_month),
-            "end": str(end),
-            "cloudCover": 100,
-            "geom": geom[0],
+            "geom": geom,
         }
 
-    dag.set_preferred_provider(pref_provider)
-    search_results = dag.search_all(**default_search_criteria)
+    return {
+        "productType": "S2_MSI_L2A",
+        "start": str(last_month),
+        "end": str(end),
+        "cloudCover": 100,
+        "geom": geom,
+    }
+
+
+def search_provider(dag, provider, catalogue=None):
+    """Search products on one provider, named in each query so that several providers can be searched at once"""
+    def search(criteria):
+        return dag.search_all(provider=provider, **criteria)
+
+    if catalogue is None:
+        return search(search_criteria(provider))
+
+    return catalogue.search(dag, provider, search_criteria(provider), search)
+
+
+def search_data(workspace, dag, pref_provider, plot_res, catalogue=None, providers=None, timeout=SEARCH_TIMEOUT):
+    """
+    Process the search of EOproducts for Ariege zone
+
+    :param catalogue: Catalogue caching search results, only new acquisitions are then queried.
+    :param providers: List of providers searched concurrently instead of the preferred
+        provider only, see federated_search. Their results are merged, see merge_results.
+    :param timeout: Number of seconds to wait for providers.
+    """
+    if providers:
+        search_results = merge_results(
+            federated_search(providers, lambda provider: search_provider(dag, provider, catalogue), timeout)
+        )
+    else:
+        default_search_criteria = search_criteria(pref_provider)
+        dag.set_preferred_provider(pref_provider)
+        if catalogue is None:
+            search_results = dag.search_all(**default_search_criteria)
+        else:
+            search_results = catalogue.search(
+                dag, pref_provider, default_search_criteria, lambda criteria: dag.search_all(**criteria)
+            )
 
     if len(search_results) == 0:
         raise ValueError("No products found")
@@ -103,38 +245,110 @@ def search_data(workspace, dag, pref_provider, plot_res):
     logging.info("Number of products found : %s", len(search_results))
 
     if "quicklook" in search_results[0].properties.keys() and plot_res:
-        quicklook_img(workspace, search_results, len(search_results))
+        quicklook_img(workspace, search_results)
 
     return search_results
 
 
-def quicklook_img(workspace, search_results, total_count):
-    """Function to plot overview of products if needed"""
-    quicklooks_dir = os.path.join(workspace, "quicklooks")
-    if not os.path.isdir(quicklooks_dir):
-        os.mkdir(quicklooks_dir)
+def fetch_quicklook(product, quicklooks_dir):
+    """
+    Return the path of the quicklook of a product, only downloaded when it is not yet
+    in the quicklooks directory where it is stored under the product id
+    """
+    quicklook_path = os.path.join(quicklooks_dir, product.properties["id"])
+    if not os.path.isfile(quicklook_path):
+        quicklook_path = product.get_quicklook(filename=product.properties["id"], base_dir=quicklooks_dir)
+
+    return quicklook_path
+
+
+def fetch_quicklooks(search_results, quicklooks_dir, max_workers=QUICKLOOK_WORKERS):
+    """
+    Fetch quicklooks of products concurrently, cached ones are not downloaded again
+
+    :return: List of quicklook paths in the order of search results, None when one is unavailable.
+    """
+    os.makedirs(quicklooks_dir, exist_ok=True)
+
+    def fetch(product):
+        try:
+            return fetch_quicklook(product, quicklooks_dir) or None
+        except Exception as err:  # pylint: disable=broad-except
+            logging.warning("Quicklook of %s unavailable: %s", product.properties["id"], err)
+            return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(fetch, search_results))
+
+
+def contact_sheet(quicklook_paths, columns=3, tile_size=256):
+    """
+    Tile quicklooks into a single (3, height, width) uint8 array, each quicklook is
+    shrunk to fit a square tile and unavailable ones are left black
+    """
+    import numpy as np
+    from PIL import Image
+
+    rows = max(1, math.ceil(len(quicklook_paths) / columns))
+    sheet = np.zeros((rows, columns, tile_size, tile_size, 3), dtype=np.uint8)
+    for i, quicklook_path in enumerate(quicklook_paths):
+        if quicklook_path is None:
+            continue
+        with Image.open(quicklook_path) as img:
+            img = img.convert("RGB")
+            img.thumbnail((tile_size, tile_size))
+            thumbnail = np.asarray(img)
+        sheet[i // columns, i % columns, : thumbnail.shape[0], : thumbnail.shape[1]] = thumbnail
 
-    fig = plt.figure(figsize=(10, 8))
-    for i, product in enumerate(search_results, start=1):
-        # This line takes care of downloading the quicklook
-        quicklook_path = product.get_quicklook(base_dir=quicklooks_dir)
-        img = mpimg.imread(quicklook_path)
-        size_x = int(np.ceil(total_count / 3))
+    return sheet.transpose(4, 0, 2, 1, 3).reshape(3, rows * tile_size, columns * tile_size)
 
-        axe_x = fig.add_subplot(size_x, 3, i)
+
+def quicklook_img(workspace, search_results, name="contact_sheet", max_workers=QUICKLOOK_WORKERS):
+    """
+    Write an overview of products as a contact sheet of their quicklooks, filled row by row
+    in the order of search results
+
+    :param name: File name of the contact sheet, without extension.
+    :return: Path of the contact sheet image.
+    """
+    quicklooks_dir = os.path.join(workspace, "quicklooks")
+    quicklook_paths = fetch_quicklooks(search_results, quicklooks_dir, max_workers=max_workers)
+
+    for i, product in enumerate(search_results):
         date = product.properties["modificationDate"].split("T")[0]
-        axe_x.set_title(f'{date} and CC : {round(product.properties["cloudCover"])}')
-        plt.imshow(img)
-    plt.tight_layout()
-    plt.show()
+        logging.info("Quicklook %s : %s and CC : %s", i + 1, date, round(product.properties["cloudCover"]))
+
+    sheet_path = os.path.join(quicklooks_dir, f"{name}.png")
+    with open(sheet_path, "wb") as sheet:
+        sheet.write(encode_image(contact_sheet(quicklook_paths)))
+    logging.info("Contact sheet of %s quicklooks written to %s", len(search_results), sheet_path)
+
+    return sheet_path
+
 
+def zone_cloudcover(eoprod, zone_clouds=None):
+    """Return the cloud cover of the zone in an EO product when it was scored, else of the whole tile"""
+    percent = (zone_clouds or {}).get(eoprod.properties["id"])
 
-def filter_cloudcover(filtered_img, lim_cloudcover: float = 20.0):
+    return eoprod.properties["cloudCover"] if percent is None else percent
+
+
+def filter_cloudcover(filtered_img, lim_cloudcover: float = 20.0, zone_clouds=None):
     """
     Return the minimum cloudcover on EOproducts list
+
+    :param zone_clouds: Dict of product id and cloud percent of the zone, see score_clouds.
     """
+    from eodag.api.search_result import SearchResult
+    from eodag.crunch import FilterProperty
+
     too_cloudy = False
-    finals_img = filtered_img.crunch(FilterProperty({"cloudCover": lim_cloudcover, "operator": "lt"}))
+    if zone_clouds is None:
+        finals_img = filtered_img.crunch(FilterProperty({"cloudCover": lim_cloudcover, "operator": "lt"}))
+    else:
+        finals_img = SearchResult(
+            products=[eoprod for eoprod in filtered_img if zone_cloudcover(eoprod, zone_clouds) < lim_cloudcover]
+        )
 
     if len(finals_img) == 0:
         too_cloudy = True
@@ -142,31 +356,45 @@ def filter_cloudcover(filtered_img, lim_cloudcover: float = 20.0):
     return finals_img, too_cloudy
 
 
-def filter_img(search_results, new_crop):
+def recent_products(search_results):
+    """Return the EO products sensed in the last RECENT_DAYS days, preferred to older ones"""
+    from eodag.crunch import FilterDate
+
+    today = datetime.datetime.today()
+    middle = today - datetime.timedelta(days=RECENT_DAYS)
+
+    return search_results.crunch(FilterDate({"start": str(middle), "end": str(today)}))
+
+
+def filter_img(search_results, new_crop, coverage=None, zone_clouds=None):
     """
     Filter images based on overlapped parameters, date and cloudcover
-    """
-    search_geometry = new_crop["geometry"][0]
-    contains = check_coverage(search_results, search_geometry)
 
-    if any(contains):
+    :param coverage: Tuple (coverage percent, contained) arrays of the zone over
+        search results, see coverage_matrix. Computed from new_crop if not given.
+    :param zone_clouds: Dict of product id and cloud percent of the zone, used instead
+        of the cloud cover of the tile for scored products.
+    """
+    from eodag.api.search_result import SearchResult
+
+    if coverage is None:
+        coverage_zone, contains = geometries_coverage(search_results, [new_crop["geometry"][0]])
+        coverage = (coverage_zone[0], contains[0])
+    coverage_zone, contains = coverage
+
+    filter_results = SearchResult(
+        products=[
+            product
+            for product, keep in zip(
+                search_results, covering_products(search_results, coverage, new_crop["geometry"][0])
+            )
+            if keep
+        ]
+    )
+    if contains.any():
         logging.info("The search geometry is contained in one product")
-        filter_results = search_results.crunch(
-            FilterOverlap({"contains": True}), geometry=search_geometry
-        )
     else:
-        logging.warning("The search geometry is not totally contained in one product")
-        area_zone = search_geometry.area
-        product_to_keep = []
-        for product in search_results:
-            coverage_zone = (
-                100 * product.geometry.intersection(search_geometry).area / area_zone
-            )
-
-            if coverage_zone > 95:
-                product_to_keep.append(product)
-
-        filter_results = SearchResult(products=product_to_keep)
+        logging.warning("The search geometry is not totally contained in one product, adjacent tiles are mosaicked")
 
         logging.info(
             "Filter results overlapped are : %s with size of %s",
@@ -179,36 +407,116 @@ def filter_img(search_results, new_crop):
             len(filter_results),
         )
 
-    today = datetime.datetime.today()
-    middle = today - datetime.timedelta(days=10)
-
-    filter_results_date = filter_results.crunch(
-        FilterDate({"start": str(middle), "end": str(today)})
-    )
+    filter_results_date = recent_products(filter_results)
 
     # Display cloudcover of images of the last month
     for eoprod in filter_results:
         logging.info(
             "Filter product id %s with cloudcover of %s",
             eoprod.properties["id"],
-            eoprod.properties["cloudCover"],
+            zone_cloudcover(eoprod, zone_clouds),
         )
 
-    finals_img, too_cloudy = filter_cloudcover(filter_results_date)
+    finals_img, too_cloudy = filter_cloudcover(filter_results_date, zone_clouds=zone_clouds)
 
     if too_cloudy:
-        finals_img, _ = filter_cloudcover(filter_results)
+        finals_img, _ = filter_cloudcover(filter_results, zone_clouds=zone_clouds)
 
     return finals_img
 
 
-def download_img(final_img, dag, outdir):
-    """This function download an image if it not already on the bucket"""
+def find_tci_asset(final_img):
+    """
+    Return the key and href of the TCI asset of an EO product, preferring the 10m one,
+    or (None, None) when the provider does not expose assets
+    """
+    assets = getattr(final_img, "assets", None) or {}
+    keys = [key for key in assets.keys() if TCI_ASSET_PATTERN.search(key)]
+    keys = sorted(keys, key=lambda key: ("20m" in key or "60m" in key, key))
+
+    if not keys:
+        return None, None
+
+    return keys[0], assets[keys[0]].get("href")
+
 
-    out_path = dag.download(product=final_img, outputs_prefix=outdir)
+def is_remote(out_path):
+    """Check if a path is an URL read through HTTP range requests"""
+    return str(out_path).startswith(("http://", "https://", "/vsi"))
+
+
+def tci_name(name):
+    """Build the TCI image name of a product id as it is named inside the SAFE"""
+    date = name.split("_")[2]
+    tile = name.split("_")[5]
+
+    return f"{tile}_{date}_TCI_10m"
+
+
+def remote_readable(href):
+    """
+    Check that GDAL opens a remote TCI asset without credentials, as crop processes do,
+    so that assets of providers requiring authentication are downloaded instead
+    """
+    import rasterio as rio
+    from rasterio.errors import RasterioIOError
+
+    try:
+        with rio.open(href):
+            return True
+    except RasterioIOError as error:
+        logging.warning("TCI asset %s not readable in place, download it: %s", href, error)
+        return False
+
+
+def download_img(final_img, dag, outdir, mode="full", metrics=None):
+    """This function download an image if it not already on the bucket
+
+    Downloads are staged in outdir and only published once complete, a product published
+    by a previous run is reused and an interrupted TCI asset download is resumed.
+
+    :param mode: One of DOWNLOAD_MODES. ``asset`` only downloads the TCI asset and
+        ``remote`` returns its href to be cropped in place, or downloads it when it cannot
+        be opened without credentials, both fall back on the full product when the
+        provider does not expose a TCI asset.
+    :param metrics: RunMetrics counting products and bytes downloaded, products reused
+        or read in place are not counted as downloaded.
+    """
+    if mode not in DOWNLOAD_MODES:
+        raise ValueError(f"This download mode {mode} does not exist")
+    metrics = RunMetrics() if metrics is None else metrics
+
+    name = final_img.properties["id"]
+    asset_key, asset_href = find_tci_asset(final_img)
+    if mode == "remote" and asset_href is not None and is_remote(asset_href) and remote_readable(asset_href):
+        logging.info("Read TCI asset in place from %s", asset_href)
+        metrics.add("products_read_in_place")
+        out_path = asset_href
+    elif published_path(outdir, name) is not None:
+        logging.info("Product %s already downloaded", name)
+        metrics.add("products_reused")
+        out_path = published_path(outdir, name)
+    elif mode in ("asset", "remote") and asset_key is not None:
+        logging.info("Download only asset %s", asset_key)
+        if str(asset_href).startswith(("http://", "https://")):
+            asset = final_img.assets[asset_key]
+            out_path = staged_fetch(
+                asset_href, outdir, name, f"{tci_name(name)}.jp2", auth=product_auth(final_img),
+                size=asset.get("file:size"), checksum=asset_checksum(asset)
+            )
+        else:
+            out_path = staged_download(dag, final_img, outdir, asset=f"^{re.escape(asset_key)}$")
+        metrics.add("products_downloaded")
+        metrics.add("bytes_downloaded", path_size(out_path))
+    else:
+        if mode != "full":
+            logging.warning("No TCI asset exposed, download the full product")
+        out_path = staged_download(dag, final_img, outdir)
+        metrics.add("products_downloaded")
+        metrics.add("bytes_downloaded", path_size(out_path))
 
     if "quicklook" in final_img.properties.keys():
-        quicklook_img(outdir, [final_img], 1)
+        quicklook_img(outdir, [final_img], name=final_img.properties["id"])
 
     final_date = final_img.properties["modificationDate"]
     final_cc = round(final_img.properties["cloudCover"], ndigits=2)
@@ -218,71 +526,181 @@ def download_img(final_img, dag, outdir):
     return out_path
 
 
-def cropzone(zone, new_crop, out_path):
+def find_tci_img(out_path):
     """
-    Crop the selected zone on image and create a tif file
+    Return the path of the TCI image inside a downloaded product
     """
+    if is_remote(out_path):
+        return out_path
+
     img_type = out_path.split("/")[-1].split("_")[1]
     if "L2A" in img_type:
         img_path = glob.glob(
             f"{out_path}/GRANULE/*/IMG_DATA/R10m/*_TCI_10m.jp2", recursive=True
-        )[0]
+        )
     else:
         img_path = glob.glob(
             f"{out_path}/GRANULE/*/IMG_DATA/*_TCI*jp2", recursive=True
-        )[0]
+        )
+
+    if not img_path:
+        # Only the TCI asset has been downloaded, without the SAFE layout
+        img_path = sorted(glob.glob(f"{out_path}/**/*TCI*.jp2", recursive=True))
+
+    return img_path[0]
+
+
+def read_zone(src, zone, nodata=0):
+    """
+    Read only the pixels of an opened raster overlapping a zone and mask outside the polygon
+
+    :param src: Opened rasterio dataset.
+    :param zone: Zone name, its window and mask are cached per tile grid.
+    :return: Tuple of the array in native dtype and its transform.
+    """
+    window, outside = zone_pixels(zone, src.crs.to_string(), src.transform, src.width, src.height)
+    raster = src.read(window=window)
+    raster[:, outside] = nodata
+
+    return raster, src.window_transform(window)
+
+
+def read_zones(zones, out_path):
+    """
+    Read the pixels of every zone from the TCI image of a product opened once
+
+    :param zones: List of zone names.
+    :param out_path: Path of the downloaded product or URL of its TCI asset, or list of
+        them for products of adjacent tiles to mosaic, see read_mosaic.
+    :return: Tuple of the image crs and dict of zone name and tuple (array, transform).
+    """
+    import rasterio as rio
+
+    if isinstance(out_path, list):
+        return read_mosaic(zones, [find_tci_img(path) for path in out_path])
+
+    img_path = find_tci_img(out_path)
+
+    rasters = {}
+    with rio.open(img_path) as src:
+        logging.info("raster crs: %s", src.crs)
+        for zone in zones:
+            rasters[zone] = read_zone(src, zone)
+        crs = src.crs
+
+    return crs, rasters
+
+
+def cropzones(zones, out_path, output_img=None, tif_file=None):
+    """
+    Crop every selected zone on image opened once and create one tif file per zone.
+    Only the window of the image covering each zone is decoded.
+
+    :param zones: List of zone names.
+    :param out_path: Path of the downloaded product or URL of its TCI asset.
+    :param output_img: Directory of tif files, by default the parent directory of the product.
+    :param tif_file: Name of tif files before the zone suffix, by default the TCI image name.
+    :return: Dict of zone name and path of its tif file.
+    """
+    if tif_file is None:
+        tif_file = find_tci_img(out_path).split("/")[-1].split(".")[0]
+    if output_img is None:
+        output_img = "/".join(out_path.split("/")[:-2])
+
+    crs, rasters = read_zones(zones, out_path)
+
+    paths_to_tif_file = {}
+    for zone, (raster_clipped, transform) in rasters.items():
+        path_to_tif_file = os.path.join(output_img, tif_file + f"_{zone}.tif")
+        # Write the data to a new geotiff file
+        write_raster(path_to_tif_file, raster_clipped, crs, transform, nodata=0)
+        paths_to_tif_file[zone] = path_to_tif_file
+
+    return paths_to_tif_file
+
+
+def encode_image(raster, img_format="png", quality=None):
+    """
+    Encode a (bands, height, width) uint8 array to image bytes without writing a tif file
+
+    :param img_format: One of IMAGE_FORMATS.
+    :param quality: Compression level from 0 to 9 for png, quality from 1 to 100 for webp and jpeg.
+    """
+    import numpy as np
+    from PIL import Image
+
+    if raster.shape[0] == 1:
+        img = Image.fromarray(raster[0])
+    else:
+        img = Image.fromarray(np.ascontiguousarray(np.moveaxis(raster, 0, -1)))
+
+    if img_format == "png":
+        options = {"compress_level": 6 if quality is None else quality}
+    else:
+        options = {"quality": 90 if quality is None else quality}
+
+    buffer = io.BytesIO()
+    img.save(buffer, format=IMAGE_FORMATS[img_format][0], **options)
+
+    return buffer.getvalue()
+
+
+def georeference(crs, transform, width, height, snow=None):
+    """
+    Build the JSON sidecar which keeps the georeferencing of an encoded image
+
+    :param snow: Snow statistics of the zone added to the sidecar, see snow_stats.
+    """
+    import rasterio as rio
 
-    raster = rxr.open_rasterio(img_path, masked=True).squeeze()
-    logging.info("crop extent crs: %s", new_crop.crs)
-    logging.info("raster crs: %s", raster.rio.crs)
+    sidecar = {
+        "crs": crs.to_string(),
+        "transform": list(transform)[:6],
+        "bounds": list(rio.transform.array_bounds(height, width, transform)),
+        "width": width,
+        "height": height,
+    }
+    if snow is not None:
+        sidecar["snow"] = snow
 
-    raster_clipped = raster.rio.clip(new_crop.geometry.apply(mapping), new_crop.crs)
+    return json.dumps(sidecar).encode()
 
-    tif_file = img_path.split("/")[-1].split(".")[0]
-    output_img = "/".join(out_path.split("/")[:-2])
-    path_to_tif_file = os.path.join(output_img, tif_file + f"_{zone}.tif")
-    # Write the data to a new geotiff file
-    raster_clipped.rio.to_raster(path_to_tif_file)
 
-    return path_to_tif_file
+def cropzone(zone, out_path):
+    """
+    Crop the selected zone on image and create a tif file
+    """
+    return cropzones([zone], out_path)[zone]
 
 
-def check_old_files(outdir):
+def check_old_files(outdir, index=None):
     """
     Check the date of images downloaded and delete too old files
+
+    :param index: OutputIndex of outdir, opened if not given.
     """
+    index = OutputIndex(outdir) if index is None else index
 
-    min_date = datetime.date.today() - datetime.timedelta(days=31)
-    files_list = os.listdir(outdir)
-    if len(files_list) != 0:
-        for obj in files_list:
-            path_obj = Path(outdir, obj)
+    min_date = datetime.date.today() - datetime.timedelta(days=RETENTION_DAYS)
+    old_files = index.older_than(min_date)
+    if old_files:
+        logging.info("Remove %s images sensed before %s", len(old_files), min_date)
+        index.remove(old_files)
 
-            if os.path.isfile(str(path_obj)) and obj.endswith(".tif"):
-                date_file = obj.split("_")[1].split("T")[0]
-                if datetime.datetime.strptime(date_file, "%Y%m%d").date() < min_date:
-                    logging.info("Remove old image files of date %s", date_file)
-                    os.remove(path_obj)
-            elif os.path.isdir(str(path_obj)) and obj.startswith("S2"):
-                logging.info("Remove full product folder %s", obj)
-                shutil.rmtree(path_obj)
+    remove_published(outdir)
+    clean_legacy(outdir, min_date)
+    clean_staging(outdir, min_date)
 
 
-def check_files_in_local(outdir, name, zone):
+def check_files_in_local(outdir, name, zone, index=None):
     """As it is done in check_files_in_bucket we check if image already exist in local
-    before downloading it"""
+    before downloading it
 
-    date = name.split("_")[2].split("T")[0]
-    tile = name.split("_")[5]
-
-    matches = [date, tile, zone]
-    filenames_path = glob.glob(os.path.join(outdir, f"*{zone}.tif"))
-    filenames = [os.path.basename(file) for file in filenames_path]
-    for file in filenames:
-        if all(elem in file for elem in matches):
-            return True
+    :param index: OutputIndex shared by all zones of a run, opened if not given.
+    """
+    index = OutputIndex(outdir) if index is None else index
 
-    return False
+    return index.exists(*product_key(name, zone))
 
 
 def convert_tiff_to_png(input_tiff_path, output_png_path):
@@ -292,6 +710,8 @@ def convert_tiff_to_png(input_tiff_path, output_png_path):
     :param input_tiff_path: Path to the input TIFF file.
     :param output_png_path: Path to save the output PNG file.
     """
+    from PIL import Image
+
     tif_name = input_tiff_path.split("/")[-1]
     try:
         # Open the input TIFF file
@@ -304,53 +724,484 @@ def convert_tiff_to_png(input_tiff_path, output_png_path):
         logging.error("Error converting %s to PNG: %s", tif_name, e)
 
 
-def process(zone, outdir, pref_provider, plot_res, bucket):
+def select_products(zone, outdir, search_results, bucket, bucket_index=None, coverage=None, output_index=None,
+                    zone_clouds=None):
     """
-    Process search, filter and crop final EO product
+    Filter final EO products of one zone which are not already processed
+
+    :param bucket_index: BucketIndex shared by all zones of a run.
+    :param output_index: OutputIndex of outdir shared by all zones of a run.
+    :param coverage: Coverage of the zone over search results, see coverage_matrix.
+    :param zone_clouds: Cloud percent of the zone per product id, see score_clouds.
+    :return: List of EO products to download, or of Mosaic when no product contains the zone.
     """
-    out_paths = []
-    dag = EODataAccessGateway()
-    search_results = search_data(outdir, dag, pref_provider, plot_res)
-    aoi_path = glob.glob(f"{os.getcwd()}/ressources/zone_4326.shp")
+    if coverage is None:
+        coverage_zone, contains = geometries_coverage(search_results, [prepared_zone(zone)])
+        coverage = (coverage_zone[0], contains[0])
+    image_names = filter_img(search_results, zone_crop(zone), coverage=coverage, zone_clouds=zone_clouds)
+    if not coverage[1].any():
+        coverage_by_id = {product.properties["id"]: percent for product, percent in zip(search_results, coverage[0])}
+        image_names = mosaic_groups(image_names, coverage_by_id, zone_crop(zone)["geometry"][0])
 
-    logging.info("AOI PATH : %s", aoi_path)
-    crop_extent = gpd.read_file(aoi_path[0])
+    return [
+        eoprod for eoprod in image_names
+        if not is_processed(zone, eoprod.properties["id"], outdir, bucket, bucket_index, output_index)
+    ]
 
-    list_zone = crop_extent.NAME.to_list()
-    if zone not in list_zone:
-        raise ValueError(f"This zone {zone} does not exist")
 
-    new_crop = gpd.read_file(aoi_path[0], mask=crop_extent[crop_extent.NAME == zone])
+def is_processed(zone, name, outdir, bucket, bucket_index=None, output_index=None):
+    """Check if the image of an EO product id for a zone is on the bucket, or in outdir without bucket"""
+    from LookPyrenees.manage_bucket import check_files_on_bucket
 
-    image_names = filter_img(search_results, new_crop)
+    if bucket is not None:
+        logging.info("Check files on bucket %s", bucket)
+        return check_files_on_bucket(bucket, name, zone, index=bucket_index)
 
-    for eoprod in image_names:
-        name = eoprod.properties["id"]
-        if bucket is not None:
-            logging.info("Check files on bucket %s", bucket)
-            if not check_files_on_bucket(bucket, name, zone):
-                out_paths.append(download_img(eoprod, dag, outdir))
-        else:
-            logging.info("Check files in local directory %s for image %s", outdir, name)
-            if not check_files_in_local(outdir, name, zone):
-                out_paths.append(download_img(eoprod, dag, outdir))
-
-    # If the list is wide we can stop now
-    if out_paths:
-        file_path = [cropzone(zone, new_crop, out_path) for out_path in out_paths]
-
-        for file in file_path:
-            name = file.split("/")[-1]
-            file_png = Path(file).with_suffix("." + "png")
-            convert_tiff_to_png(file, str(file_png))
-            os.remove(file)
-            logging.info("Deleted %s sucessfully.", name)
-
-            if bucket is not None:
-                png_name = str(file_png).split("/")[-1]
-                load_on_gcs(bucket, str(file_png), png_name)
-    else:
-        file_path = None
+    logging.info("Check files in local directory %s for image %s", outdir, name)
+    return check_files_in_local(outdir, name, zone, index=output_index)
+
+
+def cloud_candidates(search_results, coverage, outdir, bucket, bucket_index=None, output_index=None):
+    """
+    Group the zones of each EO product whose clouds are worth scoring: products of the recent
+    window not processed yet for the zone, so that a run with nothing new reads no cloud mask.
+    Older products only selected when recent ones are too cloudy keep their tile cloud cover.
+
+    :param coverage: Dict of zone name and its coverage, see coverage_matrix.
+    :return: Dict of product id and tuple (EO product, zone names), see zones_per_product.
+    """
+    recent = {product.properties["id"] for product in recent_products(search_results)}
+
+    candidates = {}
+    for name, (product, zones) in zones_per_product(search_results, coverage).items():
+        zones = [
+            zone for zone in zones
+            if name in recent and not is_processed(zone, name, outdir, bucket, bucket_index, output_index)
+        ]
+        if zones:
+            candidates[name] = (product, zones)
+
+    return candidates
+
+
+def group_products(selected_per_zone):
+    """
+    Group EO products selected by several zones so that each one is downloaded once
+
+    :param selected_per_zone: Dict of zone name and list of EO products or Mosaic.
+    :return: Dict of product id and tuple (EO product or Mosaic, list of zone names).
+    """
+    products = {}
+    for zone, selected in selected_per_zone.items():
+        for eoprod in selected:
+            name = eoprod.properties["id"]
+            if name not in products:
+                products[name] = (eoprod, [])
+            products[name][1].append(zone)
+
+    return products
+
+
+class RateLimiter:
+    """Space out calls shared by several threads to respect provider rate limits"""
+
+    def __init__(self, min_interval=0.0):
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.last_call = None
+
+    def wait(self):
+        """Block until min_interval seconds have passed since the previous call"""
+        with self.lock:
+            now = time.monotonic()
+            if self.last_call is not None:
+                delay = self.last_call + self.min_interval - now
+                if delay > 0:
+                    time.sleep(delay)
+                    now = time.monotonic()
+            self.last_call = now
+
+
+def throttled_download(rate_limiter, final_img, dag, outdir, mode, metrics=None):
+    """Download an image once the rate limiter allows it"""
+    rate_limiter.wait()
+
+    return download_img(final_img, dag, outdir, mode=mode, metrics=metrics)
+
+
+def crop_product(zones, out_path, name, img_format="png", quality=None, keep_rasters=False, snow=False,
+                 dem_path=None):
+    """
+    Crop all zones of a downloaded product and encode them in memory,
+    run in a worker process
+
+    :param out_path: Path of the downloaded product, or list of paths of a mosaic.
+    :param name: EO product id, images are named after its TCI image.
+    :param keep_rasters: Also return the cropped arrays, e.g. to append them to time series cubes.
+    :param snow: Also compute snow of zones and add it to their sidecar, see snow_stats.
+    :param dem_path: DEM raster to estimate the snow line of zones.
+    :return: Tuple of a dict of zone name and dict of output file name and its content,
+        the image and its JSON georeferencing sidecar, and the crs and arrays of zones
+        (see read_zones) if keep_rasters else None.
+    """
+    crs, rasters = read_zones(zones, out_path)
+    extension = IMAGE_FORMATS[img_format][1]
+    # Snow of a mosaic is only computed over its first product
+    snow_path = out_path[0] if isinstance(out_path, list) else out_path
+    snow_per_zone = (snow_stats(zones, snow_path, name, dem_path) if snow else None) or {}
+
+    outputs = {}
+    for zone, (raster_clipped, transform) in rasters.items():
+        file_name = f"{tci_name(name)}_{zone}"
+        outputs[zone] = {
+            file_name + extension: encode_image(raster_clipped, img_format, quality),
+            file_name + ".json": georeference(
+                crs, transform, raster_clipped.shape[2], raster_clipped.shape[1], snow_per_zone.get(zone)
+            ),
+        }
+
+    return outputs, (crs, rasters) if keep_rasters else None
+
+
+def save_outputs(outdir, outputs, index=None):
+    """
+    Write output files of a zone in the output directory
+
+    :param index: OutputIndex of outdir where written images are added.
+    """
+    for file_name, content in outputs.items():
+        with open(os.path.join(outdir, file_name), "wb") as file:
+            file.write(content)
+        logging.info("Wrote %s sucessfully.", file_name)
+
+    if index is not None:
+        for file_name, content in outputs.items():
+            index.add(file_name, len(content))
+
+
+def content_type(file_name):
+    """Return the content type of an output file"""
+    for _, extension, img_content_type in IMAGE_FORMATS.values():
+        if file_name.endswith(extension):
+            return img_content_type
+
+    return "application/json"
+
+
+def unique_downloads(products):
+    """Return the EO products to download for products and mosaics to crop, each one once"""
+    downloads = {}
+    for item, _ in products.values():
+        for eoprod in mosaic_members(item):
+            downloads.setdefault(eoprod.properties["id"], eoprod)
+
+    return list(downloads.values())
+
+
+def ready_crops(waiting, out_paths):
+    """
+    Pop the crops which no longer wait for any download
+
+    :param waiting: Dict of product id and tuple (EO product or Mosaic, zone names),
+        updated in place.
+    :param out_paths: Dict of product id and path of the downloaded products.
+    :return: List of tuples (product id, EO product or Mosaic, zone names, path or list
+        of paths of a mosaic) ready to crop.
+    """
+    ready = []
+    for crop_name, (item, zones) in list(waiting.items()):
+        members = [eoprod.properties["id"] for eoprod in mosaic_members(item)]
+        if all(member in out_paths for member in members):
+            del waiting[crop_name]
+            crop_path = [out_paths[member] for member in members]
+            ready.append((crop_name, item, zones, crop_path if isinstance(item, Mosaic) else crop_path[0]))
+
+    return ready
+
+
+def latest_crops(products):
+    """
+    Return the product or mosaic with the newest sensing time of each zone, the only one
+    rendered into tiles so that tiles of a zone are written by a single task per run
+
+    :param products: Dict of product id and tuple (EO product or Mosaic, zone names), see group_products.
+    :return: Dict of zone name and product id.
+    """
+    latest = {}
+    for name, (_, zones) in products.items():
+        for zone in zones:
+            if zone not in latest or sensing_time(name) > sensing_time(latest[zone]):
+                latest[zone] = name
+
+    return latest
+
+
+def latest_rasters(latest, name, rasters):
+    """
+    Return the crops of a product for the zones whose newest crop of the run it is
+
+    :param latest: Dict of zone name and product id, see latest_crops.
+    :param rasters: Tuple of the crs and crops of the product, see read_zones, or None.
+    :return: List of tuples (zone name, array, transform).
+    """
+    if rasters is None:
+        return []
+
+    return [(zone, raster, transform) for zone, (raster, transform) in rasters[1].items() if latest.get(zone) == name]
+
+
+def save_crops(outdir, outputs_per_zone, files_per_zone, keep_local=True, output_index=None, metrics=None):
+    """
+    Save output files of cropped zones in outdir and list their images per zone
+
+    :param files_per_zone: Dict of zone name and list of image paths, updated in place.
+    :return: List of tuples (file name, content) of all output files.
+    """
+    metrics = RunMetrics() if metrics is None else metrics
+    files = []
+    for zone, outputs in outputs_per_zone.items():
+        metrics.add("zones_cropped")
+        img_file = next(iter(outputs))
+        if keep_local:
+            metrics.timed("save", save_outputs, outdir, outputs, output_index)
+            img_file = os.path.join(str(outdir), img_file)
+        files_per_zone.setdefault(zone, []).append(img_file)
+        files.extend(outputs.items())
+
+    return files
+
+
+def append_crops(outdir, name, rasters, metrics):
+    """Append zone crops of a product to their time series cubes, see append_crop"""
+    crs, arrays = rasters
+    for zone, (raster, transform) in arrays.items():
+        metrics.timed("cube", append_crop, outdir, name, zone, raster, transform, crs)
+
+
+def cpu_executor(max_workers=None):
+    """
+    Create the process pool of crops. Workers are started by a fork server, or spawned
+    where it is not available, as forking the threads of downloads and of the service
+    could copy locks held by them into workers.
+    """
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context(method))
+
+
+def task_result(future, stage, item, metrics):
+    """
+    Return the result of a pipeline task, a failure being logged and counted so that
+    other products of the run go on. A broken process pool is raised as no crop can run.
+
+    :return: Tuple (True, result), or (False, None) if the task failed.
+    """
+    try:
+        return True, future.result()
+    except BrokenProcessPool:
+        raise
+    except Exception:  # pylint: disable=broad-except
+        logging.exception("%s of %s failed", stage.capitalize(), item.properties["id"])
+        metrics.add(f"{stage}_failures")
+        return False, None
+
+
+def log_failed_crops(waiting):
+    """Log crops left waiting for products whose download failed"""
+    for name, (_, zones) in waiting.items():
+        logging.warning("%s not cropped for %s zones, a download failed", name, ", ".join(zones))
+
+
+def run_pipeline(products, dag, outdir, bucket_session=None, download_mode="full", download_workers=2,
+                 cpu_workers=None, download_interval=0.0, img_format="png", quality=None, keep_local=True,
+                 metrics=None, output_index=None, time_series=False, snow=False, dem_path=None, tiles=None,
+                 cpu_pool=None):
+    """
+    Download, crop and upload products in a staged pipeline. Downloads and uploads run
+    in a bounded thread pool and crops in a process pool, each product is cropped as
+    soon as it is downloaded and each image uploaded as soon as it is encoded. A failed
+    task is logged and counted in metrics, the other products of the run go on.
+
+    :param products: Dict of product id and tuple (EO product, zone names), see group_products.
+        Products of a mosaic are downloaded once even if also selected alone, and the
+        mosaic is cropped once all of them are downloaded.
+    :param bucket_session: BucketSession used by all uploads, None to keep images in local.
+    :param download_workers: Number of concurrent downloads and uploads.
+    :param cpu_workers: Number of crop processes, by default the number of cores.
+    :param download_interval: Minimum number of seconds between two download starts.
+    :param img_format: One of IMAGE_FORMATS.
+    :param quality: Compression level or quality of images, see encode_image.
+    :param keep_local: Write images in outdir, else only stream them to the bucket.
+    :param metrics: RunMetrics recording time of each stage and downloaded and uploaded bytes.
+    :param output_index: OutputIndex of outdir updated with written images, opened if not given.
+    :param time_series: Also append zone crops to their time series cube, see append_crop.
+    :param snow: Also compute snow of zones from full products, see snow_stats.
+    :param dem_path: DEM raster to estimate the snow line of zones.
+    :param tiles: One of TILE_FORMATS to also render the newest crop of each zone into its
+        tile pyramid in outdir, see TileStore, None to only write images.
+    :param cpu_pool: Process pool kept between runs, e.g. by the service, so that crop
+        processes do not import the geo stack again. A pool of cpu_workers is created if None.
+    :return: Dict of zone name and list of its image paths (image names if not kept in local).
+    """
+    metrics = RunMetrics() if metrics is None else metrics
+    if keep_local and output_index is None:
+        output_index = OutputIndex(outdir)
+    rate_limiter = RateLimiter(download_interval)
+    tile_store = None if tiles is None else TileStore(outdir, tiles)
+    latest = {} if tiles is None else latest_crops(products)
+    files_per_zone = {}
+
+    with ThreadPoolExecutor(max_workers=download_workers) as io_pool, \
+            nullcontext(cpu_pool) if cpu_pool is not None else cpu_executor(cpu_workers) as cpu_pool:
+        tasks = {}
+        for eoprod in unique_downloads(products):
+            future = io_pool.submit(
+                metrics.timed, "download", throttled_download, rate_limiter, eoprod, dag, outdir, download_mode,
+                metrics
+            )
+            tasks[future] = ("download", eoprod, None)
+        # Crops waiting for the download of their products
+        waiting = dict(products)
+
+        out_paths = {}
+        pending = set(tasks)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, eoprod, payload = tasks.pop(future)
+                succeeded, result = task_result(future, stage, eoprod, metrics)
+                if not succeeded:
+                    continue
+                if stage == "download":
+                    out_path = result
+                    out_paths[eoprod.properties["id"]] = out_path
+                    for name, item, zones, crop_path in ready_crops(waiting, out_paths):
+                        crop_future = cpu_pool.submit(
+                            timed_call, crop_product, zones, crop_path, name, img_format, quality,
+                            time_series or tile_store is not None, snow, dem_path
+                        )
+                        tasks[crop_future] = ("crop", item, None)
+                        pending.add(crop_future)
+                elif stage == "crop":
+                    name = eoprod.properties["id"]
+                    seconds, (outputs_per_zone, rasters) = result
+                    metrics.record("crop", seconds)
+                    if time_series:
+                        append_crops(outdir, name, rasters, metrics)
+                    files = save_crops(outdir, outputs_per_zone, files_per_zone, keep_local, output_index, metrics)
+                    if bucket_session is not None:
+                        for file_name, content in files:
+                            upload_future = io_pool.submit(
+                                metrics.timed, "upload", bucket_session.upload, content, file_name,
+                                content_type(file_name)
+                            )
+                            tasks[upload_future] = ("upload", eoprod, len(content))
+                            pending.add(upload_future)
+                    for zone, raster, transform in latest_rasters(latest, name, rasters):
+                        tiles_future = cpu_pool.submit(
+                            timed_call, changed_tiles, raster, transform, rasters[0], tile_store.digests(zone)
+                        )
+                        tasks[tiles_future] = ("tiles", eoprod, zone)
+                        pending.add(tiles_future)
+                elif stage == "tiles":
+                    seconds, changed = result
+                    metrics.record("tiles", seconds)
+                    written = metrics.timed(
+                        "save", tile_store.write, payload, sensing_time(eoprod.properties["id"]).isoformat(), changed
+                    )
+                    metrics.add("tiles_written", written)
+                elif result:
+                    metrics.add("files_uploaded")
+                    metrics.add("bytes_uploaded", payload)
+
+    log_failed_crops(waiting)
+
+    return files_per_zone
+
+
+def process_zones(zones, outdir, pref_provider, plot_res, bucket, download_mode="full",
+                  bucket_manifest=False, catalogue=None, metrics=None, dag=None, cloud_scoring=True,
+                  providers=None, search_timeout=SEARCH_TIMEOUT, **pipeline_kwargs):
+    """
+    Process one search shared by all zones, download each selected product once
+    and crop all zones covered by it in a single raster pass
+
+    :param zones: List of zone names to process.
+    :param download_mode: One of DOWNLOAD_MODES, see download_img.
+    :param bucket_manifest: Read and update the manifest of the bucket instead of listing it.
+    :param catalogue: Catalogue caching search results, see search_data.
+    :param metrics: RunMetrics filled with the time of each stage and the amount of processed data.
+    :param dag: Gateway searching and downloading EO products, an EODataAccessGateway by default.
+    :param cloud_scoring: Select products by the clouds of each zone read from their cloud
+        mask assets, see score_clouds, else by the cloud cover of the whole tile.
+    :param providers: Providers searched concurrently instead of pref_provider only, see search_data.
+    :param search_timeout: Number of seconds to wait for providers.
+    :param pipeline_kwargs: Concurrency settings passed to run_pipeline.
+    :return: Dict of image files per zone (None when nothing new was downloaded).
+    """
+    from eodag import EODataAccessGateway, setup_logging
+
+    from LookPyrenees.manage_bucket import BucketSession
+
+    setup_logging(2)  # 0: nothing, 1: only progress bars, 2: INFO, 3: DEBUG
+
+    # Fail on unknown zones before searching
+    for zone in zones:
+        zone_crop(zone)
+
+    metrics = RunMetrics() if metrics is None else metrics
+    if dag is None:
+        search_timeouts(providers or [pref_provider], search_timeout)
+        dag = EODataAccessGateway()
+    with metrics.stage("search"):
+        search_results = search_data(
+            outdir, dag, pref_provider, plot_res, catalogue=catalogue, providers=providers, timeout=search_timeout
+        )
+    metrics.add("products_found", len(search_results))
+    bucket_session = None if bucket is None else BucketSession(bucket, use_manifest=bucket_manifest)
+    bucket_index = None if bucket_session is None else bucket_session.index
+    output_index = OutputIndex(outdir) if bucket is None else None
+
+    with metrics.stage("select"):
+        coverage = coverage_matrix(search_results, zones)
+
+        clouds_per_zone = {}
+        if cloud_scoring:
+            with metrics.stage("clouds"):
+                clouds_per_zone = score_clouds(cloud_candidates(
+                    search_results, coverage, outdir, bucket, bucket_index=bucket_index, output_index=output_index
+                ))
+
+        selected_per_zone = {}
+        for zone in zones:
+            logging.info("Selecting products of %s zone", zone)
+            selected_per_zone[zone] = select_products(
+                zone, outdir, search_results, bucket, bucket_index=bucket_index, coverage=coverage[zone],
+                output_index=output_index, zone_clouds=clouds_per_zone.get(zone),
+            )
+
+    products = group_products(selected_per_zone)
+    logging.info("%s unique products to download for %s zones", len(products), len(zones))
+
+    files_per_zone = {zone: None for zone in zones}
+    files_per_zone.update(
+        run_pipeline(
+            products, dag, outdir, bucket_session=bucket_session, download_mode=download_mode, metrics=metrics,
+            output_index=output_index, **pipeline_kwargs
+        )
+    )
+
+    if bucket_session is not None:
+        bucket_session.close()
+
+    if not products:
         logging.info("All files already exist, no download")
 
-    return file_path
+    return files_per_zone
+
+
+def process(zone, outdir, pref_provider, plot_res, bucket, download_mode="full"):
+    """
+    Process search, filter and crop final EO product
+    """
+    return process_zones([zone], outdir, pref_provider, plot_res, bucket, download_mode)[zone]
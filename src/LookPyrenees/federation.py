@@ -0,0 +1,101 @@
+"""This module searches several providers concurrently and merges their results into one product per acquisition"""
+# pylint: disable=import-error,import-outside-toplevel
+import logging
+import math
+import os
+import queue
+import threading
+import time
+
+# Number of seconds after which providers which did not answer are left out
+SEARCH_TIMEOUT = 120
+# Processing levels in order of preference, products of other levels come last
+PRODUCT_LEVELS = ["MSIL2A", "MSIL1C"]
+
+
+def acquisition_key(name):
+    """Return the (tile, sensing time) of an EO product id, shared by its products of all levels and providers"""
+    parts = name.split("_")
+
+    return parts[5], parts[2]
+
+
+def level_rank(name):
+    """Return the preference of the processing level of an EO product id, lower is better"""
+    level = name.split("_")[1]
+
+    return PRODUCT_LEVELS.index(level) if level in PRODUCT_LEVELS else len(PRODUCT_LEVELS)
+
+
+def search_timeouts(providers, timeout=SEARCH_TIMEOUT):
+    """
+    Set the timeout of the search requests of providers in eodag configuration, unless
+    already configured, so that their requests give up with the search. The gateway
+    reads it when created.
+    """
+    for provider in filter(None, providers):
+        os.environ.setdefault(f"EODAG__{provider.upper()}__SEARCH__TIMEOUT", str(math.ceil(timeout)))
+
+
+def federated_search(providers, search, timeout=SEARCH_TIMEOUT):
+    """
+    Query providers concurrently, those failing or not answering within timeout are left
+    out so that an outage of one provider does not stall nor fail the run. Searches run
+    in daemon threads, so a provider still not answering does not delay the exit either.
+
+    :param providers: List of provider names.
+    :param search: Function returning the search results of a provider given its name.
+    :param timeout: Number of seconds to wait for all providers.
+    :return: List of tuples (provider, seconds, search results) in order of answer.
+    """
+    results = queue.Queue()
+
+    def run(provider):
+        try:
+            results.put((provider, search(provider), None))
+        except Exception as error:  # pylint: disable=broad-except
+            results.put((provider, None, error))
+
+    start = time.perf_counter()
+    for provider in providers:
+        threading.Thread(target=run, args=(provider,), name=f"search-{provider}", daemon=True).start()
+
+    answers = []
+    late = list(providers)
+    while late:
+        try:
+            provider, search_results, error = results.get(timeout=max(0.0, start + timeout - time.perf_counter()))
+        except queue.Empty:
+            logging.warning("No answer of %s after %s s, their results are left out", ", ".join(late), timeout)
+            break
+        late.remove(provider)
+        if error is not None:
+            logging.warning("Search on %s failed: %s", provider, error)
+            continue
+        seconds = time.perf_counter() - start
+        logging.info("%s products found on %s in %.1f s", len(search_results), provider, seconds)
+        answers.append((provider, seconds, search_results))
+
+    return answers
+
+
+def merge_results(answers):
+    """
+    Merge search results of several providers keeping one product per tile and sensing
+    time, the L2A one if any and else the one of the provider which answered first,
+    which is then the one downloading it
+
+    :param answers: List of tuples (provider, seconds, search results), see federated_search.
+    :return: SearchResult of merged products.
+    """
+    from eodag.api.search_result import SearchResult
+
+    merged = {}
+    for rank, (_, _, search_results) in enumerate(answers):
+        for product in search_results:
+            name = product.properties["id"]
+            key = acquisition_key(name)
+            if key not in merged or (level_rank(name), rank) < merged[key][0]:
+                merged[key] = ((level_rank(name), rank), product)
+
+    return SearchResult([product for _, product in merged.values()])
@@ -1,80 +1,313 @@
 """This module allow to download, upload and delete data on google cloud storage"""
 
+import datetime
+import json
 import logging
+import math
 import os
 
+from google.api_core.exceptions import NotFound, PreconditionFailed  # type: ignore
 from google.cloud import storage  # type: ignore
+from google.cloud.storage.batch import Batch  # type: ignore
+from requests.adapters import HTTPAdapter
+
+from LookPyrenees.outputs import RETENTION_DAYS
+from LookPyrenees.outputs import image_key as blob_key
+from LookPyrenees.outputs import product_key
 
 os.environ.get("GOOGLE_APPLICATION_CREDENTIALS", "")
 
+MANIFEST_BLOB = "manifest.json"
+DEFAULT_WORKERS = 8
+# Number of deletions sent in one batch request, the JSON API accepts up to 100
+BATCH_SIZE = 100
+
+
+class ResponsesBatch(Batch):
+    """Batch request keeping the responses returned by finish when it is used as a context manager"""
+
+    def __init__(self, client, raise_exception=True):
+        super().__init__(client, raise_exception=raise_exception)
+        self.responses = []
+
+    def finish(self, raise_exception=True):
+        self.responses = super().finish(raise_exception=raise_exception)
+        return self.responses
+
+
+class BucketIndex:
+    """
+    Set of (date, tile, zone) keys of images stored on a bucket, built from one
+    listing per run or read from a manifest object stored in the bucket
+    """
+
+    def __init__(self, bucket_name, use_manifest=False, client=None):
+        self.bucket_name = bucket_name
+        self.use_manifest = use_manifest
+        self.client = client
+        self.blob_names = None
+        self.keys = set()
+        self.dirty = False
+
+    def get_bucket(self):
+        """Return the bucket, creating the client on first use"""
+        if self.client is None:
+            self.client = storage.Client()
+
+        return self.client.bucket(self.bucket_name)
+
+    def load(self):
+        """Fill the index from the manifest if used and present, else from one listing"""
+        bucket = self.get_bucket()
+        blob_names = None
+        if self.use_manifest:
+            try:
+                manifest = json.loads(bucket.blob(MANIFEST_BLOB).download_as_text())
+                blob_names = manifest["blobs"]
+                logging.info("Read %s blobs from manifest of bucket %s", len(blob_names), self.bucket_name)
+            except NotFound:
+                logging.info("No manifest on bucket %s, list its blobs", self.bucket_name)
+
+        if blob_names is None:
+            blobs = self.client.list_blobs(bucket)
+            blob_names = [blob.name for blob in blobs if blob.name != MANIFEST_BLOB]
+            # The manifest has to be written for the next runs
+            self.dirty = self.use_manifest
+
+        self.blob_names = set(blob_names)
+        self.keys = {blob_key(blob_name) for blob_name in self.blob_names} - {None}
+
+        return self
+
+    def add(self, blob_name):
+        """Add a blob uploaded during the run to the index, it will be listed if not loaded yet"""
+        if self.blob_names is None:
+            return
+
+        if blob_name not in self.blob_names:
+            self.blob_names.add(blob_name)
+            self.dirty = True
+            key = blob_key(blob_name)
+            if key is not None:
+                self.keys.add(key)
+
+    def remove(self, blob_names):
+        """Remove blobs deleted during the run from the index"""
+        if self.blob_names is None:
+            return
+
+        removed = self.blob_names & set(blob_names)
+        if removed:
+            self.blob_names -= removed
+            self.keys = {blob_key(blob_name) for blob_name in self.blob_names} - {None}
+            self.dirty = True
+
+    def exists(self, name, zone):
+        """Check if the image of an EO product id for a zone is on the bucket"""
+        if self.blob_names is None:
+            self.load()
+
+        return product_key(name, zone) in self.keys
+
+    def save(self):
+        """Write the manifest object on the bucket with all blobs of the index if it changed"""
+        if not self.use_manifest or self.blob_names is None or not self.dirty:
+            return
+
+        manifest = json.dumps({"blobs": sorted(self.blob_names)})
+        self.get_bucket().blob(MANIFEST_BLOB).upload_from_string(manifest, content_type="application/json")
+        logging.info("Manifest of bucket %s updated with %s blobs", self.bucket_name, len(self.blob_names))
+        self.dirty = False
+
+
+class BucketSession:
+    """
+    One storage client and its connection pool shared by all operations on a bucket
+    during a run, with the BucketIndex of the bucket kept up to date on upload
+
+    :param read_only: Never write the manifest of the bucket on close, for dry runs.
+    """
+
+    def __init__(self, bucket_name, client=None, max_workers=DEFAULT_WORKERS, use_manifest=False, read_only=False):
+        self.bucket_name = bucket_name
+        self.read_only = read_only
+        self.client = storage.Client() if client is None else client
+        self.max_workers = max_workers
 
-def load_on_gcs(bucket_name, source_file, destination_blob):
+        # Keep one connection per worker alive instead of the 10 of the default pool
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(max_workers, 10))
+        self.client._http.mount("https://", adapter)  # pylint: disable=protected-access
+        self.client._http.mount("http://", adapter)  # pylint: disable=protected-access
+
+        self.bucket = self.client.bucket(bucket_name)
+        self.index = BucketIndex(bucket_name, use_manifest=use_manifest, client=self.client)
+
+    def upload(self, source, destination_blob, content_type=None):
+        """
+        Upload a file or bytes unless the blob already exists, the create only
+        precondition replaces the round trip to check its existence
+
+        :param source: Path of the file to upload or its content, streamed without touching the disk.
+        :return: True if the file has been uploaded, False if it already existed.
+        """
+        blob = self.bucket.blob(destination_blob)
+        try:
+            if isinstance(source, bytes):
+                blob.upload_from_string(source, content_type=content_type, if_generation_match=0)
+            else:
+                blob.upload_from_filename(source, content_type=content_type, if_generation_match=0)
+        except PreconditionFailed:
+            logging.info("File %s already exists", destination_blob)
+            self.index.add(destination_blob)
+            return False
+
+        logging.info("File %s uploaded to bucket %s.", destination_blob, self.bucket_name)
+        self.index.add(destination_blob)
+        return True
+
+    def delete(self, blob_name):
+        """Delete a blob in a single request, a missing blob is only logged"""
+        try:
+            self.bucket.blob(blob_name).delete()
+        except NotFound:
+            logging.info("File %s does not exists", blob_name)
+            return False
+
+        logging.info("Blob %s deleted.", blob_name)
+        return True
+
+    def delete_many(self, blob_names, batch_size=BATCH_SIZE):
+        """
+        Delete blobs with one batch request per batch_size blobs instead of one request
+        per blob, missing blobs are only logged
+
+        :return: List of blob names deleted.
+        """
+        blob_names = list(blob_names)
+        deleted = []
+        for start in range(0, len(blob_names), batch_size):
+            names = blob_names[start:start + batch_size]
+            with ResponsesBatch(self.client, raise_exception=False) as batch:
+                for name in names:
+                    self.bucket.blob(name).delete()
+            for name, response in zip(names, batch.responses):
+                if 200 <= response.status_code < 300:
+                    deleted.append(name)
+                elif response.status_code == 404:
+                    logging.info("File %s does not exists", name)
+                else:
+                    logging.warning("Blob %s not deleted: %s %s", name, response.status_code, response.text)
+
+        self.index.remove(deleted)
+        logging.info("%s blobs deleted from bucket %s in %s batch requests.", len(deleted), self.bucket_name,
+                     math.ceil(len(blob_names) / batch_size))
+        return deleted
+
+    def close(self):
+        """Write the manifest of the bucket if needed and close the connection pool"""
+        if not self.read_only:
+            self.index.save()
+        self.client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def load_on_gcs(bucket_name, source_file, destination_blob, session=None):
     """
     Upload images to the bucket on Google Cloud Storage (GCS)
+
+    :param session: BucketSession shared by the run, a new one is created if not given.
     """
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(destination_blob)
-
-    # Optional: set a generation-match precondition to avoid potential race conditions
-    # and data corruptions. The request to upload is aborted if the object's
-    # generation number does not match your precondition. For a destination
-    # object that does not yet exist, set the if_generation_match precondition to 0.
-    # If the destination object already exists in your bucket, set instead a
-    # generation-match precondition using its generation number.
-    generation_match_precondition = 0
-
-    stats = blob.exists(storage_client)
-    filename = source_file.split("/")[-1]
-    if not stats:
-        blob.upload_from_filename(source_file, if_generation_match=generation_match_precondition)
-        logging.info("File %s uploaded to bucket %s.", filename, bucket_name)
-    else:
-        logging.info("File %s already exists", destination_blob)
-
-
-def delete_blob(bucket_name, blob_name):
+    if session is None:
+        with BucketSession(bucket_name) as new_session:
+            return new_session.upload(source_file, destination_blob)
+
+    return session.upload(source_file, destination_blob)
+
+
+def delete_blob(bucket_name, blob_name, session=None):
     """Deletes a blob from the bucket."""
+    if session is None:
+        with BucketSession(bucket_name) as new_session:
+            return new_session.delete(blob_name)
 
-    storage_client = storage.Client()
+    return session.delete(blob_name)
 
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(blob_name)
-    generation_match_precondition = None
 
-    # Optional: set a generation-match precondition to avoid potential race conditions
-    # and data corruptions. The request to delete is aborted if the object's
-    # generation number does not match your precondition.
-    blob.reload()  # Fetch blob metadata to use in generation_match_precondition.
-    generation_match_precondition = blob.generation
+def expired_blobs(blob_names, min_date=None, keep_last=None):
+    """
+    Select the zone images of a bucket to delete, with their georeferencing sidecars
 
-    stats = blob.exists(storage_client)
-    if stats:
-        blob.delete(if_generation_match=generation_match_precondition)
-        logging.info("Blob %s deleted.", blob_name)
-    else:
-        logging.info("File %s does not exists", blob_name)
+    :param min_date: Images sensed before this date are selected, None to keep them whatever their age.
+    :param keep_last: Number of the newest images of each zone kept, the older ones are selected.
+    :return: Sorted list of blob names, blobs which are not zone images are never selected.
+    """
+    dates_per_zone = {}
+    for blob_name in blob_names:
+        key = blob_key(blob_name)
+        if key is not None:
+            date, tile, zone = key
+            dates_per_zone.setdefault(zone, set()).add((date, tile))
 
+    kept = set()
+    if keep_last is not None:
+        for zone, dates in dates_per_zone.items():
+            kept |= {(date, tile, zone) for date, tile in sorted(dates, reverse=True)[:keep_last]}
 
-def check_files_on_bucket(bucket_name, name, zone):
-    """This function allow to check if an image already exists before download it"""
-    # Create a client
-    client = storage.Client()
+    expired = []
+    for blob_name in blob_names:
+        key = blob_key(blob_name)
+        if key is None:
+            continue
+        too_old = min_date is not None and key[0] < f"{min_date:%Y%m%d}"
+        too_many = keep_last is not None and key not in kept
+        if too_old or too_many:
+            expired.append(blob_name)
 
-    # Get the bucket
-    bucket = client.bucket(bucket_name)
+    return sorted(expired)
 
-    # List all blobs in the bucket
-    blobs = list(client.list_blobs(bucket))
 
-    date = name.split("_")[2].split("T")[0]
-    tile = name.split("_")[5]
+def check_old_blobs(bucket_name, max_age_days=RETENTION_DAYS, keep_last=None, use_manifest=False, dry_run=False,
+                    session=None):
+    """
+    Delete zone images of the bucket sensed more than max_age_days ago, or beyond the
+    keep_last newest images of each zone, as check_old_files does in the output dirpath.
+    Blob names are read from the bucket index, the manifest if used, and blobs are
+    deleted with batch requests.
 
-    matches = [date, tile, zone]
-    # Check each blob name for the substring
-    if len(blobs) > 0:
-        for blob in blobs:
-            if all(elem in blob.name for elem in matches):
-                return True
+    :param max_age_days: Number of days images are kept, None to only keep the last ones.
+    :param keep_last: Number of images kept per zone, None to only apply the age rule.
+    :param dry_run: Only log the blobs which would be deleted.
+    :param session: BucketSession shared by the run, a new one is created if not given.
+    :return: List of blob names deleted, or to delete on a dry run.
+    """
+    if session is None:
+        with BucketSession(bucket_name, use_manifest=use_manifest, read_only=dry_run) as new_session:
+            return check_old_blobs(bucket_name, max_age_days, keep_last, dry_run=dry_run, session=new_session)
+
+    if session.index.blob_names is None:
+        session.index.load()
+    min_date = None if max_age_days is None else datetime.date.today() - datetime.timedelta(days=max_age_days)
+    expired = expired_blobs(session.index.blob_names, min_date=min_date, keep_last=keep_last)
+    logging.info("%s blobs of bucket %s to delete", len(expired), bucket_name)
+    if dry_run:
+        for blob_name in expired:
+            logging.info("Would delete %s", blob_name)
+        return expired
+
+    return session.delete_many(expired)
+
+
+def check_files_on_bucket(bucket_name, name, zone, index=None):
+    """This function allow to check if an image already exists before download it
+
+    :param index: BucketIndex shared by all checks of a run, built with one listing if not given.
+    """
+    if index is None:
+        index = BucketIndex(bucket_name)
 
-    return False
+    return index.exists(name, zone)
@@ -0,0 +1,132 @@
+"""This module measures pipeline stages of a run and exports them as a JSON or OpenMetrics report"""
+import datetime
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_PREFIX = "lookpyrenees"
+
+
+def peak_rss(who=resource.RUSAGE_SELF):
+    """Return the peak resident set size in bytes of the process or of its terminated children"""
+    max_rss = resource.getrusage(who).ru_maxrss
+
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def path_size(path):
+    """Return the size in bytes of a file or of all files of a directory, 0 if it is not local"""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+
+    return sum(
+        os.path.getsize(os.path.join(dirpath, file_name))
+        for dirpath, _, file_names in os.walk(path)
+        for file_name in file_names
+    )
+
+
+def timed_call(func, *args):
+    """Call a function and return its elapsed time with its result, picklable for worker processes"""
+    start = time.perf_counter()
+    result = func(*args)
+
+    return time.perf_counter() - start, result
+
+
+class RunMetrics:
+    """
+    Thread safe counters and cumulative wall time of pipeline stages. Stages running
+    concurrently add up, so a stage time can be greater than the run time.
+    """
+
+    def __init__(self):
+        self.started_at = datetime.datetime.now(datetime.timezone.utc)
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        """Add one call of a stage which lasted seconds"""
+        with self.lock:
+            calls, total = self.stages.get(stage, (0, 0.0))
+            self.stages[stage] = (calls + 1, total + seconds)
+
+    @contextmanager
+    def stage(self, stage):
+        """Record the wall time of the wrapped block as one call of a stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def timed(self, stage, func, *args):
+        """Call a function and record its wall time as one call of a stage"""
+        with self.stage(stage):
+            return func(*args)
+
+    def add(self, counter, value=1):
+        """Increment a counter, e.g. products downloaded or bytes uploaded"""
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def report(self):
+        """Return the run report as a JSON serializable dict"""
+        with self.lock:
+            return {
+                "started_at": self.started_at.isoformat(),
+                "elapsed_seconds": round(time.perf_counter() - self.start, 3),
+                "peak_rss_bytes": peak_rss(),
+                "peak_rss_children_bytes": peak_rss(resource.RUSAGE_CHILDREN),
+                "stages": {
+                    stage: {"calls": calls, "seconds": round(seconds, 3)}
+                    for stage, (calls, seconds) in sorted(self.stages.items())
+                },
+                "counters": dict(sorted(self.counters.items())),
+            }
+
+    def to_openmetrics(self):
+        """Return the run report in the Prometheus/OpenMetrics text exposition format"""
+        report = self.report()
+        lines = [
+            f"# TYPE {METRICS_PREFIX}_run_elapsed_seconds gauge",
+            f"{METRICS_PREFIX}_run_elapsed_seconds {report['elapsed_seconds']}",
+            f"# TYPE {METRICS_PREFIX}_peak_rss_bytes gauge",
+            f'{METRICS_PREFIX}_peak_rss_bytes{{process="main"}} {report["peak_rss_bytes"]}',
+            f'{METRICS_PREFIX}_peak_rss_bytes{{process="children"}} {report["peak_rss_children_bytes"]}',
+            f"# TYPE {METRICS_PREFIX}_stage_seconds counter",
+        ]
+        lines += [
+            f'{METRICS_PREFIX}_stage_seconds_total{{stage="{stage}"}} {values["seconds"]}'
+            for stage, values in report["stages"].items()
+        ]
+        lines.append(f"# TYPE {METRICS_PREFIX}_stage_calls counter")
+        lines += [
+            f'{METRICS_PREFIX}_stage_calls_total{{stage="{stage}"}} {values["calls"]}'
+            for stage, values in report["stages"].items()
+        ]
+        for counter, value in report["counters"].items():
+            lines += [f"# TYPE {METRICS_PREFIX}_{counter} counter", f"{METRICS_PREFIX}_{counter}_total {value}"]
+        lines.append("# EOF")
+
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path):
+        """Write the run report as JSON"""
+        with open(path, "w", encoding="utf-8") as report_file:
+            json.dump(self.report(), report_file, indent=2)
+        logging.info("Run report written to %s", path)
+
+    def write_openmetrics(self, path):
+        """Write the run report as OpenMetrics text, e.g. for the node exporter textfile collector"""
+        with open(path, "w", encoding="utf-8") as metrics_file:
+            metrics_file.write(self.to_openmetrics())
+        logging.info("OpenMetrics report written to %s", path)
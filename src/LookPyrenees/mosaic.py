@@ -0,0 +1,140 @@
+"""
+This module mosaics products of adjacent tiles of one datatake for zones that no single
+product contains, reading only the window of each tile over the zone
+"""
+# pylint: disable=import-error,import-outside-toplevel
+import logging
+
+from LookPyrenees.zones import zone_grid
+
+MOSAIC_SUFFIX = "mosaic"
+# Percent of a zone the tiles of a datatake have to cover together to be mosaicked
+MIN_COVERAGE = 95
+
+
+def datatake_key(name):
+    """Return the (platform, sensing time, relative orbit) of an EO product id, shared by the tiles of a datatake"""
+    parts = name.split("_")
+
+    return parts[0], parts[2], parts[4]
+
+
+def union_coverage(products, geometry):
+    """Compute the coverage percent of a zone by the union of the footprints of EO products"""
+    import shapely
+
+    union = shapely.union_all([product.geometry for product in products])
+
+    return 100 * shapely.area(shapely.intersection(geometry, union)) / shapely.area(geometry)
+
+
+def datatake_coverage(search_results, coverage_zone, geometry):
+    """
+    Compute the coverage of a zone by the union of the products of the datatake of each EO product
+
+    :param coverage_zone: Coverage percent of the zone by each product, see coverage_matrix.
+    :param geometry: Shapely geometry of the zone.
+    :return: Array of coverage percent over products, 0 for products not intersecting the zone.
+    """
+    import numpy as np
+
+    groups = {}
+    for i, product in enumerate(search_results):
+        if coverage_zone[i] > 0:
+            groups.setdefault(datatake_key(product.properties["id"]), []).append(i)
+
+    coverage = np.zeros(len(coverage_zone))
+    for indices in groups.values():
+        coverage[indices] = union_coverage([search_results[i] for i in indices], geometry)
+
+    return coverage
+
+
+class Mosaic:
+    """
+    EO products of adjacent tiles of one datatake cropped together. It is named after the
+    product covering most of the zone, whose grid is used, with a suffix so that its id
+    differs from this product while being parsed the same way.
+    """
+
+    def __init__(self, products):
+        self.products = products
+        self.properties = dict(products[0].properties, id=f'{products[0].properties["id"]}_{MOSAIC_SUFFIX}')
+
+    def __repr__(self):
+        return f"Mosaic({', '.join(product.properties['id'] for product in self.products)})"
+
+
+def mosaic_members(item):
+    """Return the EO products to download for a selected EO product or mosaic"""
+    return item.products if isinstance(item, Mosaic) else [item]
+
+
+def mosaic_groups(products, coverage_by_id, geometry):
+    """
+    Group EO products per datatake into mosaics, a mosaic of one product is kept so
+    that crops of a zone are always on the same grid. Tiles of a datatake can be filtered
+    out, e.g. for their clouds, so a datatake whose remaining tiles no longer cover the
+    zone is left out rather than cropped into a partial image.
+
+    :param coverage_by_id: Dict of product id and coverage percent of the zone.
+    :param geometry: Shapely geometry of the zone.
+    :return: List of Mosaic.
+    """
+    groups = {}
+    for product in products:
+        groups.setdefault(datatake_key(product.properties["id"]), []).append(product)
+
+    mosaics = []
+    for key, group in groups.items():
+        coverage = union_coverage(group, geometry)
+        if coverage <= MIN_COVERAGE:
+            logging.warning("Datatake %s left out, its remaining tiles cover %.1f percent of the zone",
+                            "_".join(key), coverage)
+            continue
+        mosaics.append(Mosaic(sorted(group, key=lambda product: -coverage_by_id[product.properties["id"]])))
+
+    return mosaics
+
+
+def read_mosaic(zones, img_paths, nodata=0):
+    """
+    Read the pixels of every zone from the TCI images of adjacent tiles, each image being
+    opened once and only read over the zone. Tiles are warped on the grid of the first
+    image and fill pixels left empty by previous ones, so memory scales with zones only.
+
+    :param img_paths: Paths or URLs of TCI images, the first one gives the crs and grid.
+    :return: Tuple of the crs and dict of zone name and tuple (array, transform), see read_zones.
+    """
+    import numpy as np
+    import rasterio as rio
+    from rasterio.enums import Resampling
+    from rasterio.vrt import WarpedVRT
+
+    with rio.open(img_paths[0]) as src:
+        crs, transform, count, dtype = src.crs, src.transform, src.count, src.dtypes[0]
+
+    grids = {zone: zone_grid(zone, crs.to_string(), transform) for zone in zones}
+    rasters = {
+        zone: (np.full((count, height, width), nodata, dtype=dtype), grid_transform)
+        for zone, (grid_transform, width, height, _) in grids.items()
+    }
+
+    for img_path in img_paths:
+        with rio.open(img_path) as src:
+            logging.info("Mosaic zones from %s", img_path)
+            for zone, (grid_transform, width, height, _) in grids.items():
+                # Only source blocks overlapping the zone grid are read and warped
+                with WarpedVRT(
+                    src, crs=crs, transform=grid_transform, width=width, height=height,
+                    resampling=Resampling.nearest, nodata=nodata
+                ) as vrt:
+                    data = vrt.read()
+                raster = rasters[zone][0]
+                empty = (raster == nodata).all(axis=0)
+                raster[:, empty] = data[:, empty]
+
+    for zone, (_, _, _, outside) in grids.items():
+        rasters[zone][0][:, outside] = nodata
+
+    return crs, rasters
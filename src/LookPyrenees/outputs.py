@@ -0,0 +1,148 @@
+"""This module indexes zone images written in the output dirpath to check their existence and age"""
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from LookPyrenees.utils import sqlite_connect
+
+INDEX_DIR = ".index"
+INDEX_FILE = "outputs.sqlite"
+IMAGE_EXTENSIONS = (".tif", ".png", ".webp", ".jpg")
+# Number of days images are kept after their sensing date
+RETENTION_DAYS = 31
+
+
+def image_key(file_name):
+    """
+    Parse the (date, tile, zone) key of a zone image name such as
+    T31TCH_20240511T103629_TCI_10m_montcalm.png, None if it is not a zone image
+    """
+    stem = file_name.split("/")[-1].rsplit(".", 1)[0]
+    parts = stem.split("_")
+    if len(parts) < 5 or parts[2] != "TCI":
+        return None
+
+    return parts[1].split("T")[0], parts[0], "_".join(parts[4:])
+
+
+def product_key(name, zone):
+    """Build the (date, tile, zone) key of an EO product id for a zone"""
+    date = name.split("_")[2].split("T")[0]
+    tile = name.split("_")[5]
+
+    return date, tile, zone
+
+
+class OutputIndex:
+    """
+    SQLite index of the zone images of an output dirpath with their (date, tile, zone)
+    key and size. It is updated when images are written or removed, the directory is
+    only scanned when the index has no database yet. The database is created on the first
+    write: until then, the scan is kept in memory so that only checking a directory does
+    not write in it. Images removed by something else are skipped by checks, images added
+    by something else are not indexed.
+    """
+
+    def __init__(self, outdir):
+        self.outdir = str(outdir)
+        self.path = os.path.join(self.outdir, INDEX_DIR, INDEX_FILE)
+        self.memory = None
+        self.lock = threading.Lock()
+
+    def scan(self, conn):
+        """Fill the index with the zone images of the directory"""
+        logging.info("Index zone images of %s", self.outdir)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS outputs (file_name TEXT PRIMARY KEY, date TEXT NOT NULL, "
+            "tile TEXT NOT NULL, zone TEXT NOT NULL, size INTEGER NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS outputs_key ON outputs (date, tile, zone)")
+        rows = []
+        if os.path.isdir(self.outdir):
+            with os.scandir(self.outdir) as entries:
+                for entry in entries:
+                    key = image_key(entry.name)
+                    if entry.is_file() and entry.name.endswith(IMAGE_EXTENSIONS) and key is not None:
+                        rows.append((entry.name, *key, entry.stat().st_size))
+        conn.execute("DELETE FROM outputs")
+        conn.executemany("INSERT INTO outputs VALUES (?, ?, ?, ?, ?)", rows)
+
+    @contextmanager
+    def connect(self, write=False):
+        """
+        Open a connection to the index, committed and closed on exit
+
+        :param write: Create the database if it does not exist yet, from the scan kept in
+            memory if there is one, rather than reading the scan kept in memory.
+        """
+        with self.lock:
+            if not write and not os.path.exists(self.path):
+                if self.memory is None:
+                    self.memory = sqlite3.connect(":memory:", check_same_thread=False)
+                    with self.memory:
+                        self.scan(self.memory)
+                with self.memory:
+                    yield self.memory
+                return
+
+            created = not os.path.exists(self.path)
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with sqlite_connect(self.path) as conn:
+                if created and self.memory is not None:
+                    self.memory.backup(conn)
+                elif created:
+                    self.scan(conn)
+                if self.memory is not None:
+                    self.memory.close()
+                    self.memory = None
+                yield conn
+
+    def add(self, file_name, size):
+        """Index a zone image written in the directory, other files are ignored"""
+        key = image_key(file_name)
+        if not file_name.endswith(IMAGE_EXTENSIONS) or key is None:
+            return
+
+        with self.connect(write=True) as conn:
+            conn.execute("INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?)", (file_name, *key, size))
+
+    def exists(self, date, tile, zone):
+        """Check if an image of a zone was already produced from the tile sensed at date"""
+        with self.connect() as conn:
+            rows = conn.execute(
+                "SELECT file_name FROM outputs WHERE date = ? AND tile = ? AND zone = ?", (date, tile, zone)
+            ).fetchall()
+
+        return any(os.path.exists(os.path.join(self.outdir, file_name)) for (file_name,) in rows)
+
+    def latest(self, zone):
+        """Return the name of the newest image of a zone, None if there is none"""
+        with self.connect() as conn:
+            rows = conn.execute(
+                "SELECT file_name FROM outputs WHERE zone = ? ORDER BY date DESC, file_name DESC", (zone,)
+            ).fetchall()
+
+        return next(
+            (file_name for (file_name,) in rows if os.path.exists(os.path.join(self.outdir, file_name))), None
+        )
+
+    def older_than(self, min_date):
+        """Return the names of images sensed before min_date"""
+        with self.connect() as conn:
+            rows = conn.execute("SELECT file_name FROM outputs WHERE date < ?", (f"{min_date:%Y%m%d}",))
+            return [file_name for (file_name,) in rows]
+
+    def remove(self, file_names):
+        """Delete images and their georeferencing sidecars from the directory and the index"""
+        if not file_names:
+            return
+
+        for file_name in file_names:
+            for path in (file_name, f"{file_name.rsplit('.', 1)[0]}.json"):
+                if os.path.exists(os.path.join(self.outdir, path)):
+                    os.remove(os.path.join(self.outdir, path))
+
+        with self.connect(write=True) as conn:
+            conn.executemany("DELETE FROM outputs WHERE file_name = ?", [(file_name,) for file_name in file_names])
@@ -0,0 +1,311 @@
+"""
+This module keeps the gateway, zones and search results in memory between runs triggered
+through a small HTTP API, triggers of zones already waiting for a run joining that run
+"""
+# pylint: disable=import-error,import-outside-toplevel
+import datetime
+import itertools
+import json
+import logging
+import os
+import threading
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from LookPyrenees.catalogue import MemoryCache
+from LookPyrenees.download import (
+    check_old_files,
+    content_type,
+    cpu_executor,
+    process_zones,
+)
+from LookPyrenees.federation import SEARCH_TIMEOUT, search_timeouts
+from LookPyrenees.metrics import RunMetrics
+from LookPyrenees.outputs import OutputIndex
+from LookPyrenees.zones import prepared_zone, search_geometry, zone_names
+
+# Number of finished runs kept to answer status requests
+MAX_JOBS = 100
+SEARCH_CACHE_TTL = datetime.timedelta(minutes=10)
+
+
+def now_iso():
+    """Return the current time as an ISO string"""
+    return datetime.datetime.now().isoformat(timespec="seconds")
+
+
+class ZoneService:
+    """
+    Run zones one run at a time in a worker thread, with the gateway, the zones, a process
+    pool of crop workers and search results kept between runs. At most one run waits: a
+    trigger of zones already waiting or running returns that run, other zones join the
+    waiting run, so concurrent triggers of the same zone are coalesced into one run.
+
+    :param options: Keyword arguments of process_zones other than zones, see run_options.
+    :param catalogue: Catalogue of search results behind the in-memory cache, see MemoryCache.
+    :param search_cache_ttl: Time during which search results are reused without reading the catalogue.
+    :param dag: Gateway searching and downloading EO products, an EODataAccessGateway by default.
+    :param all_zones: Zones of a trigger of all zones, every zone of the registry by default.
+    """
+
+    def __init__(self, options, catalogue=None, search_cache_ttl=SEARCH_CACHE_TTL, dag=None, all_zones=None,
+                 max_jobs=MAX_JOBS):
+        self.options = dict(options)
+        self.outdir = str(options["outdir"])
+        self.search_cache = MemoryCache(catalogue, ttl=search_cache_ttl)
+        self.dag = dag
+        self.all_zones = all_zones
+        self.max_jobs = max_jobs
+        self.cpu_pool = None
+        self.output_index = None
+        self.started_at = None
+
+        self.condition = threading.Condition()
+        self.ids = itertools.count(1)
+        self.jobs = {}
+        self.waiting = None
+        self.running = None
+        self.stopping = False
+        self.worker = threading.Thread(target=self.work, name="zone-runs", daemon=True)
+
+    def warm_up(self):
+        """Create the gateway and the crop workers and load zones, once for all runs"""
+        from eodag import EODataAccessGateway
+
+        os.makedirs(self.outdir, exist_ok=True)
+        self.output_index = OutputIndex(self.outdir)
+        if self.all_zones is None:
+            self.all_zones = zone_names()
+        for zone in zone_names():
+            prepared_zone(zone)
+        search_geometry()
+
+        if self.dag is None:
+            search_timeouts(
+                self.options.get("providers") or [self.options["pref_provider"]],
+                self.options.get("search_timeout", SEARCH_TIMEOUT),
+            )
+            self.dag = EODataAccessGateway()
+        self.cpu_pool = cpu_executor(self.options.get("cpu_workers"))
+
+    def start(self):
+        """Warm up and start running triggered zones"""
+        self.warm_up()
+        self.started_at = now_iso()
+        self.worker.start()
+        logging.info("Service ready for %s zones", len(self.all_zones))
+
+    def close(self):
+        """Stop once the current run is over and shut the crop workers down"""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.worker.is_alive():
+            self.worker.join()
+        if self.cpu_pool is not None:
+            self.cpu_pool.shutdown()
+
+    def check_zones(self, zones):
+        """Raise a ValueError on unknown zones"""
+        known = zone_names()
+        for zone in zones:
+            if zone not in known:
+                raise ValueError(f"This zone {zone} does not exist")
+
+    def trigger(self, zones):
+        """
+        Queue a run of zones, coalesced with the waiting or running one
+
+        :param zones: List of zone names.
+        :return: Dict of the run processing them, see job.
+        """
+        self.check_zones(zones)
+        with self.condition:
+            if self.running is not None and set(zones) <= set(self.running["zones"]):
+                return dict(self.running)
+
+            if self.waiting is None:
+                self.waiting = {
+                    "id": next(self.ids), "zones": [], "state": "queued", "queued_at": now_iso(),
+                    "started_at": None, "finished_at": None, "error": None, "metrics": None,
+                }
+                self.jobs[self.waiting["id"]] = self.waiting
+                self.forget_jobs()
+            # Replaced rather than extended so that copies handed out are not modified
+            self.waiting["zones"] = self.waiting["zones"] + [
+                zone for zone in zones if zone not in self.waiting["zones"]
+            ]
+            self.condition.notify()
+            logging.info("Run %s queued for %s zones", self.waiting["id"], ", ".join(self.waiting["zones"]))
+
+            return dict(self.waiting)
+
+    def forget_jobs(self):
+        """Drop the oldest finished runs beyond max_jobs"""
+        finished = [job_id for job_id, job in self.jobs.items() if job["state"] in ("done", "failed")]
+        for job_id in finished[:max(0, len(self.jobs) - self.max_jobs)]:
+            del self.jobs[job_id]
+
+    def job(self, job_id):
+        """Return a copy of a run, None if it is unknown"""
+        with self.condition:
+            return dict(self.jobs[job_id]) if job_id in self.jobs else None
+
+    def status(self):
+        """Return the state of the service and its runs"""
+        with self.condition:
+            return {
+                "started_at": self.started_at,
+                "zones": self.all_zones,
+                "running": None if self.running is None else dict(self.running),
+                "queued": None if self.waiting is None else dict(self.waiting),
+                "jobs": [dict(job) for job in self.jobs.values()],
+            }
+
+    def latest(self, zone):
+        """
+        Return the newest image of a zone in the output dirpath
+
+        :return: Path of the image, None if the zone has no image.
+        """
+        self.check_zones([zone])
+        file_name = self.output_index.latest(zone)
+
+        return None if file_name is None else os.path.join(self.outdir, file_name)
+
+    def work(self):
+        """Run waiting zones until the service is closed"""
+        while True:
+            with self.condition:
+                while self.waiting is None and not self.stopping:
+                    self.condition.wait()
+                if self.stopping:
+                    return
+                job, self.waiting, self.running = self.waiting, None, self.waiting
+                job.update(state="running", started_at=now_iso())
+
+            self.run(job)
+            with self.condition:
+                self.running = None
+
+    def run(self, job):
+        """Process the zones of a run with the warm gateway, workers and search results"""
+        metrics = RunMetrics()
+        try:
+            process_zones(
+                job["zones"], catalogue=self.search_cache, dag=self.dag, metrics=metrics, cpu_pool=self.cpu_pool,
+                **self.options
+            )
+            check_old_files(self.outdir, index=self.output_index)
+            state, error = "done", None
+        except BrokenProcessPool as exc:
+            # A crop worker died, the next runs get new workers
+            logging.exception("Run %s failed, restart the crop workers", job["id"])
+            self.cpu_pool.shutdown(wait=False, cancel_futures=True)
+            self.cpu_pool = cpu_executor(self.options.get("cpu_workers"))
+            state, error = "failed", str(exc)
+        except Exception as exc:  # pylint: disable=broad-except
+            logging.exception("Run %s failed", job["id"])
+            state, error = "failed", str(exc)
+
+        with self.condition:
+            job.update(state=state, error=error, finished_at=now_iso(), metrics=metrics.report())
+        logging.info("Run %s %s", job["id"], state)
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """
+    HTTP API of the service:
+
+    - POST /runs?zone=<zone|all> queues a run, several zones are separated by commas
+    - GET /status, /runs and /runs/<id> describe the service and its runs
+    - GET /zones/<zone>/latest sends the newest image of a zone
+    """
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """Log requests with the service logs"""
+        logging.debug(format, *args)
+
+    def send_json(self, status, body):
+        """Send a JSON answer"""
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_file(self, path):
+        """Send a file with the content type of its extension"""
+        with open(path, "rb") as file:
+            content = file.read()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type(path))
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Describe the service, a run, or send the newest image of a zone"""
+        service = self.server.service
+        parts = urlsplit(self.path).path.strip("/").split("/")
+        if parts == ["status"]:
+            self.send_json(200, service.status())
+        elif parts == ["runs"]:
+            self.send_json(200, service.status()["jobs"])
+        elif len(parts) == 2 and parts[0] == "runs" and parts[1].isdigit():
+            job = service.job(int(parts[1]))
+            self.send_json(200 if job is not None else 404, job or {"error": f"No run {parts[1]}"})
+        elif len(parts) == 3 and parts[0] == "zones" and parts[2] == "latest":
+            try:
+                path = service.latest(parts[1])
+            except ValueError as error:
+                self.send_json(404, {"error": str(error)})
+                return
+            if path is None or not os.path.exists(path):
+                self.send_json(404, {"error": f"No image of {parts[1]} zone"})
+            else:
+                self.send_file(path)
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Queue a run of the zones of the query"""
+        service = self.server.service
+        url = urlsplit(self.path)
+        if url.path.strip("/") != "runs":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+
+        zone = parse_qs(url.query).get("zone", ["all"])[0]
+        try:
+            job = service.trigger(service.all_zones if zone == "all" else zone.split(","))
+        except ValueError as error:
+            self.send_json(400, {"error": str(error)})
+            return
+        self.send_json(202, job)
+
+
+class ServiceServer(ThreadingHTTPServer):
+    """HTTP server of a ZoneService"""
+
+    daemon_threads = True
+
+    def __init__(self, service, host="127.0.0.1", port=8080):
+        super().__init__((host, port), ServiceHandler)
+        self.service = service
+
+
+def serve(service, host="127.0.0.1", port=8080):
+    """Start a service and answer HTTP requests until interrupted"""
+    service.start()
+    server = ServiceServer(service, host, port)
+    logging.info("Serving on http://%s:%s", *server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Service interrupted")
+    finally:
+        server.server_close()
+        service.close()
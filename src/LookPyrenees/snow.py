@@ -0,0 +1,167 @@
+"""This module maps snow of zones with the NDSI of green and SWIR bands and estimates their snow line"""
+# pylint: disable=import-error,import-outside-toplevel
+import glob
+import logging
+
+from LookPyrenees.zones import zone_pixels
+
+GREEN_BAND = "B03"
+SWIR_BAND = "B11"
+# NDSI threshold of snow as a fraction, compared without division nor float arrays
+NDSI_THRESHOLD = (2, 5)
+# Reflectances of products from processing baseline 04.00 are shifted by this offset
+BOA_OFFSET = 1000
+ELEVATION_BAND = 100
+SNOW_LINE_FRACTION = (1, 2)
+# Elevation bands with fewer pixels are ignored to compute the snow line
+MIN_BAND_PIXELS = 50
+
+
+def radiometric_offset(name):
+    """Return the offset added to reflectances of an EO product from its processing baseline"""
+    baseline = name.split("_")[3]
+
+    return BOA_OFFSET if baseline.startswith("N") and int(baseline[1:]) >= 400 else 0
+
+
+def find_band_img(out_path, band):
+    """
+    Return the path of a spectral band inside a downloaded SAFE product, at its finest
+    resolution for L2A products, None if the product does not hold it
+    """
+    img_path = sorted(glob.glob(f"{out_path}/GRANULE/*/IMG_DATA/R*m/*_{band}_*m.jp2"))
+    img_path = img_path or glob.glob(f"{out_path}/GRANULE/*/IMG_DATA/*_{band}.jp2")
+    img_path = img_path or sorted(glob.glob(f"{out_path}/**/*_{band}*.jp2", recursive=True))
+
+    # R10m sorts before R20m and R60m
+    return img_path[0] if img_path else None
+
+
+def remove_offset(band, offset):
+    """Subtract the radiometric offset of a uint16 band in place, saturating at 0"""
+    import numpy as np
+
+    if offset:
+        np.maximum(band, offset, out=band)
+        band -= np.uint16(offset)
+
+    return band
+
+
+def snow_mask(green, swir, threshold=NDSI_THRESHOLD):
+    """
+    Return the boolean mask of pixels whose NDSI is above threshold, compared as
+    (den - num) * green > (den + num) * swir to avoid divisions and float arrays
+
+    :param threshold: NDSI threshold as a (numerator, denominator) fraction.
+    """
+    import numpy as np
+
+    num, den = threshold
+
+    return np.multiply(green, den - num, dtype=np.uint32) > np.multiply(swir, den + num, dtype=np.uint32)
+
+
+def snow_line(snow, elevation, valid, band_size=ELEVATION_BAND, fraction=SNOW_LINE_FRACTION):
+    """
+    Estimate the snow line as the lowest elevation band from which the snow fraction
+    of every higher band is above fraction, None when the top band is not snowy
+
+    :param snow: Boolean snow mask.
+    :param elevation: Elevation array in meters on the same grid.
+    :param valid: Boolean mask of pixels to take into account.
+    :return: Altitude in meters of the bottom of the band.
+    """
+    import numpy as np
+
+    if not valid.any():
+        return None
+    lowest = int(elevation[valid].min() // band_size)
+    bands = (elevation[valid] // band_size).astype(np.int64) - lowest
+    pixels = np.bincount(bands)
+    snowy = np.bincount(bands, weights=snow[valid])
+
+    num, den = fraction
+    kept = np.flatnonzero(pixels >= MIN_BAND_PIXELS)
+    above = snowy[kept] * den > pixels[kept] * num
+    # Number of consecutive snowy bands from the top
+    top_snowy = len(above) if above.all() else int(np.argmin(above[::-1]))
+    if top_snowy == 0:
+        return None
+
+    return float((kept[len(kept) - top_snowy] + lowest) * band_size)
+
+
+def read_resampled(src, window_bounds, shape, resampling_name="nearest"):
+    """Read the first band of a raster over bounds resampled to shape, pixels outside it are 0"""
+    from rasterio.enums import Resampling
+    from rasterio.windows import from_bounds
+
+    window = from_bounds(*window_bounds, transform=src.transform)
+
+    return src.read(
+        1, window=window, out_shape=shape, resampling=Resampling[resampling_name], boundless=True, fill_value=0
+    )
+
+
+def snow_stats(zones, out_path, name, dem_path=None, threshold=NDSI_THRESHOLD):
+    """
+    Compute snow of all zones of a product, green, SWIR and DEM rasters being opened once.
+    SWIR and DEM are resampled on the 10m green grid of each zone window.
+
+    :param name: EO product id, its processing baseline gives the radiometric offset.
+    :param dem_path: Path of a DEM raster in any crs to estimate the snow line, optional.
+    :return: Dict of zone name and dict of snow pixels, valid pixels, snow fraction and
+        snow line altitude (None without DEM), None when the product has no SWIR band.
+    """
+    import numpy as np
+    import rasterio as rio
+    from rasterio.warp import Resampling, reproject
+    from rasterio.windows import bounds as window_bounds
+    from rasterio.windows import transform as window_transform
+
+    green_path, swir_path = find_band_img(out_path, GREEN_BAND), find_band_img(out_path, SWIR_BAND)
+    if green_path is None or swir_path is None:
+        logging.warning("No %s and %s bands in %s, snow is not computed", GREEN_BAND, SWIR_BAND, out_path)
+        return None
+
+    offset = radiometric_offset(name)
+    stats = {}
+    with rio.open(green_path) as green_src, rio.open(swir_path) as swir_src:
+        dem_src = rio.open(dem_path) if dem_path is not None else None
+        try:
+            for zone in zones:
+                window, outside = zone_pixels(
+                    zone, str(green_src.crs), green_src.transform, green_src.width, green_src.height
+                )
+                bounds = window_bounds(window, green_src.transform)
+                green = green_src.read(1, window=window)
+                swir = read_resampled(swir_src, bounds, green.shape)
+                valid = ~outside & (green > 0) & (swir > 0)
+                remove_offset(green, offset)
+                remove_offset(swir, offset)
+
+                snow = snow_mask(green, swir, threshold) & valid
+                snow_pixels, valid_pixels = int(snow.sum()), int(valid.sum())
+                zone_stats = {
+                    "snow_pixels": snow_pixels,
+                    "valid_pixels": valid_pixels,
+                    "snow_fraction": round(snow_pixels / valid_pixels, 4) if valid_pixels else None,
+                    "snow_line": None,
+                }
+
+                if dem_src is not None:
+                    elevation = np.full(green.shape, np.nan, dtype=np.float32)
+                    reproject(
+                        rio.band(dem_src, 1), elevation, dst_transform=window_transform(window, green_src.transform),
+                        dst_crs=green_src.crs, resampling=Resampling.bilinear, dst_nodata=float("nan"),
+                    )
+                    zone_stats["snow_line"] = snow_line(snow, elevation, valid & ~np.isnan(elevation))
+
+                logging.info("Snow fraction of %s zone: %s", zone, zone_stats["snow_fraction"])
+                stats[zone] = zone_stats
+        finally:
+            if dem_src is not None:
+                dem_src.close()
+
+    return stats
@@ -0,0 +1,279 @@
+"""
+This module stages downloads in the output dirpath so that interrupted ones are resumed
+and only complete and verified products are published next to zone images
+"""
+# pylint: disable=import-error,import-outside-toplevel
+import datetime
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+STAGING_DIR = ".staging"
+RECORDS_DIR = ".downloads"
+PART_SUFFIX = ".part"
+CHUNK_SIZE = 1024 * 1024
+# Multihash codes of the hash functions used by the STAC file:checksum field
+MULTIHASH_ALGORITHMS = {0x11: "sha1", 0x12: "sha256", 0x13: "sha512", 0xD5: "md5"}
+
+
+def read_varint(data, index):
+    """Read an unsigned varint of a multihash, return its value and the index after it"""
+    value, shift = 0, 0
+    while True:
+        byte = data[index]
+        value |= (byte & 0x7F) << shift
+        index += 1
+        if not byte & 0x80:
+            return value, index
+        shift += 7
+
+
+def parse_multihash(multihash):
+    """
+    Return the hashlib algorithm and hex digest of a multihash hex string,
+    None when it is malformed or its hash function is not supported
+    """
+    try:
+        data = bytes.fromhex(multihash)
+        code, index = read_varint(data, 0)
+        length, index = read_varint(data, index)
+    except (ValueError, IndexError):
+        return None
+
+    if code not in MULTIHASH_ALGORITHMS or len(data) - index != length:
+        return None
+
+    return MULTIHASH_ALGORITHMS[code], data[index:].hex()
+
+
+def asset_checksum(asset):
+    """Return the expected (algorithm, hex digest) of a STAC asset, None if the provider does not give it"""
+    multihash = asset.get("file:checksum")
+
+    return None if multihash is None else parse_multihash(multihash)
+
+
+def file_digest(path, algorithm):
+    """Return the hex digest of a file read by chunks"""
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def verify_part(part, size=None, checksum=None):
+    """
+    Check a downloaded part against its expected size and checksum, a part with a wrong
+    checksum or too large is removed to restart its download from scratch
+
+    :raise IOError: When the part is incomplete, it is kept to be resumed.
+    :raise ValueError: When the part is corrupted.
+    """
+    part_size = os.path.getsize(part)
+    if size is not None and part_size < size:
+        raise IOError(f"Download of {part} interrupted at {part_size} of {size} bytes")
+    if size is not None and part_size > size:
+        os.remove(part)
+        raise ValueError(f"Download of {part} has {part_size} bytes instead of {size}")
+
+    if checksum is not None:
+        algorithm, expected = checksum
+        if file_digest(part, algorithm) != expected:
+            os.remove(part)
+            raise ValueError(f"Download of {part} does not match its {algorithm} checksum")
+
+
+def product_auth(final_img):
+    """Return the requests authentication of the provider of an EO product, None if it has none"""
+    from requests.auth import AuthBase
+
+    downloader_auth = getattr(final_img, "downloader_auth", None)
+    auth = None if downloader_auth is None else downloader_auth.authenticate()
+
+    return auth if isinstance(auth, AuthBase) else None
+
+
+def gdal_auth(href, auth=None):
+    """
+    Return the href and GDAL options sending the requests authentication of a provider,
+    so that GDAL reads assets of providers requiring it
+
+    :return: Tuple of the href, signed when the authentication adds query parameters,
+        and the dict of GDAL options to pass to rasterio.Env.
+    """
+    if auth is None:
+        return href, {}
+
+    import requests
+
+    request = auth(requests.Request("GET", href).prepare())
+    authorization = request.headers.get("Authorization")
+
+    return request.url, {} if authorization is None else {"GDAL_HTTP_HEADERS": f"Authorization: {authorization}"}
+
+
+def fetch_resumable(href, dest, auth=None, size=None, checksum=None, timeout=60):
+    """
+    Download a file over HTTP to a part file next to dest, resumed with a range request
+    when a part is left by an interrupted run, and renamed to dest once verified
+
+    :param auth: Requests authentication of the provider.
+    :param size: Expected size in bytes, if known.
+    :param checksum: Expected (algorithm, hex digest), see asset_checksum.
+    :return: dest
+    """
+    import requests
+
+    part = dest + PART_SUFFIX
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+
+    if size is None or offset < size:
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        with requests.get(href, headers=headers, auth=auth, stream=True, timeout=timeout) as response:
+            # A range starting at the end of a complete part is not satisfiable
+            if response.status_code != 416:
+                response.raise_for_status()
+                if offset and response.status_code != 206:
+                    logging.info("Range requests not supported for %s, restart its download", href)
+                    offset = 0
+                elif offset:
+                    logging.info("Resume download of %s from %s bytes", href, offset)
+
+                with open(part, "ab" if offset else "wb") as part_file:
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        part_file.write(chunk)
+                    part_file.flush()
+                    os.fsync(part_file.fileno())
+
+    verify_part(part, size=size, checksum=checksum)
+    os.replace(part, dest)
+
+    return dest
+
+
+def record_path(outdir, product_id):
+    """Return the path of the record of a published product"""
+    return os.path.join(outdir, RECORDS_DIR, f"{product_id}.json")
+
+
+def published_path(outdir, product_id):
+    """Return the path of a product downloaded completely by a previous run, None if there is none"""
+    try:
+        with open(record_path(outdir, product_id), encoding="utf-8") as record:
+            path = os.path.join(outdir, json.load(record)["path"])
+    except FileNotFoundError:
+        return None
+
+    return path if os.path.exists(path) else None
+
+
+def publish(outdir, staged_path, product_id):
+    """
+    Move a complete download from the staging dirpath to outdir with an atomic rename
+    and record where it is
+
+    :param staged_path: Path returned by the download, inside the staging dirpath.
+    :return: Path of the download in outdir.
+    """
+    relative_path = os.path.relpath(staged_path, os.path.join(outdir, STAGING_DIR))
+    top = relative_path.split(os.sep)[0]
+    # Left by a run which did not stage its downloads
+    if os.path.isdir(os.path.join(outdir, top)):
+        shutil.rmtree(os.path.join(outdir, top))
+    elif os.path.exists(os.path.join(outdir, top)):
+        os.remove(os.path.join(outdir, top))
+    os.replace(os.path.join(outdir, STAGING_DIR, top), os.path.join(outdir, top))
+
+    os.makedirs(os.path.join(outdir, RECORDS_DIR), exist_ok=True)
+    record = record_path(outdir, product_id)
+    with open(record + PART_SUFFIX, "w", encoding="utf-8") as record_file:
+        json.dump({"path": relative_path}, record_file)
+    os.replace(record + PART_SUFFIX, record)
+
+    return os.path.join(outdir, relative_path)
+
+
+def staged_download(dag, product, outdir, **kwargs):
+    """
+    Download a product with eodag in the staging dirpath and publish it once complete
+
+    :param kwargs: Other parameters of dag.download, e.g. the asset filter.
+    """
+    staging_dir = os.path.join(outdir, STAGING_DIR)
+    os.makedirs(staging_dir, exist_ok=True)
+    staged_path = dag.download(product=product, outputs_prefix=staging_dir, **kwargs)
+
+    return publish(outdir, staged_path, product.properties["id"])
+
+
+def staged_fetch(href, outdir, product_id, file_name, **kwargs):
+    """
+    Download a single asset of a product in the staging dirpath with resume and checksum
+    verification, and publish it in a directory named after the product
+
+    :param file_name: Name of the asset file, hrefs of some providers do not end with it.
+    :param kwargs: Authentication, size and checksum, see fetch_resumable.
+    """
+    staged_dir = os.path.join(outdir, STAGING_DIR, product_id)
+    os.makedirs(staged_dir, exist_ok=True)
+    fetch_resumable(href, os.path.join(staged_dir, file_name), **kwargs)
+
+    return publish(outdir, staged_dir, product_id)
+
+
+def remove_published(outdir):
+    """Remove products published by downloads, once their zones are cropped, and their records"""
+    records_dir = os.path.join(outdir, RECORDS_DIR)
+    if not os.path.isdir(records_dir):
+        return
+
+    for obj in os.listdir(records_dir):
+        if not obj.endswith(".json"):
+            continue
+        path = published_path(outdir, obj[: -len(".json")])
+        if path is not None:
+            top = os.path.join(outdir, os.path.relpath(path, outdir).split(os.sep)[0])
+            logging.info("Remove full product folder %s", os.path.basename(top))
+            if os.path.isdir(top):
+                shutil.rmtree(top)
+            else:
+                os.remove(top)
+        os.remove(os.path.join(records_dir, obj))
+
+
+def clean_legacy(outdir, min_date):
+    """
+    Remove product folders downloaded in outdir before downloads were staged, which have
+    no record and are never reused, once they were sensed before min_date
+    """
+    for obj in os.listdir(outdir):
+        path_obj = os.path.join(outdir, obj)
+        if not obj.startswith("S2") or not os.path.isdir(path_obj):
+            continue
+        try:
+            sensing_date = datetime.datetime.strptime(obj.split("_")[2].split("T")[0], "%Y%m%d").date()
+        except (IndexError, ValueError):
+            continue
+        if sensing_date < min_date:
+            logging.info("Remove legacy product folder %s", obj)
+            shutil.rmtree(path_obj)
+
+
+def clean_staging(outdir, min_date):
+    """Remove staged downloads not resumed since min_date"""
+    staging_dir = os.path.join(outdir, STAGING_DIR)
+    if not os.path.isdir(staging_dir):
+        return
+
+    for obj in os.listdir(staging_dir):
+        path_obj = os.path.join(staging_dir, obj)
+        if datetime.date.fromtimestamp(os.path.getmtime(path_obj)) < min_date:
+            logging.info("Remove stale staged download %s", obj)
+            if os.path.isdir(path_obj):
+                shutil.rmtree(path_obj)
+            else:
+                os.remove(path_obj)
@@ -0,0 +1,226 @@
+"""
+This module renders zone crops into Web Mercator tile pyramids, written as XYZ static
+files or MBTiles archives, and only encodes and writes tiles whose content changed
+"""
+# pylint: disable=import-error,import-outside-toplevel
+import hashlib
+import io
+import logging
+import math
+import os
+
+from LookPyrenees.utils import sqlite_connect
+
+TILES_DIR = "tiles"
+TILES_INDEX = "tiles.sqlite"
+TILE_FORMATS = ["xyz", "mbtiles"]
+TILE_SIZE = 256
+# Number of zoom levels rendered below the zoom of the native resolution
+OVERVIEW_LEVELS = 5
+# Half of the extent of Web Mercator in meters
+MERCATOR_ORIGIN = 20037508.342789244
+
+
+def tile_span(zoom):
+    """Return the width in Web Mercator meters of a tile at zoom"""
+    return 2 * MERCATOR_ORIGIN / 2 ** zoom
+
+
+def native_zoom(resolution, latitude):
+    """Return the lowest zoom whose pixels are as fine as a resolution in meters at a latitude"""
+    return math.ceil(math.log2(tile_span(0) * math.cos(math.radians(latitude)) / (TILE_SIZE * resolution)))
+
+
+def tile_range(bounds, zoom):
+    """
+    Return the tiles covering bounds in Web Mercator at zoom
+
+    :return: Tuple (first column, first row, last column, last row), last ones included.
+    """
+    left, bottom, right, top = bounds
+    span = tile_span(zoom)
+    last = 2 ** zoom - 1
+
+    return (
+        max(0, math.floor((left + MERCATOR_ORIGIN) / span)),
+        max(0, math.floor((MERCATOR_ORIGIN - top) / span)),
+        min(last, math.ceil((right + MERCATOR_ORIGIN) / span) - 1),
+        min(last, math.ceil((MERCATOR_ORIGIN - bottom) / span) - 1),
+    )
+
+
+def render_level(raster, transform, crs, bounds, zoom, resampling_name="average"):
+    """
+    Reproject a crop on the tiles covering it at zoom in one pass
+
+    :param raster: (3, height, width) uint8 array, 0 outside the zone.
+    :param bounds: Bounds of the crop in Web Mercator.
+    :return: Dict of (zoom, column, row) and (TILE_SIZE, TILE_SIZE, 4) RGBA array.
+    """
+    import numpy as np
+    from rasterio.enums import Resampling
+    from rasterio.transform import from_origin
+    from rasterio.warp import reproject
+
+    first_col, first_row, last_col, last_row = tile_range(bounds, zoom)
+    span = tile_span(zoom)
+    level = np.zeros(
+        (raster.shape[0], (last_row - first_row + 1) * TILE_SIZE, (last_col - first_col + 1) * TILE_SIZE),
+        dtype=raster.dtype,
+    )
+    reproject(
+        raster, level, src_transform=transform, src_crs=crs, src_nodata=0,
+        dst_transform=from_origin(
+            first_col * span - MERCATOR_ORIGIN, MERCATOR_ORIGIN - first_row * span, span / TILE_SIZE, span / TILE_SIZE
+        ),
+        dst_crs="EPSG:3857", dst_nodata=0, resampling=Resampling[resampling_name],
+    )
+    alpha = np.where(level.any(axis=0), 255, 0).astype(np.uint8)
+    rgba = np.concatenate([level, alpha[np.newaxis]]).transpose(1, 2, 0)
+
+    return {
+        (zoom, col, row): rgba[
+            (row - first_row) * TILE_SIZE:(row - first_row + 1) * TILE_SIZE,
+            (col - first_col) * TILE_SIZE:(col - first_col + 1) * TILE_SIZE,
+        ]
+        for row in range(first_row, last_row + 1)
+        for col in range(first_col, last_col + 1)
+    }
+
+
+def tile_digest(rgba):
+    """Return the digest of the pixels of a tile, compared before encoding it"""
+    return hashlib.blake2b(rgba.tobytes(), digest_size=16).hexdigest()
+
+
+def encode_tile(rgba):
+    """Encode an RGBA tile to PNG bytes"""
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.fromarray(rgba, mode="RGBA").save(buffer, format="PNG", optimize=True)
+
+    return buffer.getvalue()
+
+
+def changed_tiles(raster, transform, crs, digests=None, overview_levels=OVERVIEW_LEVELS):
+    """
+    Render the tile pyramid of a zone crop from its native zoom down to its overviews,
+    each level being reprojected from the crop so that memory scales with the zone,
+    and encode the tiles whose pixels differ from digests. Run in a worker process.
+
+    :param digests: Dict of (zoom, column, row) and digest of tiles already written.
+    :return: Dict of (zoom, column, row) and tuple (digest, PNG bytes) of changed tiles.
+    """
+    from rasterio.transform import array_bounds
+    from rasterio.warp import transform_bounds
+
+    digests = digests or {}
+    crop_bounds = array_bounds(raster.shape[1], raster.shape[2], transform)
+    bounds = transform_bounds(crs, "EPSG:3857", *crop_bounds)
+    _, south, _, north = transform_bounds(crs, "EPSG:4326", *crop_bounds)
+    max_zoom = native_zoom(abs(transform.a), (south + north) / 2)
+
+    changed = {}
+    for zoom in range(max_zoom, max_zoom - overview_levels - 1, -1):
+        resampling_name = "bilinear" if zoom == max_zoom else "average"
+        for key, rgba in render_level(raster, transform, crs, bounds, zoom, resampling_name).items():
+            digest = tile_digest(rgba)
+            if digests.get(key) != digest:
+                changed[key] = (digest, encode_tile(rgba))
+
+    return changed
+
+
+class TileStore:
+    """
+    Tile pyramids of zones in the tiles directory of an output dirpath, as XYZ static files
+    or one MBTiles archive per zone, with an SQLite index of the digest of each tile and of
+    the sensing time shown by each pyramid so that an older crop never replaces a newer one
+    """
+
+    def __init__(self, outdir, tile_format="xyz"):
+        if tile_format not in TILE_FORMATS:
+            raise ValueError(f"This tile format {tile_format} does not exist")
+
+        self.tile_format = tile_format
+        self.tiles_dir = os.path.join(str(outdir), TILES_DIR)
+        self.index_path = os.path.join(self.tiles_dir, TILES_INDEX)
+        os.makedirs(self.tiles_dir, exist_ok=True)
+        with sqlite_connect(self.index_path) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS digests (zone TEXT NOT NULL, zoom INTEGER NOT NULL, col INTEGER NOT NULL, "
+                "row INTEGER NOT NULL, digest TEXT NOT NULL, PRIMARY KEY (zone, zoom, col, row))"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS pyramids (zone TEXT PRIMARY KEY, sensing_time TEXT NOT NULL)")
+
+    def digests(self, zone):
+        """Return the digest of each tile of the pyramid of a zone"""
+        with sqlite_connect(self.index_path) as conn:
+            rows = conn.execute("SELECT zoom, col, row, digest FROM digests WHERE zone = ?", (zone,))
+            return {(zoom, col, row): digest for zoom, col, row, digest in rows}
+
+    def tile_path(self, zone, zoom, col, row):
+        """Return the path of an XYZ tile"""
+        return os.path.join(self.tiles_dir, zone, str(zoom), str(col), f"{row}.png")
+
+    def mbtiles_path(self, zone):
+        """Return the path of the MBTiles archive of a zone"""
+        return os.path.join(self.tiles_dir, f"{zone}.mbtiles")
+
+    def write_xyz(self, zone, tiles):
+        """Write tiles as static files, each one replaced atomically"""
+        for (zoom, col, row), (_, content) in tiles.items():
+            path = self.tile_path(zone, zoom, col, row)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(f"{path}.part", "wb") as tile:
+                tile.write(content)
+            os.replace(f"{path}.part", path)
+
+    def write_mbtiles(self, zone, tiles):
+        """Write tiles in the MBTiles archive of a zone, whose rows are numbered from the south"""
+        with sqlite_connect(self.mbtiles_path(zone)) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, "
+                "tile_data BLOB, PRIMARY KEY (zoom_level, tile_column, tile_row))"
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)",
+                [(zoom, col, 2 ** zoom - 1 - row, content) for (zoom, col, row), (_, content) in tiles.items()],
+            )
+            zooms = [zoom for (zoom,) in conn.execute("SELECT DISTINCT zoom_level FROM tiles")]
+            conn.executemany(
+                "INSERT OR REPLACE INTO metadata VALUES (?, ?)",
+                [("name", zone), ("format", "png"), ("type", "overlay"), ("minzoom", str(min(zooms))),
+                 ("maxzoom", str(max(zooms)))],
+            )
+
+    def write(self, zone, sensing_time, tiles):
+        """
+        Write the changed tiles of the pyramid of a zone unless it already shows a newer crop
+
+        :param sensing_time: Sensing time of the crop as an ISO string.
+        :param tiles: Dict of (zoom, column, row) and tuple (digest, PNG bytes), see changed_tiles.
+        :return: Number of tiles written.
+        """
+        with sqlite_connect(self.index_path) as conn:
+            row = conn.execute("SELECT sensing_time FROM pyramids WHERE zone = ?", (zone,)).fetchone()
+        if row is not None and row[0] > sensing_time:
+            logging.info("Tiles of %s zone already show a crop newer than %s", zone, sensing_time)
+            return 0
+
+        if self.tile_format == "xyz":
+            self.write_xyz(zone, tiles)
+        elif tiles:
+            self.write_mbtiles(zone, tiles)
+
+        with sqlite_connect(self.index_path) as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?)",
+                [(zone, *key, digest) for key, (digest, _) in tiles.items()],
+            )
+            conn.execute("INSERT OR REPLACE INTO pyramids VALUES (?, ?)", (zone, sensing_time))
+        logging.info("Wrote %s changed tiles of %s zone", len(tiles), zone)
+
+        return len(tiles)
@@ -0,0 +1,14 @@
+"""This module gathers small helpers shared by the modules of the package"""
+import sqlite3
+from contextlib import contextmanager
+
+
+@contextmanager
+def sqlite_connect(path):
+    """Open a connection to an SQLite database, committed and closed on exit"""
+    conn = sqlite3.connect(path)
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
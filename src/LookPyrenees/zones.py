@@ -0,0 +1,128 @@
+"""This module loads zones of Pyrenees once and caches their geometries, reprojections and pixel windows"""
+# pylint: disable=import-error,import-outside-toplevel
+import math
+from functools import lru_cache
+from importlib.resources import files
+
+RESSOURCES_DIR = files("LookPyrenees") / "ressources"
+ZONES_FILE = "zone_4326.shp"
+SEARCH_FILE = "pyrenees.shp"
+
+
+@lru_cache(maxsize=None)
+def zones_extent():
+    """Return the GeoDataFrame of all zones, read once from the package resources"""
+    import geopandas as gpd
+
+    return gpd.read_file(str(RESSOURCES_DIR / ZONES_FILE))
+
+
+@lru_cache(maxsize=None)
+def search_geometry():
+    """Return the geometry of the whole Pyrenees used to search EO products"""
+    import geopandas as gpd
+
+    return gpd.read_file(str(RESSOURCES_DIR / SEARCH_FILE)).geometry[0]
+
+
+def zone_names():
+    """Return the names of all zones"""
+    return zones_extent().NAME.to_list()
+
+
+@lru_cache(maxsize=None)
+def zone_crop(zone):
+    """Return the GeoDataFrame crop extent of a zone"""
+    crop_extent = zones_extent()
+    if zone not in crop_extent.NAME.to_list():
+        raise ValueError(f"This zone {zone} does not exist")
+
+    return crop_extent[crop_extent.NAME == zone].reset_index(drop=True)
+
+
+@lru_cache(maxsize=None)
+def prepared_zone(zone):
+    """Return the shapely geometry of a zone prepared for repeated predicates"""
+    import shapely
+
+    geometry = zone_crop(zone).geometry[0]
+    shapely.prepare(geometry)
+
+    return geometry
+
+
+@lru_cache(maxsize=None)
+def reprojected_zone(zone, crs):
+    """Return the GeoSeries of a zone reprojected to a crs given as a string"""
+    return zone_crop(zone).to_crs(crs).geometry
+
+
+def snapped_window(zone_geometry, transform):
+    """
+    Compute the window which covers the bounding box of a zone geometry expressed
+    in the raster crs, snapped outwards to whole pixels, possibly outside the raster
+    """
+    from rasterio.windows import Window, from_bounds
+
+    window = from_bounds(*zone_geometry.total_bounds, transform=transform)
+    col_off, row_off = math.floor(window.col_off), math.floor(window.row_off)
+    col_end = math.ceil(window.col_off + window.width)
+    row_end = math.ceil(window.row_off + window.height)
+
+    return Window(col_off, row_off, col_end - col_off, row_end - row_off)
+
+
+def pixel_window(zone_geometry, transform, width, height):
+    """
+    Compute the raster window which covers the bounding box of a zone geometry
+    expressed in the raster crs, snapped outwards to whole pixels
+    """
+    from rasterio.windows import Window
+
+    return snapped_window(zone_geometry, transform).intersection(Window(0, 0, width, height))
+
+
+@lru_cache(maxsize=None)
+def zone_pixels(zone, crs, transform, width, height):
+    """
+    Return the window of a zone on a raster grid and the mask of its pixels outside
+    the zone polygon, computed once per tile grid
+
+    :param crs: Crs of the raster as a string.
+    :param transform: Affine transform of the raster.
+    :return: Tuple of the window and a read-only boolean array, True outside the zone.
+    """
+    from rasterio.features import geometry_mask
+    from rasterio.windows import transform as window_transform
+
+    zone_geometry = reprojected_zone(zone, crs)
+    window = pixel_window(zone_geometry, transform, width, height)
+    outside = geometry_mask(
+        zone_geometry, out_shape=(window.height, window.width), transform=window_transform(window, transform)
+    )
+    outside.flags.writeable = False
+
+    return window, outside
+
+
+@lru_cache(maxsize=None)
+def zone_grid(zone, crs, transform):
+    """
+    Return the grid of a zone aligned on the pixels of a raster but not clipped to its
+    extent, to merge rasters of adjacent tiles, and the mask of its pixels outside the zone polygon
+
+    :param crs: Crs of the raster as a string.
+    :param transform: Affine transform of the raster.
+    :return: Tuple of the transform, width and height of the grid and a read-only boolean
+        array, True outside the zone.
+    """
+    from rasterio.features import geometry_mask
+    from rasterio.windows import transform as window_transform
+
+    zone_geometry = reprojected_zone(zone, crs)
+    window = snapped_window(zone_geometry, transform)
+    grid_transform = window_transform(window, transform)
+    outside = geometry_mask(zone_geometry, out_shape=(window.height, window.width), transform=grid_transform)
+    outside.flags.writeable = False
+
+    return grid_transform, window.width, window.height, outside
@@ -0,0 +1,163 @@
+"""Local fake of the google cloud storage JSON API to test bucket operations offline"""
+import json
+import re
+import threading
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+BUCKET_PATH = re.compile(r"^/storage/v1/b/(?P<bucket>[^/]+)$")
+OBJECT_PATH = re.compile(r"^/storage/v1/b/(?P<bucket>[^/]+)/o/(?P<name>.+)$")
+LIST_PATH = re.compile(r"^/storage/v1/b/(?P<bucket>[^/]+)/o$")
+MEDIA_PATH = re.compile(r"^/download/storage/v1/b/(?P<bucket>[^/]+)/o/(?P<name>.+)$")
+UPLOAD_PATH = re.compile(r"^/upload/storage/v1/b/(?P<bucket>[^/]+)/o$")
+BATCH_PATH = "/batch/storage/v1"
+BATCH_BOUNDARY = "batch_fake_gcs"
+
+
+class FakeGCSHandler(BaseHTTPRequestHandler):
+    """Handle the subset of requests made by LookPyrenees.manage_bucket"""
+
+    def log_message(self, *_):
+        """Keep test output quiet"""
+
+    def send_json(self, status, body=None):
+        """Write a JSON response"""
+        data = b"" if body is None else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_not_found(self):
+        """Write a JSON error as returned by GCS"""
+        self.send_json(404, {"error": {"code": 404, "message": "No such object"}})
+
+    def route(self):
+        """Split the request path and query"""
+        url = urlparse(self.path)
+        self.server.requests.append((self.command, url.path))
+        return url.path, {key: values[0] for key, values in parse_qs(url.query).items()}
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Get metadata, content or listing of objects"""
+        path, query = self.route()
+        blobs = self.server.blobs
+
+        if match := BUCKET_PATH.match(path):
+            self.send_json(200, {"kind": "storage#bucket", "name": match["bucket"]})
+        elif match := LIST_PATH.match(path):
+            prefix = query.get("prefix", "")
+            items = [self.server.metadata(name) for name in sorted(blobs) if name.startswith(prefix)]
+            self.send_json(200, {"kind": "storage#objects", "items": items})
+        elif match := MEDIA_PATH.match(path):
+            name = unquote(match["name"])
+            if name not in blobs:
+                self.send_not_found()
+                return
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(blobs[name])))
+            self.end_headers()
+            self.wfile.write(blobs[name])
+        elif match := OBJECT_PATH.match(path):
+            name = unquote(match["name"])
+            if name not in blobs:
+                self.send_not_found()
+                return
+            if query.get("alt") == "media":
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(blobs[name])
+                return
+            self.send_json(200, self.server.metadata(name))
+        else:
+            self.send_not_found()
+
+    def send_batch(self, body):
+        """Apply the deletions of a batch request and write one HTTP response per deletion"""
+        message = BytesParser().parsebytes(f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body)
+        parts = []
+        for content_id, part in enumerate(message.get_payload(), 1):
+            method, uri, _ = part.get_payload().splitlines()[0].split(" ")
+            match = OBJECT_PATH.match(urlparse(uri).path)
+            if method == "DELETE" and match is not None and self.server.delete(unquote(match["name"])):
+                status = "204 No Content\r\n\r\n"
+            else:
+                status = "404 Not Found\r\nContent-Type: application/json\r\n\r\n" + json.dumps(
+                    {"error": {"code": 404, "message": "No such object"}}
+                )
+            parts.append(
+                f"--{BATCH_BOUNDARY}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status}\r\n"
+            )
+        data = ("".join(parts) + f"--{BATCH_BOUNDARY}--\r\n").encode()
+
+        self.send_response(200)
+        self.send_header("Content-Type", f"multipart/mixed; boundary={BATCH_BOUNDARY}")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """Upload an object with a multipart request, or apply a batch of deletions"""
+        path, query = self.route()
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+
+        if path == BATCH_PATH:
+            self.send_batch(body)
+        elif UPLOAD_PATH.match(path):
+            message = BytesParser().parsebytes(
+                f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode() + body
+            )
+            metadata_part, media_part = message.get_payload()
+            name = json.loads(metadata_part.get_payload())["name"]
+            if query.get("ifGenerationMatch") == "0" and name in self.server.blobs:
+                self.send_json(412, {"error": {"code": 412, "message": "Precondition Failed"}})
+                return
+            self.server.blobs[name] = media_part.get_payload(decode=True)
+            self.send_json(200, self.server.metadata(name))
+        else:
+            self.send_not_found()
+
+    def do_DELETE(self):  # pylint: disable=invalid-name
+        """Delete an object"""
+        path, _ = self.route()
+        match = OBJECT_PATH.match(path)
+        if match is None or not self.server.delete(unquote(match["name"])):
+            self.send_not_found()
+            return
+        self.send_response(204)
+        self.end_headers()
+
+
+class FakeGCSServer(ThreadingHTTPServer):
+    """Fake GCS server running in a thread, blobs of all buckets are kept in one dict"""
+
+    def __init__(self, blobs=None):
+        super().__init__(("127.0.0.1", 0), FakeGCSHandler)
+        self.blobs = dict(blobs or {})
+        self.requests = []
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        """Endpoint to give to the storage client"""
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def delete(self, name):
+        """Delete an object, False if it does not exist"""
+        return self.blobs.pop(name, None) is not None
+
+    def metadata(self, name):
+        """Build the JSON resource of an object"""
+        return {"kind": "storage#object", "name": name, "bucket": "fake", "generation": "1",
+                "size": str(len(self.blobs[name]))}
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
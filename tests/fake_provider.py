@@ -0,0 +1,316 @@
+"""Local fake of an EO provider serving synthetic Sentinel-2 products to run the workflow offline"""
+import datetime
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+import rasterio as rio
+from eodag.api.product import EOProduct
+from eodag.api.search_result import SearchResult
+from pyproj import Transformer
+from rasterio.transform import from_origin
+from shapely.geometry import Polygon, box, mapping, shape
+
+FAKE_TILE = "T31TCH"
+# Upper left corner and size in meters of synthetic TCI images, covering all zones of the tile
+FAKE_ORIGIN = (362000, 4750000)
+FAKE_SIZE = (60000, 45000)
+# Synthetic bands are snowy north of this northing, where the synthetic DEM is at 1250 m
+FAKE_SNOW_NORTHING = 4725000
+# Resolution factor of bands and their reflectances of snow and bare ground, with the offset of baseline 04.00
+FAKE_BANDS = {"B03": (1, 7000, 4000), "B11": (2, 2500, 3500)}
+RANGE_HEADER = re.compile(r"^bytes=(?P<start>\d+)-(?P<end>\d*)$")
+
+
+def fake_product_name(date, tile=FAKE_TILE, level="L2A"):
+    """Build a Sentinel-2 product name sensed at date"""
+    return f"S2B_MSI{level}_{date:%Y%m%d}T103629_N0510_R008_{tile}_{date:%Y%m%d}T121256"
+
+
+def write_band(path, data, resolution, driver="JP2OpenJPEG"):
+    """Write a one band raster on the grid of synthetic products"""
+    with rio.open(
+            path,
+            "w",
+            driver=driver,
+            height=data.shape[0],
+            width=data.shape[1],
+            count=1,
+            dtype=data.dtype,
+            crs="EPSG:32631",
+            transform=from_origin(*FAKE_ORIGIN, resolution, resolution),
+    ) as dst:
+        dst.write(data, 1)
+
+
+def northings(resolution):
+    """Return the northing of pixel centres of each row of synthetic rasters as a column"""
+    return FAKE_ORIGIN[1] - resolution * (np.arange(FAKE_SIZE[1] // resolution)[:, np.newaxis] + 0.5)
+
+
+def make_fake_dem(path, resolution=100):
+    """Write a synthetic DEM rising by 50 m every km northwards, 1250 m at FAKE_SNOW_NORTHING"""
+    elevation = 1250 + (northings(resolution) - FAKE_SNOW_NORTHING) / 20
+    write_band(path, np.repeat(elevation, FAKE_SIZE[0] // resolution, axis=1).astype(np.float32), resolution, "GTiff")
+
+    return path
+
+
+def make_fake_scl(path, resolution=60):
+    """Write a synthetic scene classification layer, high probability clouds north of FAKE_SNOW_NORTHING"""
+    classes = np.where(northings(resolution) > FAKE_SNOW_NORTHING, 9, 4).astype(np.uint8)
+    write_band(path, np.repeat(classes, FAKE_SIZE[0] // resolution, axis=1), resolution, "GTiff")
+
+    return path
+
+
+def make_fake_product(outdir, name, resolution=60, bands=False, bounds=None):
+    """
+    Write a synthetic SAFE product with a TCI image covering the zones of T31TCH
+
+    :param bands: Also write B03 and B11 bands at resolution and twice resolution, with
+        reflectances of snow north of FAKE_SNOW_NORTHING and of bare ground south of it.
+    :param bounds: (left, bottom, right, top) of the TCI image in EPSG:32631 to write only
+        a part of it, as a tile adjacent to others, with the same pixel values.
+    """
+    tile, date = name.split("_")[5], name.split("_")[2]
+    img_dir = Path(outdir, name, f"{name}.SAFE", "GRANULE", f"L2A_{tile}", "IMG_DATA", "R10m")
+    img_dir.mkdir(parents=True, exist_ok=True)
+
+    width, height = FAKE_SIZE[0] // resolution, FAKE_SIZE[1] // resolution
+    data = np.random.default_rng(0).integers(1, 255, (3, height, width), dtype=np.uint8)
+    left, top = FAKE_ORIGIN
+    if bounds is not None:
+        left, top = bounds[0], bounds[3]
+        col, row = (left - FAKE_ORIGIN[0]) // resolution, (FAKE_ORIGIN[1] - top) // resolution
+        data = data[:, row:(FAKE_ORIGIN[1] - bounds[1]) // resolution, col:(bounds[2] - FAKE_ORIGIN[0]) // resolution]
+        height, width = data.shape[1:]
+    with rio.open(
+            img_dir / f"{tile}_{date}_TCI_10m.jp2",
+            "w",
+            driver="JP2OpenJPEG",
+            height=height,
+            width=width,
+            count=3,
+            dtype="uint8",
+            crs="EPSG:32631",
+            transform=from_origin(left, top, resolution, resolution),
+            # Lossless so that pixels of parts of the image are the same
+            reversible=True,
+            quality=100,
+    ) as dst:
+        dst.write(data)
+
+    if bands:
+        for band, (scale, snow, ground) in FAKE_BANDS.items():
+            band_dir = img_dir.parent / f"R{10 * scale}m"
+            band_dir.mkdir(exist_ok=True)
+            reflectance = np.where(northings(scale * resolution) > FAKE_SNOW_NORTHING, snow, ground)
+            write_band(
+                band_dir / f"{tile}_{date}_{band}_{10 * scale}m.jp2",
+                np.repeat(reflectance.astype(np.uint16), FAKE_SIZE[0] // (scale * resolution), axis=1),
+                scale * resolution,
+            )
+
+    return str(Path(outdir, name, f"{name}.SAFE"))
+
+
+def fake_footprint(bounds=None):
+    """Return the footprint in EPSG:4326 of synthetic products, or of the part of them within bounds"""
+    utm_box = box(FAKE_ORIGIN[0], FAKE_ORIGIN[1] - FAKE_SIZE[1], FAKE_ORIGIN[0] + FAKE_SIZE[0], FAKE_ORIGIN[1])
+    utm_box = utm_box if bounds is None else box(*bounds)
+    to_wgs84 = Transformer.from_crs("EPSG:32631", "EPSG:4326", always_xy=True)
+
+    return Polygon(zip(*to_wgs84.transform(*utm_box.exterior.xy)))
+
+
+def stac_item(name, cloud_cover, footprint):
+    """Build the STAC item returned by the fake provider for a product"""
+    sensing = datetime.datetime.strptime(name.split("_")[2], "%Y%m%dT%H%M%S").isoformat()
+    return {
+        "type": "Feature",
+        "id": name,
+        "geometry": mapping(footprint),
+        "properties": {
+            "id": name,
+            "title": name,
+            "cloudCover": cloud_cover,
+            "modificationDate": f"{sensing}Z",
+            # eodag 2 and later eodag versions name sensing dates differently
+            "startTimeFromAscendingNode": sensing,
+            "completionTimeFromAscendingNode": sensing,
+            "start_datetime": sensing,
+            "end_datetime": sensing,
+        },
+    }
+
+
+def item_product(item, provider="fake_provider"):
+    """Build the EO product of a STAC item as search results of eodag hold it"""
+    return EOProduct(provider, dict(item["properties"], geometry=item["geometry"]))
+
+
+class FakeProvider:
+    """
+    Stand-in of EODataAccessGateway answering searches with STAC items of synthetic
+    products sensed every few days until today, and downloading them by copying a
+    SAFE structure written once per product
+
+    :param days: Number of days of acquisitions before today.
+    :param revisit: Number of days between two acquisitions.
+    :param name: Provider name of products, to route them in a FakeGateway.
+    :param level: Processing level of products, L2A or L1C.
+    :param delay: Number of seconds each search lasts.
+    :param error: Exception raised by searches to fake an outage.
+    """
+
+    def __init__(self, days=30, revisit=3, resolution=60, name="fake_provider", level="L2A", delay=0.0, error=None):
+        self.resolution = resolution
+        self.name = name
+        self.delay = delay
+        self.error = error
+        self.templates_dir = tempfile.mkdtemp(prefix="fake_provider_")
+        self.templates = {}
+        self.searches = []
+        self.downloads = []
+
+        footprint = fake_footprint()
+        today = datetime.date.today()
+        self.items = [
+            stac_item(fake_product_name(today - datetime.timedelta(days=day), level=level), (day * 37) % 100, footprint)
+            for day in range(0, days, revisit)
+        ]
+
+    def close(self):
+        """Remove synthetic products templates"""
+        shutil.rmtree(self.templates_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+    def set_preferred_provider(self, provider):
+        """Accept any provider, all of them serve the same products"""
+
+    def search_all(self, **criteria):
+        """Return products intersecting the geometry and sensed between start and end of criteria"""
+        self.searches.append(criteria)
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        start, end = str(criteria["start"])[:10], str(criteria["end"])[:10]
+        return SearchResult(
+            [
+                item_product(item, self.name)
+                for item in self.items
+                if start <= item["properties"]["start_datetime"][:10] <= end
+                and shape(item["geometry"]).intersects(criteria["geom"])
+            ]
+        )
+
+    def download(self, product, outputs_prefix, **_):
+        """Copy the synthetic SAFE of a product to outputs_prefix as a download would"""
+        name = product.properties["id"]
+        self.downloads.append(name)
+        if name not in self.templates:
+            self.templates[name] = make_fake_product(self.templates_dir, name, self.resolution)
+
+        safe_path = os.path.join(outputs_prefix, name, os.path.basename(self.templates[name]))
+        shutil.copytree(self.templates[name], safe_path, dirs_exist_ok=True)
+
+        return safe_path
+
+
+class FakeGateway:
+    """Stand-in of EODataAccessGateway routing searches and downloads to fake providers by name"""
+
+    def __init__(self, providers):
+        self.providers = {provider.name: provider for provider in providers}
+
+    def search_all(self, provider, **criteria):
+        """Search products on the named provider"""
+        return self.providers[provider].search_all(**criteria)
+
+    def download(self, product, outputs_prefix, **kwargs):
+        """Download a product from the provider which found it"""
+        return self.providers[product.provider].download(product, outputs_prefix, **kwargs)
+
+
+class FakeAssetHandler(BaseHTTPRequestHandler):
+    """Serve assets of the fake provider, with range requests as object stores do"""
+
+    def log_message(self, *_):
+        """Keep test output quiet"""
+
+    def send_asset(self, body=True):
+        """Send an asset or the part of it in the requested range, GDAL reads assets by ranges"""
+        self.server.requests.append((self.path, self.headers.get("Range")))
+        if self.server.authorization is not None and self.headers.get("Authorization") != self.server.authorization:
+            self.send_error(401)
+            return
+        if self.path not in self.server.assets:
+            self.send_error(404)
+            return
+
+        content = self.server.assets[self.path]
+        match = RANGE_HEADER.match(self.headers.get("Range", ""))
+        if match is None:
+            self.send_response(200)
+        elif int(match["start"]) >= len(content):
+            self.send_error(416)
+            return
+        else:
+            start = int(match["start"])
+            end = min(int(match["end"] or len(content) - 1), len(content) - 1)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(content)}")
+            content = content[start:end + 1]
+        self.send_header("Content-Length", str(len(content)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        if body:
+            self.wfile.write(content)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Send an asset"""
+        self.send_asset()
+
+    def do_HEAD(self):  # pylint: disable=invalid-name
+        """Send the headers of an asset"""
+        self.send_asset(body=False)
+
+
+class FakeAssetServer(ThreadingHTTPServer):
+    """
+    Fake asset server running in a thread, assets are bytes per URL path
+
+    :param authorization: Authorization header required by every request, None to serve anyone.
+    """
+
+    def __init__(self, assets=None, authorization=None):
+        super().__init__(("127.0.0.1", 0), FakeAssetHandler)
+        self.assets = dict(assets or {})
+        self.authorization = authorization
+        self.requests = []
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        """Base URL of assets"""
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
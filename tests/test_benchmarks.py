@@ -0,0 +1,120 @@
+"""
+Offline benchmarks of the workflow stages against a fake EO provider and a fake GCS bucket
+
+Run them with ``pytest tests/test_benchmarks.py --benchmark-only`` and compare runs with
+``--benchmark-autosave`` and ``--benchmark-compare`` to catch throughput regressions. Each
+benchmark also fails when its mean time exceeds its budget, as CI runs them on fresh runners
+without saved runs to compare with.
+"""
+import tempfile
+
+import pytest
+
+from LookPyrenees.cli import ALL_ZONES
+from LookPyrenees.download import (
+    coverage_matrix,
+    encode_image,
+    filter_img,
+    process_zones,
+    read_zones,
+    search_data,
+)
+from LookPyrenees.zones import zone_crop
+from tests.fake_gcs import FakeGCSServer
+from tests.fake_provider import FakeProvider
+
+pytest.importorskip("pytest_benchmark")
+
+BUCKET = "pyrenees_images"
+# Full runs download and crop several products, keep them few
+PROCESS_ROUNDS = 3
+# Budget in seconds of the mean time of each benchmark, several times its time on a laptop
+BUDGETS = {
+    "test_search": 0.05,
+    "test_filter": 0.05,
+    "test_crop": 3.0,
+    "test_encode[jpeg]": 0.1,
+    "test_encode[png]": 0.5,
+    "test_encode[webp]": 0.75,
+    "test_process": 15.0,
+}
+
+
+@pytest.fixture(autouse=True)
+def check_budget(request, benchmark):
+    """Fail a benchmark whose mean time exceeds its budget, nothing is measured when benchmarks are disabled"""
+    yield
+    if benchmark.stats is not None:
+        mean = benchmark.stats.stats.mean
+        assert mean < BUDGETS[request.node.name], f"{request.node.name} took {mean:.3f} s on average"
+
+
+@pytest.fixture(name="provider", scope="module")
+def fixture_provider():
+    """Fake provider shared by all benchmarks so that synthetic products are written once"""
+    with FakeProvider() as provider:
+        yield provider
+
+
+@pytest.fixture(name="search_results", scope="module")
+def fixture_search_results(provider):
+    """Search results of the whole Pyrenees"""
+    with tempfile.TemporaryDirectory() as workspace:
+        return search_data(workspace, provider, "cop_dataspace", False)
+
+
+@pytest.fixture(name="safe_path", scope="module")
+def fixture_safe_path(provider, search_results, tmp_path_factory):
+    """Downloaded synthetic product covering all zones"""
+    return provider.download(search_results[0], str(tmp_path_factory.mktemp("downloads")))
+
+
+def test_search(benchmark, provider, tmp_path):
+    """Benchmark the search of products of the last month"""
+    search_results = benchmark(search_data, str(tmp_path), provider, "cop_dataspace", False)
+
+    assert len(search_results) == len(provider.items)
+
+
+def test_filter(benchmark, search_results):
+    """Benchmark the coverage and the selection of products of all zones"""
+
+    def filter_zones():
+        coverage = coverage_matrix(search_results, ALL_ZONES)
+        return {zone: filter_img(search_results, zone_crop(zone), coverage=coverage[zone]) for zone in ALL_ZONES}
+
+    filtered = benchmark(filter_zones)
+
+    assert all(len(products) > 0 for products in filtered.values())
+
+
+def test_crop(benchmark, safe_path):
+    """Benchmark the crop of all zones in one read of a product"""
+    _, rasters = benchmark(read_zones, ALL_ZONES, safe_path)
+
+    assert set(rasters) == set(ALL_ZONES)
+
+
+@pytest.mark.parametrize("img_format", ["png", "webp", "jpeg"])
+def test_encode(benchmark, safe_path, img_format):
+    """Benchmark the encoding of cropped zones to images"""
+    _, rasters = read_zones(ALL_ZONES, safe_path)
+
+    images = benchmark(lambda: [encode_image(raster, img_format) for raster, _ in rasters.values()])
+
+    assert all(images)
+
+
+def test_process(benchmark, provider, tmp_path, monkeypatch):
+    """Benchmark a full run of all zones, from the search to the upload of images to the bucket"""
+    with FakeGCSServer() as server:
+        monkeypatch.setenv("STORAGE_EMULATOR_HOST", server.url)
+
+        def setup():
+            server.blobs.clear()
+            return (ALL_ZONES, tempfile.mkdtemp(dir=tmp_path), "cop_dataspace", False, BUCKET), {"dag": provider}
+
+        files_per_zone = benchmark.pedantic(process_zones, setup=setup, rounds=PROCESS_ROUNDS)
+
+        assert all(files_per_zone[zone] for zone in ALL_ZONES)
+        assert sum(len(files) for files in files_per_zone.values()) * 2 == len(server.blobs)
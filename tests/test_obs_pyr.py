@@ -3,30 +3,160 @@
 # pylint: disable=import-error
 import datetime
 import glob
+import hashlib
+import io
+import json
 import logging
+import math
 import os
 import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import unittest.mock
+import urllib.error
+import urllib.request
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
+from types import SimpleNamespace
 
-import geopandas as gpd
 import matplotlib.image as mpimg
 import matplotlib.pyplot as plt
+import numpy as np
+import rasterio as rio
+import requests
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import storage
+from PIL import Image
+from rasterio.transform import from_origin
+from requests.auth import HTTPBasicAuth
+from shapely.geometry import box
 
 from eodag import EODataAccessGateway
+from eodag.api.search_result import SearchResult
+from LookPyrenees.catalogue import Catalogue
+from LookPyrenees.clouds import find_cloud_asset, product_clouds, score_clouds
+from LookPyrenees.cube import open_cube, sensing_time
 from LookPyrenees.download import (
+    check_coverage,
     check_files_in_local,
     check_old_files,
+    cloud_candidates,
     convert_tiff_to_png,
+    coverage_matrix,
+    crop_product,
     cropzone,
+    cropzones,
     download_img,
     filter_img,
+    find_tci_asset,
+    find_tci_img,
+    group_products,
+    is_remote,
     process,
+    process_zones,
+    quicklook_img,
+    read_zones,
+    run_pipeline,
+    save_outputs,
     search_data,
+    select_products,
+    tci_name,
+    zones_per_product,
+)
+from LookPyrenees.federation import search_timeouts
+from LookPyrenees.manage_bucket import (
+    BATCH_SIZE,
+    MANIFEST_BLOB,
+    BucketIndex,
+    BucketSession,
+    blob_key,
+    check_files_on_bucket,
+    check_old_blobs,
+    delete_blob,
+    expired_blobs,
+    load_on_gcs,
+)
+from LookPyrenees.metrics import RunMetrics
+from LookPyrenees.mosaic import Mosaic
+from LookPyrenees.outputs import OutputIndex
+from LookPyrenees.service import ServiceServer, ZoneService
+from LookPyrenees.snow import snow_mask, snow_stats
+from LookPyrenees.staging import STAGING_DIR
+from LookPyrenees.tiles import OVERVIEW_LEVELS, TileStore, changed_tiles
+from LookPyrenees.utils import sqlite_connect
+from LookPyrenees.zones import reprojected_zone, zone_crop, zone_names, zone_pixels
+from tests.fake_gcs import FakeGCSServer
+from tests.fake_provider import (
+    FakeAssetServer,
+    FakeGateway,
+    FakeProvider,
+    fake_footprint,
+    fake_product_name,
+    item_product,
+    make_fake_dem,
+    make_fake_product,
+    make_fake_scl,
+    stac_item,
 )
-from LookPyrenees.manage_bucket import check_files_on_bucket, delete_blob, load_on_gcs
 
 CURRENT_DIR = os.getcwd()
+FAKE_PRODUCT = "S2B_MSIL2A_20240511T103629_N0510_R008_T31TCH_20240511T121256"
+# Import time budget in seconds of the CLI module, the geo stack alone takes several seconds
+CLI_IMPORT_BUDGET = 0.5
+HEAVY_MODULES = ["eodag", "folium", "geopandas", "google.cloud.storage", "matplotlib", "PIL", "rasterio", "shapely"]
+
+
+class FakeDag:
+    """Stand-in of EODataAccessGateway downloading synthetic products"""
+
+    def download(self, product, outputs_prefix, **_):
+        """Write a synthetic product instead of downloading it"""
+        return make_fake_product(outputs_prefix, product.properties["id"])
+
+
+def fake_storage_client(server):
+    """Build a storage client sending its requests to a fake GCS server"""
+    return storage.Client(
+        project="test", credentials=AnonymousCredentials(), client_options={"api_endpoint": server.url}
+    )
+
+
+def fake_eoproduct(name=FAKE_PRODUCT):
+    """Build a minimal stand-in of an EO product"""
+    sensing = datetime.datetime.strptime(name.split("_")[2], "%Y%m%dT%H%M%S").isoformat()
+    properties = {
+        "id": name,
+        "startTimeFromAscendingNode": sensing,
+        "modificationDate": "2024-05-11T12:12:56Z",
+        "cloudCover": 1.5,
+    }
+    return SimpleNamespace(properties=properties, as_dict=lambda: {"type": "Feature", "properties": properties})
+
+
+class FakeSearchDag:
+    """Stand-in of EODataAccessGateway searching in a list of products"""
+
+    def __init__(self, products):
+        self.products = products
+        self.searches = []
+
+    def search_all(self, **criteria):
+        """Return products sensed between start and end of criteria"""
+        self.searches.append(criteria)
+        return [
+            product for product in self.products
+            if str(criteria["start"]) <= product.properties["startTimeFromAscendingNode"][:10] <= str(criteria["end"])
+        ]
+
+    def deserialize_and_register(self, filename):
+        """Read products serialized in a geojson file"""
+        with open(filename, encoding="utf-8") as geojson:
+            features = json.load(geojson)["features"]
+        return [SimpleNamespace(properties=feature["properties"]) for feature in features]
 
 
 class TestClassifBase(unittest.TestCase):
@@ -35,6 +165,19 @@ class TestClassifBase(unittest.TestCase):
     def setUp(self):
         self.path = f'{os.getenv("HOME")}/data/snow/output_img'
 
+    def test_cli_import_time(self):
+        """Test that importing the CLI stays within its budget and does not load heavy dependencies"""
+        code = (
+            "import sys, time; start = time.perf_counter(); import LookPyrenees.cli; "
+            "print(time.perf_counter() - start); print(' '.join(sys.modules))"
+        )
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+        duration, modules = result.stdout.splitlines()
+
+        logging.info("LookPyrenees.cli imported in %s s", duration)
+        assert float(duration) < CLI_IMPORT_BUDGET
+        assert not set(HEAVY_MODULES) & set(modules.split())
+
     def test_search_data(self):
         """Test to search data on provider"""
         dag = EODataAccessGateway()
@@ -44,6 +187,42 @@ class TestClassifBase(unittest.TestCase):
         print(f"search_results : {search_results}")
         return search_results
 
+    def test_federated_search(self):
+        """Test that providers are searched concurrently and their results merged preferring L2A products"""
+        with tempfile.TemporaryDirectory() as tmp_dir, FakeProvider(9, name="l1c", level="L1C") as l1c, \
+                FakeProvider(6, name="l2a") as l2a, FakeProvider(name="slow", delay=3) as slow, \
+                FakeProvider(name="down", error=ConnectionError("Provider down")) as down:
+            dag = FakeGateway([l1c, l2a, slow, down])
+            search_results = search_data(tmp_dir, dag, None, False, providers=["l1c", "l2a", "slow", "down"], timeout=1)
+
+            today = datetime.date.today()
+            products = {product.properties["id"]: product.provider for product in search_results}
+            assert products == {
+                fake_product_name(today): "l2a",
+                fake_product_name(today - datetime.timedelta(days=3)): "l2a",
+                fake_product_name(today - datetime.timedelta(days=6), level="L1C"): "l1c",
+            }
+            assert len(down.searches) == 1
+
+            with self.assertRaises(ValueError):
+                search_data(tmp_dir, dag, None, False, providers=["down"])
+
+        # A provider still searching after the timeout does not delay the exit of the process
+        code = (
+            "import time; from LookPyrenees.federation import federated_search; "
+            "print(federated_search(['fast', 'hung'], lambda provider: time.sleep(provider == 'hung' and 30) or [], "
+            "timeout=1))"
+        )
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True, timeout=20)
+        assert result.stdout.startswith("[('fast'")
+        assert time.perf_counter() - start < 10
+
+        with unittest.mock.patch.dict(os.environ, {"EODAG__PEPS__SEARCH__TIMEOUT": "30"}):
+            search_timeouts(["peps", "earth_search", None], 12.5)
+            assert os.environ["EODAG__PEPS__SEARCH__TIMEOUT"] == "30"
+            assert os.environ["EODAG__EARTH_SEARCH__SEARCH__TIMEOUT"] == "13"
+
     def test_filter_img(self):
         """Test the filtering of Montcalm zone"""
         os.environ.get("EODAG__COP_DATASPACE__AUTH__CREDENTIALS__USERNAME")
@@ -54,16 +233,38 @@ class TestClassifBase(unittest.TestCase):
         search_results = search_data(
             workspace=self.path, dag=dag, pref_provider="cop_dataspace", plot_res=False
         )
-        aoi_path = glob.glob(f"{os.getcwd()}/ressources/zone_4326.shp")
-        crop_extent = gpd.read_file(aoi_path[0])
-
-        crop = gpd.read_file(aoi_path[0], mask=crop_extent[crop_extent.NAME == zone])
 
         filtered_results = filter_img(
-            search_results=search_results, new_crop=crop,
+            search_results=search_results, new_crop=zone_crop(zone),
         )
         print(f"filtered_results : {filtered_results}")
 
+    def test_quicklook_img(self):
+        """Test quicklooks are fetched once and tiled into a contact sheet"""
+        fetched = []
+
+        def get_quicklook(product, filename, base_dir):
+            fetched.append(filename)
+            quicklook_path = os.path.join(base_dir, filename)
+            Image.new("RGB", (60, 40), (200, 10, 10)).save(quicklook_path, format="JPEG")
+            return quicklook_path
+
+        products = [
+            fake_eoproduct(FAKE_PRODUCT.replace("20240511T103629", f"202405{day}T103629")) for day in range(10, 14)
+        ]
+        for product in products:
+            product.get_quicklook = lambda product=product, **kwargs: get_quicklook(product, **kwargs)
+
+        with tempfile.TemporaryDirectory() as workspace:
+            sheet_path = quicklook_img(workspace, products)
+            quicklook_img(workspace, products, name="again")
+
+            assert sorted(fetched) == sorted(product.properties["id"] for product in products)
+            with Image.open(sheet_path) as sheet:
+                assert sheet.size == (3 * 256, 2 * 256)
+                assert sheet.getpixel((10, 10))[0] > 150
+                assert sheet.getpixel((2 * 256 + 10, 256 + 10)) == (0, 0, 0)
+
     def test_cropzone(self):
         """Test cropping of Montcalm zone"""
 
@@ -75,17 +276,14 @@ class TestClassifBase(unittest.TestCase):
         search_results = search_data(
             workspace=self.path, dag=dag, pref_provider="cop_dataspace", plot_res=False
         )
-        aoi_path = glob.glob(f"{os.getcwd()}/ressources/zone_4326.shp")
-        crop_extent = gpd.read_file(aoi_path[0])
-        crop = gpd.read_file(aoi_path[0], mask=crop_extent[crop_extent.NAME == zone])
-        out_imgs = filter_img(search_results, crop)
+        out_imgs = filter_img(search_results, zone_crop(zone))
 
         out_paths = []
         for eoprod in out_imgs:
             out_paths.append(download_img(eoprod, dag, self.path))
 
         for out_path in out_paths:
-            file_path = cropzone(zone, crop, out_path)
+            file_path = cropzone(zone, out_path)
             img = mpimg.imread(file_path)
             plt.imshow(img)
             plt.show()
@@ -115,13 +313,21 @@ class TestClassifBase(unittest.TestCase):
         with open(full_path_one_month, "w", encoding="utf-8") as _:
             logging.info("File %s has been created", full_path_one_month)
 
+        # Product folders downloaded before downloads were staged
+        legacy_today = os.path.join(path_dir, fake_product_name(datetime.date.today()))
+        legacy_one_month = os.path.join(path_dir, fake_product_name(one_month.date()))
+        os.makedirs(legacy_today)
+        os.makedirs(legacy_one_month)
+
         check_old_files(path_dir)
 
         # Check that today file still exists
         assert os.path.exists(full_path_today)
+        assert os.path.exists(legacy_today)
 
         # Check that old files has been removed
         assert not os.path.exists(full_path_one_month)
+        assert not os.path.exists(legacy_one_month)
 
         with os.scandir(path_dir) as entries:
             for entry in entries:
@@ -147,6 +353,654 @@ class TestClassifBase(unittest.TestCase):
                 plt.show()
                 plt.clf()
 
+    def test_process_zones(self):
+        """Test whole process for several zones sharing a single search"""
+        zones = ["montcalm", "rulhe_nerassol"]
+        files_per_zone = process_zones(
+            zones=zones, outdir=self.path, pref_provider="cop_dataspace", plot_res=False, bucket=None
+        )
+        assert list(files_per_zone.keys()) == zones
+
+    def test_zone_clouds(self):
+        """Test that products are selected by the clouds of each zone read from their cloud mask"""
+        assets = {"TCI_10m": {}, "MSK_CLDPRB_20m": {"href": "cldprb"}, "SCL_20m": {}, "SCL_60m": {"href": "scl"}}
+        assert find_cloud_asset(SimpleNamespace(assets=assets)) == ("scl", "scl")
+        assert find_cloud_asset(SimpleNamespace(assets={"MSK_CLDPRB_60m": {"href": "cldprb"}})) == ("cldprb", "cldprb")
+        assert find_cloud_asset(SimpleNamespace(assets={})) == (None, None)
+
+        zones = ["3seigneurs", "carlit"]
+        with tempfile.TemporaryDirectory() as tmp_dir, FakeProvider(days=6) as provider:
+            today = datetime.date.today()
+            search_results = provider.search_all(
+                start=today - datetime.timedelta(days=30), end=today, geom=box(0, 40, 4, 45)
+            )
+            # Tile cloud cover of both products is below 20 percent, the newest one is cloudy over 3seigneurs
+            newest, oldest = search_results
+            newest.assets.update({"SCL_60m": {"href": make_fake_scl(os.path.join(tmp_dir, "SCL_60m.tif"))}})
+
+            coverage = coverage_matrix(search_results, zones)
+            clouds_per_zone = score_clouds(zones_per_product(search_results, coverage))
+            name = newest.properties["id"]
+            assert clouds_per_zone == {"3seigneurs": {name: 100.0}, "carlit": {name: 0.0}}
+
+            # Only clouds of recent products not processed yet for a zone are scored
+            Path(tmp_dir, f"{tci_name(name)}_carlit.png").write_bytes(b"png")
+            candidates = cloud_candidates(search_results, coverage, tmp_dir, None, output_index=OutputIndex(tmp_dir))
+            assert {key: zones for key, (_, zones) in candidates.items()} == {
+                name: ["3seigneurs"], oldest.properties["id"]: zones
+            }
+            with FakeProvider(days=15, revisit=12) as old_provider:
+                old_results = old_provider.search_all(
+                    start=today - datetime.timedelta(days=30), end=today, geom=box(0, 40, 4, 45)
+                )
+                candidates = cloud_candidates(old_results, coverage_matrix(old_results, zones), tmp_dir, None)
+                assert list(candidates) == [old_results[0].properties["id"]]
+
+            selected = {
+                zone: filter_img(
+                    search_results, zone_crop(zone), coverage=coverage[zone], zone_clouds=clouds_per_zone[zone]
+                )
+                for zone in zones
+            }
+            assert list(selected["3seigneurs"]) == [oldest]
+            assert list(selected["carlit"]) == [newest, oldest]
+
+            # Masks of providers requiring authentication are read with their credentials
+            auth = HTTPBasicAuth("user", "password")
+            authorization = auth(requests.Request("GET", "http://localhost").prepare()).headers["Authorization"]
+            scl = Path(newest.assets["SCL_60m"]["href"]).read_bytes()
+            with FakeAssetServer({"/SCL_60m.tif": scl}, authorization=authorization) as server:
+                remote = SimpleNamespace(
+                    properties=newest.properties, assets={"SCL_60m": {"href": f"{server.url}/SCL_60m.tif"}},
+                    downloader_auth=SimpleNamespace(authenticate=lambda: auth),
+                )
+                assert product_clouds(remote, zones) == {zone: clouds_per_zone[zone][name] for zone in zones}
+
+            # An unreadable mask falls back on the tile cloud cover
+            Path(tmp_dir, "SCL_20m.tif").write_text("not a raster")
+            newest.assets["SCL_60m"]["href"] = os.path.join(tmp_dir, "SCL_20m.tif")
+            assert product_clouds(newest, zones) is None
+            del newest.assets["SCL_60m"]
+            with self.assertLogs(level="WARNING") as logs:
+                assert score_clouds(zones_per_product(search_results, coverage)) == {}
+            assert len(logs.records) == 1
+
+    def test_mosaic(self):
+        """Test that zones straddling adjacent tiles of a datatake are cropped once from a mosaic of both"""
+        west_bounds, east_bounds = (362000, 4705000, 371000, 4750000), (369800, 4705000, 422000, 4750000)
+        west, east = fake_product_name(datetime.date.today()), fake_product_name(datetime.date.today(), "T31TDH")
+        search_results = SearchResult(
+            [
+                item_product(stac_item(west, 10, fake_footprint(west_bounds))),
+                item_product(stac_item(east, 10, fake_footprint(east_bounds))),
+            ]
+        )
+
+        with tempfile.TemporaryDirectory() as tmp_dir, FakeProvider() as provider:
+            selected = {
+                zone: select_products(zone, tmp_dir, search_results, None, output_index=OutputIndex(tmp_dir))
+                for zone in ["montcalm", "orlu"]
+            }
+            assert selected["orlu"] == [search_results[1]]
+            (mosaic,) = selected["montcalm"]
+            assert isinstance(mosaic, Mosaic)
+            assert {product.properties["id"] for product in mosaic.products} == {west, east}
+            # A datatake whose cloudy tile is filtered out no longer covers the zone and is not cropped
+            assert not select_products(
+                "montcalm", tmp_dir, search_results, None, output_index=OutputIndex(tmp_dir),
+                zone_clouds={west: 5.0, east: 80.0}
+            )
+
+            _, full = read_zones(["montcalm"], make_fake_product(os.path.join(tmp_dir, "full"), west))
+            tile_paths = [
+                make_fake_product(os.path.join(tmp_dir, "tiles"), west, bounds=west_bounds),
+                make_fake_product(os.path.join(tmp_dir, "tiles"), east, bounds=east_bounds),
+            ]
+            _, rasters = read_zones(["montcalm"], tile_paths)
+            np.testing.assert_array_equal(rasters["montcalm"][0], full["montcalm"][0])
+            assert rasters["montcalm"][1] == full["montcalm"][1]
+
+            files_per_zone = run_pipeline(group_products(selected), provider, tmp_dir, cpu_workers=1)
+            assert sorted(provider.downloads) == sorted([west, east])
+            reference = mosaic.products[0].properties["id"]
+            assert [os.path.basename(path) for path in files_per_zone["montcalm"]] == [
+                f"{tci_name(reference)}_montcalm.png"
+            ]
+            assert [os.path.basename(path) for path in files_per_zone["orlu"]] == [f"{tci_name(east)}_orlu.png"]
+
+    def test_tiles(self):
+        """Test that the newest crop of zones is rendered into tile pyramids where only changed tiles are written"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            crs, rasters = read_zones(["montcalm"], make_fake_product(tmp_dir, FAKE_PRODUCT))
+            raster, transform = rasters["montcalm"]
+            tiles = changed_tiles(raster, transform, crs)
+            # Pixels of synthetic products are 60m wide
+            assert sorted({zoom for zoom, _, _ in tiles}) == list(range(11 - OVERVIEW_LEVELS, 12))
+
+            store = TileStore(tmp_dir, "xyz")
+            assert store.write("montcalm", "2024-05-11T10:36:29", tiles) == len(tiles)
+            for zoom, col, row in tiles:
+                with Image.open(store.tile_path("montcalm", zoom, col, row)) as tile:
+                    assert tile.size == (256, 256) and tile.mode == "RGBA"
+            assert not changed_tiles(raster, transform, crs, store.digests("montcalm"))
+
+            raster = raster.copy()
+            raster[:, :20, :20] = 255
+            changed = changed_tiles(raster, transform, crs, store.digests("montcalm"))
+            assert 0 < len(changed) < len(tiles)
+            assert store.write("montcalm", "2024-05-01T10:36:29", changed) == 0
+
+            mbtiles = TileStore(tmp_dir, "mbtiles")
+            mbtiles.write("montcalm", "2024-05-11T10:36:29", tiles)
+            with sqlite_connect(mbtiles.mbtiles_path("montcalm")) as conn:
+                rows = set(conn.execute("SELECT zoom_level, tile_column, tile_row FROM tiles"))
+            assert rows == {(zoom, col, 2 ** zoom - 1 - row) for zoom, col, row in tiles}
+
+        with tempfile.TemporaryDirectory() as tmp_dir, FakeProvider(days=6) as provider:
+            today = datetime.date.today()
+            search_results = provider.search_all(
+                start=today - datetime.timedelta(days=30), end=today, geom=box(0, 40, 4, 45)
+            )
+            metrics = RunMetrics()
+            run_pipeline(
+                group_products({"montcalm": list(search_results)}), provider, tmp_dir, cpu_workers=1, metrics=metrics,
+                tiles="xyz"
+            )
+            assert metrics.report()["stages"]["tiles"]["calls"] == 1
+            with sqlite_connect(TileStore(tmp_dir).index_path) as conn:
+                assert conn.execute("SELECT sensing_time FROM pyramids").fetchall() == [
+                    (sensing_time(fake_product_name(today)).isoformat(),)
+                ]
+
+    def test_service(self):
+        """Test that the service coalesces triggers of the same zones and sends the newest image of a zone"""
+        with tempfile.TemporaryDirectory() as tmp_dir, FakeProvider(days=6) as provider:
+            options = {
+                "outdir": tmp_dir, "pref_provider": "fake_provider", "plot_res": False, "bucket": None,
+                "cpu_workers": 1,
+            }
+            service = ZoneService(options, dag=provider, all_zones=["montcalm", "orlu"])
+            # Triggers queued before the worker starts all wait for the same run
+            job = service.trigger(["montcalm"])
+            assert service.trigger(["montcalm"])["id"] == job["id"]
+            assert service.trigger(["orlu"])["zones"] == ["montcalm", "orlu"]
+            with self.assertRaises(ValueError):
+                service.trigger(["unknown"])
+
+            service.start()
+            server = ServiceServer(service, port=0)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            url = f"http://127.0.0.1:{server.server_address[1]}"
+
+            def wait_run(job_id, timeout=60):
+                deadline = time.monotonic() + timeout
+                while service.job(job_id)["state"] not in ("done", "failed") and time.monotonic() < deadline:
+                    time.sleep(0.2)
+
+            try:
+                wait_run(job["id"])
+                with urllib.request.urlopen(f"{url}/runs/{job['id']}") as answer:
+                    run = json.load(answer)
+                assert run["state"] == "done"
+                assert run["metrics"]["counters"]["products_found"] == 2
+
+                with urllib.request.urlopen(f"{url}/zones/orlu/latest") as answer:
+                    assert answer.headers["Content-Type"] == "image/png"
+                    Image.open(io.BytesIO(answer.read())).verify()
+
+                with urllib.request.urlopen(urllib.request.Request(f"{url}/runs?zone=all", method="POST")) as answer:
+                    assert answer.status == 202
+                    second = json.load(answer)
+                assert second["zones"] == ["montcalm", "orlu"]
+                wait_run(second["id"])
+                assert service.job(second["id"])["state"] == "done"
+                for request, status in [
+                    (urllib.request.Request(f"{url}/runs?zone=unknown", method="POST"), 400),
+                    (f"{url}/zones/carlit/latest", 404),
+                    (f"{url}/runs/1000", 404),
+                ]:
+                    with self.assertRaises(urllib.error.HTTPError) as context:
+                        urllib.request.urlopen(request)  # pylint: disable=consider-using-with
+                    assert context.exception.code == status
+
+                # A run on broken crop workers fails and the next one gets new workers
+                with self.assertRaises(BrokenProcessPool):
+                    service.cpu_pool.submit(os._exit, 1).result()
+                for path in glob.glob(os.path.join(tmp_dir, "T*")):
+                    os.remove(path)
+                for state in ["failed", "done"]:
+                    job_id = service.trigger(["montcalm"])["id"]
+                    wait_run(job_id)
+                    assert service.job(job_id)["state"] == state
+            finally:
+                server.shutdown()
+                server.server_close()
+                service.close()
+            # Search results of the first run were kept in memory for the second one
+            assert len(provider.searches) == 1
+
+    def test_group_products(self):
+        """Test that a product selected by several zones is downloaded once"""
+        prod_a = SimpleNamespace(properties={"id": "A"})
+        prod_b = SimpleNamespace(properties={"id": "B"})
+        selected = {"montcalm": [prod_a], "orlu": [prod_a, prod_b]}
+        products = group_products(selected)
+
+        assert list(products.keys()) == ["A", "B"]
+        assert products["A"][1] == ["montcalm", "orlu"]
+        assert products["B"][1] == ["orlu"]
+
+    def test_cropzones(self):
+        """Test cropping of several zones from a single product"""
+        zones = ["montcalm", "rulhe_nerassol", "orlu"]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            out_path = make_fake_product(tmp_dir, FAKE_PRODUCT)
+            file_path = cropzones(zones, out_path)
+
+            assert list(file_path.keys()) == zones
+            for zone, file in file_path.items():
+                assert file.endswith(f"_{zone}.tif")
+                with rio.open(file) as src:
+                    assert src.dtypes[0] == "uint8"
+                    assert src.count == 3
+                    # A zone is a few km wide, far smaller than the whole image
+                    assert src.width * src.height < 1000 * 750 / 4
+
+    def test_find_tci_asset(self):
+        """Test the selection of the TCI asset and of the image inside an asset only download"""
+        assets = {
+            "B03": {"href": "https://example.com/B03.jp2"},
+            "TCI_20m": {"href": "https://example.com/TCI_20m.jp2"},
+            "TCI_10m": {"href": "https://example.com/TCI_10m.jp2"},
+        }
+        assert find_tci_asset(SimpleNamespace(assets=assets)) == ("TCI_10m", "https://example.com/TCI_10m.jp2")
+        assert find_tci_asset(SimpleNamespace(assets={})) == (None, None)
+        assert find_tci_img("https://example.com/TCI.tif") == "https://example.com/TCI.tif"
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            asset_dir = Path(tmp_dir, FAKE_PRODUCT, "TCI_10m")
+            asset_dir.mkdir(parents=True)
+            (asset_dir / "T31TCH_20240511T103629_TCI_10m.jp2").touch()
+            img_path = find_tci_img(str(Path(tmp_dir, FAKE_PRODUCT)))
+            assert img_path.endswith("T31TCH_20240511T103629_TCI_10m.jp2")
+
+    def test_resumable_download(self):
+        """Test that downloads are staged, resumed with range requests, verified and published once"""
+        content = np.random.default_rng(0).integers(0, 255, 300000, dtype=np.uint8).tobytes()
+        checksum = "d50110" + hashlib.md5(content).hexdigest()
+        corrupted_product = FAKE_PRODUCT.replace("20240511T103629", "20240514T104619")
+
+        with tempfile.TemporaryDirectory() as tmp_dir, FakeAssetServer({"/TCI_10m.jp2": content}) as server:
+            product = fake_eoproduct()
+            product.assets = {
+                "TCI_10m": {"href": f"{server.url}/TCI_10m.jp2", "file:size": len(content), "file:checksum": checksum}
+            }
+            staged_dir = Path(tmp_dir, STAGING_DIR, FAKE_PRODUCT)
+            staged_dir.mkdir(parents=True)
+            (staged_dir / "T31TCH_20240511T103629_TCI_10m.jp2.part").write_bytes(content[:100000])
+
+            out_path = download_img(product, FakeDag(), tmp_dir, mode="asset")
+            assert out_path == os.path.join(tmp_dir, FAKE_PRODUCT)
+            assert Path(find_tci_img(out_path)).read_bytes() == content
+            assert server.requests == [("/TCI_10m.jp2", "bytes=100000-")]
+            assert download_img(product, FakeDag(), tmp_dir, mode="asset") == out_path
+            assert len(server.requests) == 1
+
+            product = fake_eoproduct(corrupted_product)
+            product.assets = {"TCI_10m": {"href": f"{server.url}/TCI_10m.jp2", "file:checksum": "d50110" + "0" * 32}}
+            with self.assertRaises(ValueError):
+                download_img(product, FakeDag(), tmp_dir, mode="asset")
+            assert not list(Path(tmp_dir, STAGING_DIR, corrupted_product).iterdir())
+            assert not os.path.exists(Path(tmp_dir, corrupted_product))
+
+            out_path = download_img(fake_eoproduct(corrupted_product), FakeDag(), tmp_dir)
+            assert out_path == str(Path(tmp_dir, corrupted_product, f"{corrupted_product}.SAFE"))
+            assert os.path.exists(find_tci_img(out_path))
+
+    def test_remote_auth_fallback(self):
+        """Test that a TCI asset requiring authentication is downloaded instead of read in place without it"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tci_path = find_tci_img(make_fake_product(tmp_dir, FAKE_PRODUCT))
+            content = Path(tci_path).read_bytes()
+            auth = HTTPBasicAuth("user", "password")
+            authorization = auth(requests.Request("GET", "http://localhost").prepare()).headers["Authorization"]
+
+            with FakeAssetServer({"/TCI_10m.jp2": content}, authorization=authorization) as server:
+                product = fake_eoproduct()
+                product.assets = {"TCI_10m": {"href": f"{server.url}/TCI_10m.jp2"}}
+                product.downloader_auth = SimpleNamespace(authenticate=lambda: auth)
+
+                metrics = RunMetrics()
+                out_path = download_img(product, FakeDag(), os.path.join(tmp_dir, "out"), mode="remote",
+                                        metrics=metrics)
+                assert not is_remote(out_path)
+                assert Path(find_tci_img(out_path)).read_bytes() == content
+                assert read_zones(["montcalm"], out_path)[1]["montcalm"][0].any()
+                assert metrics.report()["counters"]["bytes_downloaded"] == len(content)
+
+            # Without credentials to require, the asset is read in place and nothing is downloaded
+            with FakeAssetServer({"/TCI_10m.jp2": content}) as server:
+                href = f"{server.url}/TCI_10m.jp2"
+                product.assets = {"TCI_10m": {"href": href}}
+                metrics = RunMetrics()
+                assert download_img(product, FakeDag(), tmp_dir, mode="remote", metrics=metrics) == href
+                assert metrics.report()["counters"] == {"products_read_in_place": 1}
+
+    def test_snow(self):
+        """Test the snow mask compared without division and the snow of zones computed in one pass over a product"""
+        rng = np.random.default_rng(0)
+        green, swir = rng.integers(0, 12000, (2, 200, 200), dtype=np.uint16)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ndsi_float = (green.astype(float) - swir) / (green.astype(float) + swir)
+        np.testing.assert_array_equal(snow_mask(green, swir), ndsi_float > 0.4)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            out_path = make_fake_product(tmp_dir, FAKE_PRODUCT, bands=True)
+            dem_path = make_fake_dem(os.path.join(tmp_dir, "dem.tif"))
+
+            stats = snow_stats(["3seigneurs", "montcalm", "carlit"], out_path, FAKE_PRODUCT, dem_path=dem_path)
+            assert stats["3seigneurs"]["snow_fraction"] == 1.0
+            assert 0 < stats["montcalm"]["snow_fraction"] < 1
+            assert stats["montcalm"]["snow_line"] in (1200.0, 1300.0)
+            assert stats["carlit"]["snow_fraction"] == 0.0
+            assert stats["carlit"]["snow_line"] is None
+
+            outputs, _ = crop_product(["montcalm"], out_path, FAKE_PRODUCT, snow=True)
+            sidecar = json.loads(outputs["montcalm"]["T31TCH_20240511T103629_TCI_10m_montcalm.json"])
+            assert sidecar["snow"]["snow_fraction"] == stats["montcalm"]["snow_fraction"]
+            assert sidecar["snow"]["snow_line"] is None
+
+    def test_zones(self):
+        """Test that zones are read once from package resources and their windows cached"""
+        assert zone_names() == ["3seigneurs", "rulhe_nerassol", "montcalm", "orlu", "carlit"]
+        assert len(zone_crop("orlu")) == 1
+        assert reprojected_zone("orlu", "EPSG:32631") is reprojected_zone("orlu", "EPSG:32631")
+        with self.assertRaises(ValueError):
+            zone_crop("aneto")
+
+        transform = from_origin(362000, 4750000, 60, 60)
+        window, outside = zone_pixels("orlu", "EPSG:32631", transform, 1000, 750)
+        assert outside.shape == (window.height, window.width)
+        assert zone_pixels("orlu", "EPSG:32631", transform, 1000, 750)[1] is outside
+
+    def test_coverage_matrix(self):
+        """Test coverage of all zones by all products computed in one pass"""
+        minx, miny, maxx, maxy = zone_crop("orlu").total_bounds
+        middle = (minx + maxx) / 2
+        products = [
+            SimpleNamespace(geometry=box(minx - 1, miny - 1, maxx + 1, maxy + 1)),
+            SimpleNamespace(geometry=box(middle, miny - 1, maxx + 1, maxy + 1)),
+            SimpleNamespace(geometry=box(minx + 10, miny + 10, maxx + 10, maxy + 10)),
+        ]
+        coverage = coverage_matrix(products, ["orlu", "montcalm"])
+
+        orlu_coverage, orlu_contains = coverage["orlu"]
+        assert orlu_contains.tolist() == [True, False, False]
+        assert orlu_coverage[0] == 100
+        assert 0 < orlu_coverage[1] < 100
+        assert coverage["montcalm"][1].tolist() == [True, False, False]
+        assert coverage["montcalm"][0][1:].tolist() == [0, 0]
+        assert check_coverage(products, zone_crop("orlu").geometry[0]) == [True, False, False]
+
+    def test_catalogue(self):
+        """Test that cached search results are merged with a search of the new acquisitions only"""
+        old_product = FAKE_PRODUCT.replace("20240511T103629", "20240501T103629")
+        new_product = FAKE_PRODUCT.replace("20240511T103629", "20240521T103629")
+        dag = FakeSearchDag([fake_eoproduct(old_product), fake_eoproduct()])
+        criteria = {"productType": "S2_MSI_L2A", "start": "2024-04-25", "end": "2024-05-25", "geom": box(0, 0, 1, 1)}
+
+        def search(search_criteria):
+            return dag.search_all(**search_criteria)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            catalogue = Catalogue(os.path.join(tmp_dir, "catalogue.sqlite"))
+            assert len(catalogue.search(dag, "cop_dataspace", criteria, search)) == 2
+
+            dag.products.append(fake_eoproduct(new_product))
+            results = catalogue.search(dag, "cop_dataspace", criteria, search)
+            assert [product.properties["id"] for product in results] == [old_product, FAKE_PRODUCT, new_product]
+            # Only the days after the newest cached product are queried again
+            assert dag.searches[-1]["start"] == "2024-05-09"
+
+            catalogue = Catalogue(os.path.join(tmp_dir, "catalogue.sqlite"), refresh=True)
+            assert len(catalogue.search(dag, "cop_dataspace", criteria, search)) == 3
+            assert dag.searches[-1]["start"] == "2024-04-25"
+
+    def test_run_pipeline(self):
+        """Test concurrent download and crop of two products shared by several zones"""
+        other_product = FAKE_PRODUCT.replace("20240511T103629", "20240514T104619")
+        products = {
+            FAKE_PRODUCT: (fake_eoproduct(), ["montcalm", "orlu"]),
+            other_product: (fake_eoproduct(other_product), ["orlu"]),
+        }
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            files_per_zone = run_pipeline(products, FakeDag(), tmp_dir, download_workers=2, cpu_workers=2)
+
+            assert len(files_per_zone["montcalm"]) == 1
+            assert len(files_per_zone["orlu"]) == 2
+            for files in files_per_zone.values():
+                for file in files:
+                    assert file.endswith(".png")
+                    assert os.path.exists(file)
+                    assert os.path.exists(Path(file).with_suffix(".json"))
+
+    def test_pipeline_failures(self):
+        """Test that a failed download is counted and does not stop crops of other products"""
+        failing_product = FAKE_PRODUCT.replace("20240511T103629", "20240514T104619")
+        products = {
+            FAKE_PRODUCT: (fake_eoproduct(), ["montcalm"]),
+            failing_product: (fake_eoproduct(failing_product), ["orlu"]),
+        }
+
+        class FailingDag(FakeDag):
+            """Fake gateway failing to download one product"""
+
+            def download(self, product, outputs_prefix, **kwargs):
+                if product.properties["id"] == failing_product:
+                    raise ConnectionError("Download interrupted")
+                return super().download(product, outputs_prefix, **kwargs)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            metrics = RunMetrics()
+            files_per_zone = run_pipeline(products, FailingDag(), tmp_dir, cpu_workers=1, metrics=metrics)
+
+            assert list(files_per_zone) == ["montcalm"]
+            assert metrics.report()["counters"]["download_failures"] == 1
+
+    def test_output_index(self):
+        """Test that written images are indexed for existence checks and retention"""
+        product = FAKE_PRODUCT.replace("20240511", f"{datetime.date.today():%Y%m%d}")
+        products = {product: (fake_eoproduct(product), ["montcalm"])}
+        old_date = datetime.date.today() - datetime.timedelta(days=40)
+        old_image = f"T31TCH_{old_date:%Y%m%d}T103629_TCI_10m_orlu.webp"
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            Path(tmp_dir, old_image).write_bytes(b"old")
+            Path(tmp_dir, old_image).with_suffix(".json").write_text("{}", encoding="utf-8")
+            index = OutputIndex(tmp_dir)
+            assert index.exists(f"{old_date:%Y%m%d}", "T31TCH", "orlu")
+            assert not check_files_in_local(tmp_dir, product, "montcalm", index=index)
+
+            run_pipeline(products, FakeDag(), tmp_dir, cpu_workers=1, output_index=index)
+            assert check_files_in_local(tmp_dir, product, "montcalm", index=index)
+            assert not check_files_in_local(tmp_dir, product, "orlu", index=index)
+
+            check_old_files(tmp_dir, index=index)
+            assert not os.path.exists(Path(tmp_dir, old_image))
+            assert not os.path.exists(Path(tmp_dir, old_image).with_suffix(".json"))
+            assert not os.path.exists(Path(tmp_dir, product))
+            assert check_files_in_local(tmp_dir, product, "montcalm")
+
+            os.remove(Path(tmp_dir, f"{tci_name(product)}_montcalm.png"))
+            assert not check_files_in_local(tmp_dir, product, "montcalm")
+
+        # The directory is scanned once by an index without database, and no longer once it is written
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            Path(tmp_dir, old_image).write_bytes(b"old")
+            index = OutputIndex(tmp_dir)
+            with self.assertLogs(level="INFO") as logs:
+                for _ in range(3):
+                    assert index.exists(f"{old_date:%Y%m%d}", "T31TCH", "orlu")
+                save_outputs(tmp_dir, {f"{tci_name(product)}_montcalm.png": b"png"}, index)
+                save_outputs(tmp_dir, {f"{tci_name(product)}_orlu.png": b"png"}, index)
+                next_run_index = OutputIndex(tmp_dir)
+                assert next_run_index.exists(f"{old_date:%Y%m%d}", "T31TCH", "orlu")
+                assert check_files_in_local(tmp_dir, product, "orlu", index=next_run_index)
+            assert sum("Index zone images" in line for line in logs.output) == 1
+
+    def test_time_series(self):
+        """Test that zone crops are appended once per date to their cube and read lazily by date range"""
+        later_product = FAKE_PRODUCT.replace("20240511T103629", "20240514T104619")
+        products = {
+            later_product: (fake_eoproduct(later_product), ["montcalm"]),
+            FAKE_PRODUCT: (fake_eoproduct(), ["montcalm", "orlu"]),
+        }
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            run_pipeline(products, FakeDag(), tmp_dir, cpu_workers=1, time_series=True)
+            run_pipeline(products, FakeDag(), tmp_dir, cpu_workers=1, time_series=True)
+
+            cube = open_cube(tmp_dir, "montcalm", "T31TCH")
+            assert cube.tci.dims == ("time", "band", "y", "x")
+            assert [str(time)[:10] for time in cube.time.values] == ["2024-05-11", "2024-05-14"]
+            _, rasters = read_zones(["montcalm"], os.path.join(tmp_dir, FAKE_PRODUCT, f"{FAKE_PRODUCT}.SAFE"))
+            np.testing.assert_array_equal(cube.tci.isel(time=0).values, rasters["montcalm"][0])
+
+            assert open_cube(tmp_dir, "montcalm", "T31TCH", start="2024-05-12").sizes["time"] == 1
+            assert open_cube(tmp_dir, "orlu", "T31TCH").sizes["time"] == 1
+
+    def test_stream_to_bucket(self):
+        """Test that zone images are encoded in memory and streamed to the bucket"""
+        products = {FAKE_PRODUCT: (fake_eoproduct(), ["montcalm"])}
+
+        with tempfile.TemporaryDirectory() as tmp_dir, FakeGCSServer() as server, \
+                BucketSession("pyrenees_images", client=fake_storage_client(server)) as session:
+            files_per_zone = run_pipeline(
+                products, FakeDag(), tmp_dir, bucket_session=session, cpu_workers=1, img_format="webp",
+                quality=80, keep_local=False,
+            )
+
+            assert files_per_zone == {"montcalm": ["T31TCH_20240511T103629_TCI_10m_montcalm.webp"]}
+            assert not glob.glob(os.path.join(tmp_dir, "*montcalm*"))
+            sidecar = json.loads(server.blobs["T31TCH_20240511T103629_TCI_10m_montcalm.json"])
+            assert sidecar["crs"] == "EPSG:32631"
+            with Image.open(io.BytesIO(server.blobs["T31TCH_20240511T103629_TCI_10m_montcalm.webp"])) as img:
+                assert img.size == (sidecar["width"], sidecar["height"])
+
+    def test_run_metrics(self):
+        """Test that the pipeline reports its stages, transferred bytes and peak memory"""
+        products = {FAKE_PRODUCT: (fake_eoproduct(), ["montcalm", "orlu"])}
+        metrics = RunMetrics()
+
+        with tempfile.TemporaryDirectory() as tmp_dir, FakeGCSServer() as server, \
+                BucketSession("pyrenees_images", client=fake_storage_client(server)) as session:
+            run_pipeline(products, FakeDag(), tmp_dir, bucket_session=session, cpu_workers=1, metrics=metrics)
+            report_path = os.path.join(tmp_dir, "run_report.json")
+            metrics.write_json(report_path)
+            with open(report_path, encoding="utf-8") as report_file:
+                report = json.load(report_file)
+
+            assert report["stages"]["download"]["calls"] == 1
+            assert report["stages"]["crop"]["calls"] == 1
+            assert report["stages"]["upload"]["calls"] == 4
+            assert report["counters"]["zones_cropped"] == 2
+            assert report["counters"]["files_uploaded"] == 4
+            assert report["counters"]["bytes_downloaded"] > 0
+            assert report["counters"]["bytes_uploaded"] == sum(len(blob) for blob in server.blobs.values())
+            assert report["peak_rss_bytes"] > 0
+
+            # A product published by a previous run is reused without counting a download
+            rerun_metrics = RunMetrics()
+            run_pipeline(products, FakeDag(), tmp_dir, cpu_workers=1, metrics=rerun_metrics)
+            counters = rerun_metrics.report()["counters"]
+            assert counters["products_reused"] == 1
+            assert "products_downloaded" not in counters and "bytes_downloaded" not in counters
+
+        openmetrics = metrics.to_openmetrics()
+        assert 'lookpyrenees_stage_calls_total{stage="upload"} 4' in openmetrics
+        assert "lookpyrenees_files_uploaded_total 4" in openmetrics
+        assert openmetrics.endswith("# EOF\n")
+
+    def test_bucket_index(self):
+        """Test that the bucket index lists the bucket once and writes its manifest"""
+        assert blob_key("T31TCH_20240511T103629_TCI_10m_rulhe_nerassol.png") == ("20240511", "T31TCH", "rulhe_nerassol")
+        assert blob_key(MANIFEST_BLOB) is None
+
+        with FakeGCSServer({"T31TCH_20240511T103629_TCI_10m_montcalm.png": b"png"}) as server:
+            client = fake_storage_client(server)
+            index = BucketIndex("pyrenees_images", use_manifest=True, client=client)
+            assert check_files_on_bucket("pyrenees_images", FAKE_PRODUCT, "montcalm", index=index)
+            assert not check_files_on_bucket("pyrenees_images", FAKE_PRODUCT, "orlu", index=index)
+            assert not index.exists(FAKE_PRODUCT, "rulhe_nerassol")
+
+            index.add("T31TCH_20240511T103629_TCI_10m_orlu.png")
+            assert index.exists(FAKE_PRODUCT, "orlu")
+            index.save()
+
+            index = BucketIndex("pyrenees_images", use_manifest=True, client=client).load()
+            assert index.exists(FAKE_PRODUCT, "orlu")
+            list_requests = [path for method, path in server.requests if method == "GET" and path.endswith("/o")]
+            assert len(list_requests) == 1
+
+    def test_bucket_session(self):
+        """Test uploads and deletion through one bucket session on a fake GCS server"""
+        file_to_upload = os.path.join(CURRENT_DIR, "tests", "examples", "test.txt")
+
+        with FakeGCSServer() as server, \
+                BucketSession("pyrenees_images", client=fake_storage_client(server), max_workers=2) as session:
+            assert session.upload(file_to_upload, "test.txt")
+            assert not session.upload(file_to_upload, "test.txt")
+            # The create only precondition replaces the existence check
+            assert not [path for method, path in server.requests if method == "GET" and "/o/" in path]
+            assert server.blobs["test.txt"] == b"test\n"
+
+            assert delete_blob("pyrenees_images", "test.txt", session=session)
+            assert not session.delete("test.txt")
+            assert "test.txt" not in server.blobs
+
+    def test_bucket_retention(self):
+        """Test that old zone images of a bucket are deleted with a few batch requests"""
+        today = datetime.date.today()
+        blobs = {"test.txt": b"test\n"}
+        for day in range(0, 90, 3):
+            for zone in ["montcalm", "orlu"]:
+                stem = tci_name(fake_product_name(today - datetime.timedelta(days=day))) + f"_{zone}"
+                blobs.update({f"{stem}.png": b"png", f"{stem}.json": b"{}"})
+        names = sorted(name for name in blobs if name.startswith("T31TCH"))
+        old = [name for name in names if blob_key(name)[0] < f"{today - datetime.timedelta(days=31):%Y%m%d}"]
+
+        assert expired_blobs(names, keep_last=2) == sorted(set(names) - {
+            name for name in names if blob_key(name)[0] >= f"{today - datetime.timedelta(days=3):%Y%m%d}"
+        })
+        assert expired_blobs(["manifest.json", "test.txt"], min_date=today, keep_last=0) == []
+
+        with FakeGCSServer(blobs) as server:
+            client = fake_storage_client(server)
+            with BucketSession("pyrenees_images", client=client) as session:
+                assert check_old_blobs("pyrenees_images", dry_run=True, session=session) == old
+                assert set(old) <= set(server.blobs)
+
+                server.requests.clear()
+                deleted = check_old_blobs("pyrenees_images", session=session)
+                assert deleted == old
+                assert not set(old) & set(server.blobs)
+                assert server.requests == [("POST", "/batch/storage/v1")] * math.ceil(len(old) / BATCH_SIZE)
+                assert session.delete_many(old[:2] + ["test.txt"]) == ["test.txt"]
+
+            with unittest.mock.patch("LookPyrenees.manage_bucket.storage.Client", return_value=client):
+                assert check_old_blobs("pyrenees_images", max_age_days=None, keep_last=1, use_manifest=True,
+                                       dry_run=True)
+            # A dry run does not write the manifest
+            assert MANIFEST_BLOB not in server.blobs
+
+            with BucketSession("pyrenees_images", client=client, use_manifest=True) as session:
+                check_old_blobs("pyrenees_images", max_age_days=None, keep_last=1, session=session)
+            # The manifest read by the next runs no longer lists deleted blobs
+            assert json.loads(server.blobs[MANIFEST_BLOB])["blobs"] == sorted(server.blobs.keys() - {MANIFEST_BLOB})
+            assert {blob_key(name)[0] for name in server.blobs if blob_key(name)} == {f"{today:%Y%m%d}"}
+
     def test_upload_and_remove_on_gcs(self):
         """Test to upload an image on google cloud storage
         """
@@ -177,26 +1031,24 @@ class TestClassifBase(unittest.TestCase):
     def test_check_files_in_local(self):
         """Test the features that check if files already exists in local folder"""
 
-        path_to_check = os.path.join(CURRENT_DIR,
-                                     "tests",
-                                     "examples")
         zone = "montcalm"
         product_id = "S2B_MSIL2A_20240511T103629_N0510_R008_T31TCH_20240511T121256"
         final_tif = "T31TCH_20240511T103629_TCI_10m_montcalm.tif"
 
-        if os.path.exists(os.path.join(path_to_check, final_tif)):
-            os.remove(os.path.join(path_to_check, final_tif))
-
-        exists_before = check_files_in_local(path_to_check, product_id, zone)
-        assert not exists_before
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path_to_check = shutil.copytree(os.path.join(CURRENT_DIR, "tests", "examples"),
+                                            os.path.join(tmp_dir, "examples"))
 
-        with open(os.path.join(path_to_check, final_tif), "w", encoding="utf-8") as _:
-            logging.info("File %s has been created", final_tif)
+            exists_before = check_files_in_local(path_to_check, product_id, zone)
+            assert not exists_before
 
-        exists_after = check_files_in_local(path_to_check, product_id, zone)
-        assert exists_after
+            with open(os.path.join(path_to_check, final_tif), "w", encoding="utf-8") as _:
+                logging.info("File %s has been created", final_tif)
 
-        os.remove(os.path.join(path_to_check, final_tif))
+            exists_after = check_files_in_local(path_to_check, product_id, zone)
+            assert exists_after
+            # Checks only read the directory, the index database is created on the first write
+            assert not os.path.exists(os.path.join(path_to_check, ".index"))
 
     def test_convert_tiff_to_png(self):
         """Test conversion of tif file in png file"""